@@ -0,0 +1,151 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Compares the CPU time and the size of output archives as they used to be
+written, every member deflated at the default level, with fixed deflate
+levels, the adaptive compression policy, with and without threads, and an
+uncompressed tar archive sent gzip-encoded.
+
+The archives hold a synthetic RIOS instrument and form of growing size, in
+JSON, and a small log, like the output of a conversion to RIOS. Members are
+serialized beforehand, so that only the compression is timed.
+
+Usage::
+
+    $ python benchmarks/bench_compression.py [threads] [repeat]
+"""
+
+
+import cStringIO
+import gzip
+import sys
+import time
+import zipfile
+
+from multiprocessing.pool import ThreadPool
+
+from rios.converter.compression import CompressionPolicy
+from rios.converter.engine import build_archive, build_tar, serialize
+
+
+FIELDS = (10, 100, 1000, 5000)
+
+LEVELS = (1, 6, 9)
+
+
+class FixedPolicy(CompressionPolicy):
+    """ Deflates every member at the same level """
+
+    def __init__(self, fixed):
+        super(FixedPolicy, self).__init__()
+        self.fixed = fixed
+
+    def level(self, size):
+        return self.fixed
+
+
+def make_members(fields):
+    instrument = {
+        'id': 'urn:benchmark',
+        'version': '1.0',
+        'title': 'Benchmark',
+        'record': [
+            {'id': 'field_%d' % (idx,), 'type': 'enumeration'}
+            for idx in range(fields)
+        ],
+    }
+    form = {
+        'instrument': {'id': 'urn:benchmark', 'version': '1.0'},
+        'defaultLocalization': 'en',
+        'pages': [
+            {
+                'id': 'page_1',
+                'elements': [
+                    {
+                        'type': 'question',
+                        'options': {
+                            'fieldId': 'field_%d' % (idx,),
+                            'text': {'en': 'Question number %d' % (idx,)},
+                            'enumerations': [
+                                {'id': 'choice_%d' % (choice,)}
+                                for choice in range(5)
+                            ],
+                        },
+                    }
+                    for idx in range(fields)
+                ],
+            },
+        ],
+    }
+    return [
+        ('benchmark_i.json', serialize(instrument, 'json'), None, {}),
+        ('benchmark_f.json', serialize(form, 'json'), None, {}),
+        ('benchmark.log', 'Converted %d fields\n' % (fields,), None, {}),
+    ]
+
+
+def baseline(members):
+    """ Writes every member at the default level, as before """
+
+    container = cStringIO.StringIO()
+    with zipfile.ZipFile(container, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, payload, data_type, kwargs in members:
+            archive.writestr(name, serialize(payload, data_type, **kwargs))
+    return container.getvalue()
+
+
+def tar_gzip(members):
+    """ Writes a tar archive and gzips it, as it is sent over the wire """
+
+    container = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=container, mode='wb', mtime=0) as fp:
+        fp.write(build_tar(members).read())
+    return container.getvalue()
+
+
+def best(build, members, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.clock()
+        output = build(members)
+        timings.append(time.clock() - start)
+    if not isinstance(output, str):
+        output = output.read()
+    return min(timings), len(output)
+
+
+def main(threads=4, repeat=5):
+    pool = ThreadPool(threads)
+    policy = CompressionPolicy()
+    builds = [('default', baseline)] + [
+        ('level %d' % (level,),
+         lambda members, level=level: build_archive(
+             members, policy=FixedPolicy(level)))
+        for level in LEVELS
+    ] + [
+        ('adaptive',
+         lambda members: build_archive(members, policy=policy)),
+        ('adaptive x%d' % (threads,),
+         lambda members: build_archive(members, policy=policy, pool=pool)),
+        ('tar+gzip', tar_gzip),
+    ]
+
+    print '%8s %12s %12s %10s %12s' % (
+        'fields', 'archive', 'input [B]', 'cpu [ms]', 'output [B]')
+    for fields in FIELDS:
+        members = make_members(fields)
+        size = sum(len(payload) for _, payload, _, _ in members)
+        for label, build in builds:
+            cpu, output = best(build, members, repeat)
+            print '%8d %12s %12d %10.2f %12d' % (
+                fields, label, size, cpu * 1000, output)
+    print 'threads: %d' % (threads,)
+    pool.close()
+    pool.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:3]]))
@@ -0,0 +1,145 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Compares the memory taken by parsed RIOS documents and the time to parse
+and validate them, as plain documents and interned by
+``rios.converter.interning``, on synthetic instruments and forms with
+growing numbers of enumeration fields, and checks that both validate
+alike.
+
+Memory is the size of every distinct object reachable from the instrument
+and the form, measured with ``sys.getsizeof``.
+
+Usage::
+
+    $ python benchmarks/bench_documents.py [format] [repeat]
+"""
+
+
+import sys
+import time
+
+from rios.core import validate_form, validate_instrument
+from rios.converter.serialization import dump_json, dump_yaml
+from rios.converter.validation import load_rios
+
+
+FIELDS = (100, 1000, 5000)
+
+CHOICES = ('yes', 'no', 'unknown', 'refused')
+
+
+def make_documents(fields):
+    instrument = {
+        'id': 'urn:benchmark',
+        'version': '1.0',
+        'title': 'Benchmark',
+        'record': [
+            {
+                'id': 'field_%d' % (idx,),
+                'type': {
+                    'base': 'enumeration',
+                    'enumerations': dict(
+                        (choice, {'description': choice.capitalize()})
+                        for choice in CHOICES
+                    ),
+                },
+                'required': True,
+            }
+            for idx in range(fields)
+        ],
+    }
+    form = {
+        'instrument': {'id': 'urn:benchmark', 'version': '1.0'},
+        'defaultLocalization': 'en',
+        'title': {'en': 'Benchmark'},
+        'pages': [
+            {
+                'id': 'page_%d' % (page,),
+                'elements': [
+                    {
+                        'type': 'question',
+                        'options': {
+                            'fieldId': 'field_%d' % (idx,),
+                            'text': {'en': 'Question number %d' % (idx,)},
+                            'enumerations': [
+                                {
+                                    'id': choice,
+                                    'text': {'en': choice.capitalize()},
+                                }
+                                for choice in CHOICES
+                            ],
+                        },
+                    }
+                    for idx in range(page * 100, min(fields, page * 100 + 100))
+                ],
+            }
+            for page in range((fields + 99) // 100)
+        ],
+    }
+    return instrument, form
+
+
+def deep_size(document):
+    """ Returns the size of the distinct objects of a parsed document """
+
+    seen = set()
+    size = 0
+    pending = [document]
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+    return size
+
+
+def best(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def validate(instrument, form):
+    validate_instrument(instrument)
+    validate_form(form, instrument=instrument)
+
+
+def main(format='json', repeat=3):
+    dump = dump_yaml if format == 'yaml' else dump_json
+    print '%6s %8s %12s %10s %14s' % (
+        'fields', 'loader', 'memory [B]', 'parse [s]', 'validate [s]')
+    for fields in FIELDS:
+        contents = [dump(document) for document in make_documents(fields)]
+        for interned in (False, True):
+            parsing, (instrument, form) = best(
+                lambda: [
+                    load_rios(format, content, interned=interned)
+                    for content in contents
+                ],
+                repeat,
+            )
+            validating, _ = best(lambda: validate(instrument, form), repeat)
+            print '%6d %8s %12d %10.3f %14.3f' % (
+                fields,
+                'interned' if interned else 'plain',
+                deep_size([instrument, form]),
+                parsing,
+                validating,
+            )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*(sys.argv[1:2] + [int(arg) for arg in sys.argv[2:3]])))
@@ -0,0 +1,120 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Measures how long ``import rios.converter`` takes, on top of the ``rex.web``
+framework it runs in, and checks that it doesn't load the dependencies that
+are only needed once a conversion runs.
+
+Python 2 has no ``-X importtime``, so each run times every import statement
+by wrapping ``__import__`` in a fresh interpreter, and the slowest imports
+of the last run are listed the same way.
+
+Usage::
+
+    $ python benchmarks/bench_imports.py [repeat] [max_ms]
+
+Exits with status 1 if the median import time exceeds ``max_ms`` (default
+300) or if one of the deferred dependencies is loaded.
+"""
+
+
+import subprocess
+import sys
+
+import simplejson
+
+
+# Dependencies that must only be imported when a handler needs them
+DEFERRED = (
+    'docutils',
+    'props',
+    'rios.conversion',
+    'rios.core',
+    'yaml',
+)
+
+CHILD = r'''
+import __builtin__
+import sys
+import time
+
+import simplejson
+
+import rex.web
+baseline = set(sys.modules)
+
+original_import = __builtin__.__import__
+timings = []
+nested = [0.0]
+
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    loaded = len(sys.modules)
+    nested.append(0.0)
+    start = time.time()
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        inner = nested.pop()
+        nested[-1] += elapsed
+        if len(sys.modules) > loaded:
+            label = ('.' * level if level > 0 else '') + name
+            timings.append((elapsed - inner, elapsed, label))
+
+
+__builtin__.__import__ = timed_import
+start = time.time()
+import rios.converter
+total = time.time() - start
+__builtin__.__import__ = original_import
+
+print simplejson.dumps({
+    'total': total,
+    'timings': timings,
+    'loaded': sorted(set(sys.modules) - baseline),
+})
+'''
+
+
+def run_child():
+    output = subprocess.check_output([sys.executable, '-c', CHILD])
+    return simplejson.loads(output)
+
+
+def deferred_loaded(run):
+    """ Lists the deferred dependencies the import loaded """
+
+    loaded = set(run['loaded'])
+    return [module for module in DEFERRED if module in loaded]
+
+
+def main(repeat=5, max_ms=300):
+    runs = [run_child() for _ in range(repeat)]
+    totals = sorted(run['total'] * 1000 for run in runs)
+    median = totals[len(totals) // 2]
+
+    print 'Slowest imports of the last run'
+    print '  %10s %10s  %s' % ('self [ms]', 'cum [ms]', 'import')
+    for own, cumulative, label in sorted(
+            runs[-1]['timings'], key=lambda timing: -timing[1])[:15]:
+        print '  %10.1f %10.1f  %s' % (own * 1000, cumulative * 1000, label)
+    print 'import rios.converter: median %.1f ms, min %.1f ms (%d runs)' % (
+        median, totals[0], repeat)
+
+    failed = False
+    if median > max_ms:
+        print 'FAIL: median import time exceeds %d ms' % (max_ms,)
+        failed = True
+    loaded = deferred_loaded(runs[-1])
+    if loaded:
+        print 'FAIL: deferred dependencies were imported: %s' % (
+            ', '.join(loaded),)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:3]]))
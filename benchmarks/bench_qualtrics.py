@@ -0,0 +1,163 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Compares the serial and the parallel conversion of Qualtrics surveys to RIOS
+as the number of questions grows, and checks that both produce the same
+output.
+
+The surveys repeat the questions of ``tests/qualtrics/test_1.qsf`` on new
+pages. Its display-only questions are left out, since ``rios.conversion``
+fails to validate the forms they produce, which would make every survey
+fall back to the serial conversion.
+
+Usage::
+
+    $ python benchmarks/bench_qualtrics.py [processes] [repeat]
+
+Exits with status 1 if the outputs differ.
+"""
+
+
+import copy
+import cStringIO
+import multiprocessing
+import os
+import sys
+import time
+
+import simplejson
+
+from rios.conversion import qualtrics_to_rios
+from rios.converter.parallel import convert_qualtrics
+
+
+SURVEY = os.path.join(
+    os.path.dirname(__file__),
+    '..',
+    'tests',
+    'qualtrics',
+    'test_1.qsf',
+)
+
+COPIES = (1, 10, 50, 100, 200)
+
+
+def load_survey():
+    """ Loads the sample survey without its display-only questions """
+
+    with open(SURVEY) as survey_file:
+        survey = simplejson.load(survey_file)
+    display = set(
+        element['Payload']['QuestionID']
+        for element in survey['SurveyElements']
+        if element['Element'] == 'SQ' and
+        element['Payload']['QuestionType'] == 'DB'
+    )
+    survey['SurveyElements'] = [
+        element
+        for element in survey['SurveyElements']
+        if element['Element'] != 'SQ' or
+        element['Payload']['QuestionID'] not in display
+    ]
+    block = get_block(survey)
+    elements = []
+    for element in block['BlockElements']:
+        if element.get('QuestionID') in display:
+            continue
+        if element['Type'] == 'Page Break' and \
+                (not elements or elements[-1]['Type'] == 'Page Break'):
+            continue
+        elements.append(element)
+    while elements and elements[-1]['Type'] == 'Page Break':
+        elements.pop()
+    block['BlockElements'] = elements
+    return survey
+
+
+def get_block(survey):
+    """ Returns the block ``rios.conversion`` reads the questions from """
+
+    for element in survey['SurveyElements']:
+        if element['Element'] == 'BL':
+            blocks = element['Payload']
+            if isinstance(blocks, dict):
+                blocks = blocks.values()
+            for block in blocks:
+                if block['BlockElements']:
+                    return block
+
+
+def make_survey(survey, copies):
+    """ Repeats the questions of ``survey`` on new pages ``copies`` times """
+
+    survey = copy.deepcopy(survey)
+    questions = [
+        element
+        for element in survey['SurveyElements']
+        if element['Element'] == 'SQ'
+    ]
+    block = get_block(survey)
+    original = list(block['BlockElements'])
+    for idx in range(1, copies):
+        block['BlockElements'].append({'Type': 'Page Break'})
+        for element in original:
+            element = dict(element)
+            if element['Type'] == 'Question':
+                element['QuestionID'] += '_%d' % (idx,)
+            block['BlockElements'].append(element)
+        for question in questions:
+            question = copy.deepcopy(question)
+            payload = question['Payload']
+            payload['QuestionID'] += '_%d' % (idx,)
+            payload['DataExportTag'] += '_%d' % (idx,)
+            survey['SurveyElements'].append(question)
+    return simplejson.dumps(survey), len(questions) * copies
+
+
+def best(convert, content, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        result = convert(
+            stream=cStringIO.StringIO(content),
+            filemetadata=True,
+            suppress=True,
+        )
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def main(processes=None, repeat=3):
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes)
+    survey = load_survey()
+
+    def convert_parallel(**params):
+        return convert_qualtrics(pool, **params)
+
+    print '%10s %12s %14s %8s  %s' % (
+        'questions', 'serial [s]', 'parallel [s]', 'speedup', 'output')
+    identical = True
+    for copies in COPIES:
+        content, questions = make_survey(survey, copies)
+        serial, expected = best(qualtrics_to_rios, content, repeat)
+        parallel, result = best(convert_parallel, content, repeat)
+        same = result == expected
+        identical = identical and same
+        print '%10d %12.3f %14.3f %8.2f  %s' % (
+            questions,
+            serial,
+            parallel,
+            serial / parallel,
+            'identical' if same else 'DIFFERENT',
+        )
+    print 'processes: %d' % (processes,)
+    pool.close()
+    pool.join()
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:3]]))
@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Compares the pure-Python and C-accelerated YAML/JSON backends used by
+``rios.converter.serialization`` on a large synthetic RIOS form.
+
+Usage::
+
+    $ python benchmarks/bench_serialization.py [fields] [repeat]
+"""
+
+
+import sys
+import timeit
+
+import simplejson
+import yaml
+
+from rios.converter.serialization import (
+    HAS_JSON_SPEEDUPS,
+    dump_json,
+    dump_yaml,
+    has_libyaml,
+    load_json,
+    load_yaml,
+)
+
+
+def make_form(fields):
+    enumerations = [
+        {
+            'id': 'choice_%d' % (idx,),
+            'text': {'en': 'Choice number %d' % (idx,)},
+        }
+        for idx in range(5)
+    ]
+    return {
+        'instrument': {'id': 'urn:benchmark', 'version': '1.0'},
+        'defaultLocalization': 'en',
+        'title': {'en': 'Benchmark form'},
+        'pages': [
+            {
+                'id': 'page_%d' % (page,),
+                'elements': [
+                    {
+                        'type': 'question',
+                        'options': {
+                            'fieldId': 'field_%d_%d' % (page, idx),
+                            'text': {'en': 'Question %d on page %d' % (
+                                idx, page)},
+                            'help': {'en': 'Pick exactly one answer'},
+                            'enumerations': [
+                                dict(enumeration)
+                                for enumeration in enumerations
+                            ],
+                        },
+                    }
+                    for idx in range(50)
+                ],
+            }
+            for page in range(max(fields // 50, 1))
+        ],
+    }
+
+
+def bench(label, func, repeat):
+    elapsed = min(timeit.repeat(func, number=1, repeat=repeat))
+    print '  %-32s %8.3fs' % (label, elapsed)
+    return elapsed
+
+
+def main(fields=5000, repeat=3):
+    form = make_form(fields)
+    print 'Fields: %d, libyaml: %s, simplejson speedups: %s' % (
+        fields, has_libyaml(), HAS_JSON_SPEEDUPS)
+
+    yaml_text = yaml.dump(form, default_flow_style=False)
+    json_text = simplejson.dumps(form, sort_keys=True, indent='    ')
+    assert dump_yaml(form) == yaml_text, 'YAML output changed'
+    assert dump_json(form) == json_text, 'JSON output changed'
+
+    print 'YAML'
+    bench('dump (yaml.Dumper)',
+          lambda: yaml.dump(form, default_flow_style=False), repeat)
+    bench('dump (backend)', lambda: dump_yaml(form), repeat)
+    if has_libyaml():
+        bench('dump (yaml.CDumper)',
+              lambda: yaml.dump(form, Dumper=yaml.CDumper,
+                                default_flow_style=False), repeat)
+    bench('dump compact (backend)',
+          lambda: dump_yaml(form, compact=True), repeat)
+    bench('load (yaml.SafeLoader)',
+          lambda: yaml.safe_load(yaml_text), repeat)
+    bench('load (backend)', lambda: load_yaml(yaml_text), repeat)
+
+    print 'JSON'
+    bench('dump (simplejson.dump)',
+          lambda: simplejson.dumps(form, sort_keys=True, indent='    '),
+          repeat)
+    bench('dump (backend)', lambda: dump_json(form), repeat)
+    bench('dump compact (backend)',
+          lambda: dump_json(form, compact=True), repeat)
+    bench('load (backend)', lambda: load_json(json_text), repeat)
+    if HAS_JSON_SPEEDUPS:
+        simplejson._toggle_speedups(False)
+        try:
+            bench('load (pure Python)',
+                  lambda: simplejson.loads(json_text), repeat)
+        finally:
+            simplejson._toggle_speedups(True)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
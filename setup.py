@@ -42,6 +42,12 @@ setup(
             'flake8>=2.5.0,<3',
         ],
     },
+    entry_points={
+        'console_scripts': [
+            'rios-converter-batch = rios.converter.batch:main',
+            'rios-converter-assets = rios.converter.assets:main',
+        ],
+    },
     test_suite='nose.collector',
     rex_init='rios.converter',
     rex_static='static',
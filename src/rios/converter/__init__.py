@@ -4,5 +4,6 @@
 
 
 from .converter import *  # noqa:F401,F403
+from .engine import *  # noqa:F401,F403
 from .settings import *  # noqa:F401,F403
 from .initialize import *  # noqa:F401,F403
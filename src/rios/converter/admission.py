@@ -0,0 +1,497 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+import collections
+import contextlib
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+from webob.exc import HTTPServiceUnavailable
+from rex.core import cached, get_settings
+from .tracing import span
+
+
+__all__ = (
+    'AdmissionController',
+    'client_key',
+    'get_admission',
+    'schedule',
+)
+
+
+# Seconds between two attempts of a queued conversion to get a slot
+POLL_INTERVAL = 0.05
+
+# Request header identifying scripted clients
+TOKEN_HEADER = 'X-API-Token'
+
+# Seconds of a client's byte rate that can be used up in a burst, or
+# borrowed by an upload larger than its budget
+RATE_BURST = 10
+
+# Seconds after which the state of an idle client is forgotten; by then
+# its budget is full again
+CLIENT_IDLE = 60
+
+
+Ticket = collections.namedtuple('Ticket', 'name size client')
+
+
+def client_key(req, tokens=None):
+    """
+    Identifies the client of a request by its API token, if it sends one of
+    the ``tokens`` (by default, ``conversion_client_tokens``), otherwise by
+    its remote address. Other tokens are ignored, so a client can't get a
+    fresh share and budget by sending a new token with every request.
+    """
+
+    if tokens is None:
+        tokens = get_settings().conversion_client_tokens
+    token = req.headers.get(TOKEN_HEADER)
+    if token and token in tokens:
+        return 'token:' + hashlib.sha1(token).hexdigest()[:16]
+    return 'addr:' + (req.remote_addr or 'unknown')
+
+
+def schedule(tickets, running, weights=None, client_limit=0, budgets=None,
+             vtimes=None, clock=0.0):
+    """
+    Orders queued conversions by weighted fair queuing across clients.
+
+    Every admitted conversion advances the virtual time of its client by
+    the inverse of the client's weight, and each turn goes to the waiting
+    client with the lowest virtual time; ties go to the oldest ticket. So
+    clients take turns, and a client of weight 3 gets three turns for every
+    turn of a client of weight 1. Clients that were idle resume at the
+    virtual ``clock``, the virtual time of the last admission, so they
+    can't claim the turns they didn't use. A client never runs more than
+    ``client_limit`` conversions at a time. While more than one client is
+    waiting, clients whose byte ``budgets`` can't cover their next upload
+    are passed over.
+
+    :param tickets: Queued :class:`Ticket` objects in arrival order
+    :param running: Number of running conversions by client
+    :param weights: Weight by client; clients not listed have weight 1
+    :param budgets: Available upload bytes by client, if rate limited
+    :param vtimes: Virtual time by client
+    :param clock: Virtual time of the last admission
+    :returns: The tickets that may run, in the order they should run
+    :rtype: list
+    """
+
+    weights = weights or {}
+    budgets = dict(budgets or {})
+    load = collections.defaultdict(int, running)
+    queues = collections.OrderedDict()
+    for ticket in tickets:
+        queues.setdefault(ticket.client, collections.deque()).append(ticket)
+    vtimes = dict(
+        (client, max((vtimes or {}).get(client, clock), clock))
+        for client in queues
+    )
+
+    order = []
+    while queues:
+        candidates = [
+            client for client in queues
+            if not client_limit or load[client] < client_limit
+        ]
+        if len(queues) > 1:
+            funded = [
+                client for client in candidates
+                if budgets.get(client) is None or
+                budgets[client] >= queues[client][0].size
+            ]
+            candidates = funded or candidates
+        if not candidates:
+            break
+        client = min(candidates, key=lambda client: (
+            vtimes[client],
+            queues[client][0].name,
+        ))
+        ticket = queues[client].popleft()
+        order.append(ticket)
+        load[client] += 1
+        vtimes[client] += 1.0 / weights.get(client, 1)
+        if budgets.get(client) is not None:
+            budgets[client] -= ticket.size
+        if not queues[client]:
+            del queues[client]
+    return order
+
+
+class AdmissionController(object):
+    """
+    Limits the number of conversions that run at the same time across all
+    the worker processes sharing ``path``.
+
+    A conversion runs while it holds an exclusive lock on one of ``limit``
+    slot files, so a slot is released even if its worker dies. Conversions
+    that find no free slot wait in a queue bounded by ``queue_length``
+    requests and ``queue_size`` upload bytes, and are admitted fairly
+    across clients, see :func:`schedule`. ``client_limit`` caps the
+    conversions of a single client and ``client_rate`` the upload bytes per
+    second a client may convert while others are waiting. When the queue
+    is full, or a conversion waits longer than ``timeout`` seconds, the
+    request is answered with 503 Service Unavailable and a Retry-After
+    header. A ``limit`` of 0 admits every conversion immediately.
+
+    A queued conversion holds a request thread of its worker while it
+    waits. With ``worker_threads``, the number of requests a worker process
+    serves at the same time, a conversion is only queued if that leaves
+    the worker a thread for other requests, and is refused at once
+    otherwise.
+    """
+
+    def __init__(self, path, limit, queue_length, queue_size, timeout,
+                 retry_after, client_limit=0, client_rate=0, weights=None,
+                 worker_threads=0):
+        self.path = path
+        self.limit = limit
+        self.queue_length = queue_length
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.client_limit = client_limit
+        self.client_rate = client_rate
+        self.weights = weights or {}
+        self.worker_threads = worker_threads
+        # Conversions of this process, running or waiting
+        self.held = 0
+        self.held_lock = threading.Lock()
+        self.queue_path = os.path.join(path, 'queue')
+        self.client_path = os.path.join(path, 'clients')
+        for directory in (self.queue_path, self.client_path):
+            if limit and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+
+    @contextlib.contextmanager
+    def admit(self, size, client=''):
+        """
+        Waits until a conversion of an upload of ``size`` bytes from the
+        given ``client`` may run.
+
+        :raises HTTPServiceUnavailable:
+            If the queue is full or the wait times out
+        """
+
+        if not self.limit:
+            yield
+            return
+        with self.held_lock:
+            waiting = self.held
+            self.held += 1
+        try:
+            with self._admit(size, client, waiting):
+                yield
+        finally:
+            with self.held_lock:
+                self.held -= 1
+
+    @contextlib.contextmanager
+    def _admit(self, size, client, held):
+        with span('admission', bytes=size) as admission:
+            slot = None
+            running = self.running()
+            if (not self.tickets() and
+                    (not self.client_limit or
+                     running.get(client, 0) < self.client_limit)):
+                slot = self.acquire(client)
+            if slot is None:
+                if self.worker_threads and held + 1 >= self.worker_threads:
+                    # Waiting would take the last free thread of the worker
+                    raise self.unavailable()
+                admission.set(queued=True)
+                ticket = self.enqueue(size, client)
+                try:
+                    deadline = time.time() + self.timeout
+                    while slot is None:
+                        if time.time() > deadline:
+                            raise self.unavailable()
+                        time.sleep(POLL_INTERVAL)
+                        running = self.running()
+                        free = self.limit - sum(running.values())
+                        states = self.states()
+                        order = schedule(
+                            self.tickets(),
+                            running,
+                            weights=self.weights,
+                            client_limit=self.client_limit,
+                            budgets=self.budgets(states),
+                            vtimes=dict(
+                                (client, state[0])
+                                for client, state in states.items()
+                            ),
+                            clock=self.clock(),
+                        )
+                        if ticket in [next.name for next in order[:free]]:
+                            slot = self.acquire(client)
+                finally:
+                    self.dequeue(ticket)
+            self.charge(client, size)
+        try:
+            yield
+        finally:
+            # Closing the file releases the lock
+            slot.close()
+
+    def acquire(self, client=''):
+        """ Returns the open, locked file of a free slot, or None """
+
+        # Under the queue lock, so that `running` doesn't probe a free slot
+        # while it is tried here
+        with self._queue_lock():
+            for idx in range(self.limit):
+                path = os.path.join(self.path, 'slot-%d' % (idx,))
+                slot = open(path, 'a+')
+                try:
+                    fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    slot.close()
+                else:
+                    # Record the client holding the slot
+                    slot.truncate(0)
+                    slot.write(client)
+                    slot.flush()
+                    return slot
+        return None
+
+    def running(self):
+        """ Counts the running conversions by client """
+
+        running = collections.defaultdict(int)
+        with self._queue_lock():
+            for idx in range(self.limit):
+                path = os.path.join(self.path, 'slot-%d' % (idx,))
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'r') as slot:
+                    # A slot is busy if it can't be locked; the probe is
+                    # released at once, when the file is closed
+                    try:
+                        fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        running[slot.read()] += 1
+        return dict(running)
+
+    def tickets(self):
+        """
+        Lists the queued conversions in arrival order as :class:`Ticket`
+        objects. Tickets of dead workers are removed.
+        """
+
+        tickets = []
+        for name in sorted(os.listdir(self.queue_path)):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.queue_path, name)
+            pid = int(name.split('-')[1])
+            try:
+                os.kill(pid, 0)
+            except OSError as exc:
+                if exc.errno == errno.ESRCH:
+                    self._remove(path)
+                    continue
+            try:
+                with open(path, 'rb') as fp:
+                    size, _, client = fp.read().partition(' ')
+                tickets.append(Ticket(name, int(size), client))
+            except (IOError, ValueError):
+                # Dequeued in the meantime
+                continue
+        return tickets
+
+    def states(self):
+        """
+        Returns the virtual time, the byte budget and the time of the last
+        admission of every client admitted before, by client.
+        """
+
+        states = {}
+        for name in os.listdir(self.client_path):
+            if name.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(self.client_path, name), 'rb') as fp:
+                    vtime, tokens, updated, client = fp.read().split(' ', 3)
+                states[client] = (float(vtime), float(tokens), float(updated))
+            except (IOError, ValueError):
+                continue
+        return states
+
+    def clock(self):
+        """ Returns the virtual time of the last admission """
+
+        try:
+            with open(os.path.join(self.path, 'clock'), 'rb') as fp:
+                return float(fp.read())
+        except (IOError, ValueError):
+            return 0.0
+
+    def budgets(self, states=None):
+        """ Returns the upload bytes each rate limited client may convert """
+
+        if not self.client_rate:
+            return {}
+        if states is None:
+            states = self.states()
+        now = time.time()
+        return dict(
+            (client, min(
+                self.client_rate * RATE_BURST,
+                tokens + (now - updated) * self.client_rate,
+            ))
+            for client, (_, tokens, updated) in states.items()
+        )
+
+    def charge(self, client, size):
+        """
+        Records the admission of a conversion of ``size`` bytes for
+        ``client``: advances its virtual time and takes the bytes from its
+        budget, which may owe at most ``RATE_BURST`` seconds of its rate.
+        The states of other clients idle for ``CLIENT_IDLE`` seconds are
+        removed, unless they are queued.
+        """
+
+        with self._queue_lock():
+            states = self.states()
+            clock = self.clock()
+            if client in states:
+                clock = max(states[client][0], clock)
+            budget = self.budgets(states).get(
+                client,
+                self.client_rate * RATE_BURST,
+            )
+            self._write(
+                self.client_path,
+                hashlib.sha1(client).hexdigest(),
+                '%r %r %r %s' % (
+                    clock + 1.0 / self.weights.get(client, 1),
+                    max(budget - size, -self.client_rate * RATE_BURST),
+                    time.time(),
+                    client,
+                ),
+            )
+            self._write(self.path, 'clock', repr(clock))
+            queued = set(ticket.client for ticket in self.tickets())
+            now = time.time()
+            for other, (_, _, updated) in states.items():
+                if other != client and other not in queued and \
+                        now - updated > CLIENT_IDLE:
+                    self._remove(os.path.join(
+                        self.client_path,
+                        hashlib.sha1(other).hexdigest(),
+                    ))
+
+    def enqueue(self, size, client=''):
+        """
+        Adds a conversion to the queue and returns its ticket.
+
+        :raises HTTPServiceUnavailable: If the queue is full
+        """
+
+        with self._queue_lock():
+            tickets = self.tickets()
+            queued = sum(ticket.size for ticket in tickets)
+            if (len(tickets) >= self.queue_length or
+                    (tickets and queued + size > self.queue_size)):
+                raise self.unavailable(len(tickets))
+            ticket = '%020d-%d-%d' % (
+                int(time.time() * 1e6),
+                os.getpid(),
+                threading.current_thread().ident,
+            )
+            self._write(self.queue_path, ticket, '%d %s' % (size, client))
+        return ticket
+
+    def dequeue(self, ticket):
+        self._remove(os.path.join(self.queue_path, ticket))
+
+    def unavailable(self, depth=None):
+        """ Builds the 503 response for a conversion that isn't admitted """
+
+        if depth is None:
+            depth = len(self.tickets())
+        retry_after = self.retry_after * (1 + depth // max(self.limit, 1))
+        error = HTTPServiceUnavailable(
+            "The converter is busy. Please try again later.",
+        )
+        error.retry_after = retry_after
+        return error
+
+    def stats(self):
+        """ Reports the number of running and queued conversions """
+
+        running = self.running() if self.limit else {}
+        tickets = self.tickets() if self.limit else []
+        clients = collections.defaultdict(
+            lambda: {'running': 0, 'queued': 0, 'queued_bytes': 0}
+        )
+        for client, count in running.items():
+            clients[client]['running'] = count
+        for ticket in tickets:
+            clients[ticket.client]['queued'] += 1
+            clients[ticket.client]['queued_bytes'] += ticket.size
+        return {
+            'limit': self.limit,
+            'running': sum(running.values()),
+            'queued': len(tickets),
+            'queued_bytes': sum(ticket.size for ticket in tickets),
+            'clients': dict(clients),
+        }
+
+    @contextlib.contextmanager
+    def _queue_lock(self):
+        with open(os.path.join(self.path, 'queue.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @staticmethod
+    def _write(directory, name, content):
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        os.rename(temp_path, os.path.join(directory, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed by another worker
+            pass
+
+
+@cached
+def get_admission():
+    """ Returns the application's :class:`AdmissionController` """
+
+    settings = get_settings()
+    return AdmissionController(
+        os.path.join(
+            settings.temp_dir or tempfile.gettempdir(),
+            'rios.converter',
+            'admission'
+        ),
+        limit=settings.conversion_limit,
+        queue_length=settings.conversion_queue_length,
+        queue_size=settings.conversion_queue_size,
+        timeout=settings.conversion_queue_timeout,
+        retry_after=settings.conversion_retry_after,
+        client_limit=settings.conversion_client_limit,
+        client_rate=settings.conversion_client_rate,
+        weights=settings.conversion_client_weights,
+        worker_threads=settings.conversion_worker_threads,
+    )
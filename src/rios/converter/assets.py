@@ -0,0 +1,230 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Fingerprinted static assets.
+
+After ``rex_bundle`` has built the webpack bundle, ``rios-converter-assets``
+copies the bundle and the images under ``static/www`` to file names that
+carry a digest of their content, precompresses text assets to ``.gz``
+files, and writes a manifest of the fingerprinted names. Templates refer
+to assets with ``asset()``, which looks them up in the manifest, and
+fingerprinted files are served as immutable, so repeat visitors don't
+request them again. Without a manifest, assets keep their plain names.
+
+Usage::
+
+    $ rios-converter-assets [www_dir]
+"""
+
+
+import argparse
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+import sys
+
+import simplejson
+
+
+from webob import Response
+from rex.core import cached, get_packages
+
+
+__all__ = (
+    'asset',
+    'asset_response',
+    'build_assets',
+    'get_asset_manifest',
+    'main',
+    'serve_asset',
+)
+
+
+# Manifest of fingerprinted names, in the ``www`` directory
+MANIFEST = 'assets.json'
+
+WWW = 'rios.converter:/www'
+
+# Directories of ``www`` whose files are fingerprinted
+ASSET_DIRS = ('bundle', 'img')
+
+# Number of hex digits of the content digest in file names
+DIGEST_LENGTH = 12
+
+# File names carrying a content digest, ours or webpack's
+FINGERPRINTED = re.compile(r'(^|\.)[0-9a-f]{%d,}\.[A-Za-z0-9]+$' % (
+    DIGEST_LENGTH,))
+
+# Assets that are precompressed
+COMPRESSIBLE = ('.css', '.js', '.json', '.map', '.svg', '.ttf', '.eot')
+
+# Fingerprinted files never change, so they are cached for a year
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Other files are revalidated
+REVALIDATE = 'no-cache'
+
+
+def fingerprint(path):
+    """ Returns the name of a file with its content digest """
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 16), ''):
+            digest.update(block)
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return '%s.%s%s' % (stem, digest.hexdigest()[:DIGEST_LENGTH], ext)
+
+
+def precompress(path):
+    """
+    Writes a ``.gz`` variant of a file next to it, unless it doesn't get
+    any smaller.
+    """
+
+    target = path + '.gz'
+    if os.path.exists(target):
+        return
+    temp_path = target + '.tmp'
+    with open(path, 'rb') as source, open(temp_path, 'wb') as fp:
+        # No name or time in the header, so builds are reproducible
+        with gzip.GzipFile(filename='', fileobj=fp, mode='wb',
+                           compresslevel=9, mtime=0) as compressed:
+            shutil.copyfileobj(source, compressed)
+    if os.path.getsize(temp_path) < os.path.getsize(path):
+        os.rename(temp_path, target)
+    else:
+        os.remove(temp_path)
+
+
+def build_assets(www):
+    """
+    Fingerprints and precompresses the assets under ``www`` and writes the
+    manifest. Previously fingerprinted copies are kept, so pages cached
+    before a deployment still find their assets.
+
+    :returns: The manifest: fingerprinted names by plain name
+    :rtype: dict
+    """
+
+    manifest = {}
+    for directory in ASSET_DIRS:
+        for root, _, filenames in os.walk(os.path.join(www, directory)):
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, www).replace(os.sep, '/')
+                if filename.endswith(('.gz', '.tmp')):
+                    continue
+                if FINGERPRINTED.search(filename):
+                    # Referenced by their name from other assets
+                    target = path
+                else:
+                    target = os.path.join(root, fingerprint(path))
+                    if not os.path.exists(target):
+                        shutil.copy2(path, target)
+                    manifest[name] = \
+                        os.path.relpath(target, www).replace(os.sep, '/')
+                if filename.lower().endswith(COMPRESSIBLE):
+                    precompress(target)
+    temp_path = os.path.join(www, MANIFEST + '.tmp')
+    with open(temp_path, 'wb') as fp:
+        simplejson.dump(manifest, fp, indent=2, sort_keys=True)
+    os.rename(temp_path, os.path.join(www, MANIFEST))
+    return manifest
+
+
+@cached
+def get_asset_manifest():
+    """ Returns the manifest of fingerprinted assets; empty if not built """
+
+    path = os.path.join(get_packages().abspath(WWW), MANIFEST)
+    try:
+        with open(path, 'rb') as fp:
+            return simplejson.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def asset(name):
+    """
+    Returns the path of an asset relative to the ``www`` directory, under
+    its fingerprinted name if it has one. Available in templates.
+    """
+
+    return get_asset_manifest().get(name, name)
+
+
+def asset_response(req, filename, body, gzipped=None):
+    """
+    Returns the response serving an asset.
+
+    :param body: The content of the asset
+    :param gzipped: The content of its ``.gz`` variant, if any
+    """
+
+    content_type, _ = mimetypes.guess_type(filename)
+    response = Response(
+        content_type=content_type or 'application/octet-stream',
+        conditional_response=True,
+    )
+    if gzipped is not None:
+        response.vary = ('Accept-Encoding',)
+        if 'gzip' in req.accept_encoding:
+            body = gzipped
+            response.content_encoding = 'gzip'
+    response.body = body
+    if FINGERPRINTED.search(filename):
+        response.cache_control = IMMUTABLE
+    else:
+        response.cache_control = REVALIDATE
+        response.md5_etag()
+    return response
+
+
+def serve_asset(req, path):
+    """ Serves the asset at the package path ``path`` """
+
+    path = get_packages().abspath(path)
+    with open(path, 'rb') as fp:
+        body = fp.read()
+    gzipped = None
+    if os.path.exists(path + '.gz'):
+        with open(path + '.gz', 'rb') as fp:
+            gzipped = fp.read()
+    return asset_response(req, os.path.basename(path), body, gzipped)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='rios-converter-assets',
+        description="Fingerprint and precompress the static assets of the"
+                    " RIOS converter after the bundle is built.",
+    )
+    parser.add_argument(
+        'www',
+        nargs='?',
+        default=os.path.join('static', 'www'),
+        help="the www directory of the static files (default: %(default)s)",
+    )
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if not os.path.isdir(args.www):
+        sys.stderr.write("%s: not a directory\n" % (args.www,))
+        return 1
+    manifest = build_assets(args.www)
+    for name in sorted(manifest):
+        print "%s -> %s" % (name, manifest[name])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,297 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Command-line tool that runs the conversion pipeline of the web application
+over files and directories, e.g.::
+
+    $ rios-converter-batch to-rios -o out/ dictionaries/ 'exports/*.qsf'
+    $ rios-converter-batch from-rios --system redcap -o out/ out/
+"""
+
+
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+
+
+from .engine import LOG_NAME, run_from_rios, run_to_rios, write_to_buffer
+
+
+__all__ = (
+    'main',
+)
+
+
+# System of an input file converted to RIOS, by extension
+TO_RIOS_EXTENSIONS = {
+    '.csv': 'redcap',
+    '.qsf': 'qualtrics',
+}
+
+RIOS_EXTENSIONS = ('.yaml', '.json')
+
+
+def find_inputs(patterns, extensions):
+    """
+    Expands directories and glob patterns into a sorted list of input files
+    with one of the given extensions.
+    """
+
+    found = set()
+    for pattern in patterns:
+        paths = [pattern] if os.path.exists(pattern) else glob.glob(pattern)
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, filenames in os.walk(path):
+                    for filename in filenames:
+                        found.add(os.path.join(root, filename))
+            else:
+                found.add(path)
+    return sorted(
+        path
+        for path in found
+        if os.path.splitext(path)[1].lower() in extensions
+    )
+
+
+def to_rios_tasks(args):
+    for path in find_inputs(args.inputs, TO_RIOS_EXTENSIONS):
+        outname = os.path.splitext(os.path.basename(path))[0]
+        system = (
+            args.system or
+            TO_RIOS_EXTENSIONS[os.path.splitext(path)[1].lower()]
+        )
+        yield {
+            'direction': 'to-rios',
+            'inputs': [path],
+            'outname': outname,
+            'output': os.path.join(
+                args.output, outname + '_i.' + args.format),
+            'system': system,
+            'format': args.format,
+            'compact': args.compact,
+            'title': args.title or outname,
+            'id': args.id or re.sub(r'[^a-z0-9]+', '_', outname.lower()),
+        }
+
+
+def from_rios_tasks(args):
+    for path in find_inputs(args.inputs, RIOS_EXTENSIONS):
+        base, extension = os.path.splitext(path)
+        if not base.endswith('_i'):
+            continue
+        base = base[:-len('_i')]
+        form = base + '_f' + extension
+        calculationset = base + '_c' + extension
+        outname = os.path.basename(base)
+        yield {
+            'direction': 'from-rios',
+            'inputs': [
+                path,
+                form,
+                calculationset if os.path.exists(calculationset) else None,
+            ],
+            'outname': outname,
+            'output': os.path.join(
+                args.output,
+                outname + ('.csv' if args.system == 'redcap' else '.txt')
+            ),
+            'system': args.system,
+            'format': extension[1:].lower(),
+        }
+
+
+def write_members(directory, outname, members):
+    """
+    Writes the output files of a conversion. The first file, which tells
+    whether an input was converted, is put in place last. The conversion
+    log is named after ``outname``, since inputs share the directory.
+    """
+
+    written = 0
+    for name, payload, data_type, kwargs in members[1:] + members[:1]:
+        if name == LOG_NAME:
+            name = outname + '_' + LOG_NAME
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.')
+        with os.fdopen(fd, 'wb') as fp:
+            write_to_buffer(fp, payload, data_type, **kwargs)
+            fp.seek(0, os.SEEK_END)
+            written += fp.tell()
+        os.rename(temp_path, os.path.join(directory, name))
+    return written
+
+
+def convert(task):
+    """
+    Converts a single input in a worker process.
+
+    :returns:
+        A tuple of the input path, whether it was converted, the error
+        messages, and the number of bytes read and written
+    """
+
+    start = time.time()
+    streams = []
+    try:
+        for path in task['inputs']:
+            streams.append(open(path, 'rb') if path else None)
+        size = sum(os.fstat(stream.fileno()).st_size
+                   for stream in streams if stream)
+        if task['direction'] == 'to-rios':
+            outcome = run_to_rios(
+                task['system'],
+                streams[0],
+                task['outname'],
+                format=task['format'],
+                instrument_title=task['title'],
+                instrument_id=task['id'],
+                compact=task['compact'],
+            )
+        else:
+            outcome = run_from_rios(
+                task['system'],
+                task['format'],
+                streams,
+                task['outname'],
+            )
+    except EnvironmentError as exc:
+        # E.g. a RIOS instrument without its form
+        return task['inputs'][0], False, [
+            "Unable to read %s: %s" % (exc.filename, exc.strerror),
+        ], 0, 0, 0
+    except Exception as exc:
+        return task['inputs'][0], False, [repr(exc)], 0, 0, 0
+    finally:
+        for stream in streams:
+            if stream:
+                stream.close()
+
+    directory = os.path.dirname(task['output'])
+    error_path = os.path.join(directory, task['outname'] + '.errors.txt')
+    if outcome.stage is not None:
+        with open(error_path, 'wb') as fp:
+            fp.write('\n\n'.join(outcome.errors))
+        return task['inputs'][0], False, outcome.errors, size, 0, \
+            time.time() - start
+    written = write_members(directory, task['outname'], outcome.members)
+    if os.path.exists(error_path):
+        os.remove(error_path)
+    return task['inputs'][0], True, [], size, written, time.time() - start
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='rios-converter-batch',
+        description="Convert instrument files in bulk with the RIOS"
+                    " converter pipeline.",
+    )
+    subparsers = parser.add_subparsers(dest='direction')
+
+    to_rios = subparsers.add_parser(
+        'to-rios',
+        help="convert REDCap (*.csv) and Qualtrics (*.qsf) files to RIOS",
+    )
+    to_rios.add_argument(
+        '--system', choices=['redcap', 'qualtrics'],
+        help="system of all inputs (default: by file extension)")
+    to_rios.add_argument(
+        '--format', choices=['yaml', 'json'], default='yaml',
+        help="output format (default: yaml)")
+    to_rios.add_argument(
+        '--compact', action='store_true',
+        help="write output without indentation or key sorting")
+    to_rios.add_argument(
+        '--title', help="REDCap instrument title (default: file name)")
+    to_rios.add_argument(
+        '--id', help="REDCap instrument ID (default: file name)")
+
+    from_rios = subparsers.add_parser(
+        'from-rios',
+        help="convert RIOS *_i, *_f and *_c files to another system",
+    )
+    from_rios.add_argument(
+        '--system', choices=['redcap', 'qualtrics'], required=True,
+        help="system to convert to")
+
+    for subparser in (to_rios, from_rios):
+        subparser.add_argument(
+            'inputs', nargs='+', metavar='INPUT',
+            help="input file, directory or glob pattern")
+        subparser.add_argument(
+            '-o', '--output', required=True,
+            help="output directory")
+        subparser.add_argument(
+            '-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+            help="number of worker processes (default: number of CPUs)")
+        subparser.add_argument(
+            '--force', action='store_true',
+            help="convert inputs again even if their output exists")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    if args.direction == 'to-rios':
+        tasks = list(to_rios_tasks(args))
+    else:
+        tasks = list(from_rios_tasks(args))
+    pending = [
+        task for task in tasks
+        if args.force or not os.path.exists(task['output'])
+    ]
+    skipped = len(tasks) - len(pending)
+
+    start = time.time()
+    converted = failed = size_in = size_out = 0
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    try:
+        if pool is not None:
+            results = pool.imap_unordered(convert, pending)
+        else:
+            results = (convert(task) for task in pending)
+        for path, success, errors, read, written, _ in results:
+            size_in += read
+            size_out += written
+            if success:
+                converted += 1
+            else:
+                failed += 1
+                sys.stderr.write("%s: failed\n  %s\n" % (
+                    path, "\n  ".join(
+                        line
+                        for error in errors
+                        for line in error.splitlines()
+                    )))
+    except KeyboardInterrupt:
+        if pool is not None:
+            pool.terminate()
+        sys.stderr.write("Interrupted; run again to resume\n")
+        return 130
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = max(time.time() - start, 1e-6)
+
+    print "Converted: %d, skipped: %d, failed: %d" % (
+        converted, skipped, failed)
+    print "Read %.1f MB, wrote %.1f MB in %.1f s" % (
+        size_in / 1e6, size_out / 1e6, elapsed)
+    print "Throughput: %.1f files/s, %.2f MB/s" % (
+        (converted + failed) / elapsed, size_in / 1e6 / elapsed)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Compression of output archive members.
+
+Members smaller than ``STORE_SIZE`` bytes are stored, since deflating them
+saves less than the overhead of a deflate stream, and so is any member
+deflate doesn't shrink. The
+others are deflated at the highest level whose estimated time for all of
+them fits the ``archive_compression_budget``. The estimates are fixed
+per-level rates rather than measurements, and don't count on
+``compression_threads``, so the same conversion always produces the same
+archive, and ETag, whatever the deployment.
+
+Members are deflated in pieces of ``PIECE_SIZE`` bytes, the way pigz does:
+every piece but the last ends with a sync flush, so the pieces concatenate
+into a single deflate stream. With ``compression_threads``, the pieces of
+all the members are deflated by a thread pool, as zlib releases the GIL
+while it compresses. The pieces, hence the output, are the same with or
+without the pool.
+"""
+
+
+import zlib
+
+
+from rex.core import cached, get_settings
+
+
+__all__ = (
+    'CompressionPolicy',
+    'compress_members',
+    'deflate',
+    'get_compression_policy',
+    'get_compression_pool',
+)
+
+
+# Members are stored below this size
+STORE_SIZE = 1 << 7
+
+# Size of the pieces members are deflated in
+PIECE_SIZE = 1 << 20
+
+# Conservative deflate rates in bytes per second by level, best level first;
+# ``benchmarks/bench_compression.py`` measures them on synthetic definitions
+DEFLATE_RATES = (
+    (9, 20e6),
+    (6, 60e6),
+    (3, 150e6),
+    (1, 200e6),
+)
+
+# Level of members whose size isn't known in advance, i.e. streamed CSV
+STREAM_LEVEL = 6
+
+
+class CompressionPolicy(object):
+    """
+    Chooses how the members of an archive are compressed.
+
+    :param budget:
+        Seconds that deflating all the members of an archive should take
+    """
+
+    def __init__(self, budget=0.5):
+        self.budget = budget
+
+    def level(self, size):
+        """
+        Returns the deflate level for members of ``size`` bytes in total,
+        or ``STREAM_LEVEL`` if the size is None.
+        """
+
+        if size is None:
+            return STREAM_LEVEL
+        # Estimated serially, so the pool doesn't change the output
+        for level, rate in DEFLATE_RATES:
+            if size <= self.budget * rate:
+                return level
+        return DEFLATE_RATES[-1][0]
+
+    def stored(self, content):
+        return len(content) < STORE_SIZE
+
+
+def deflate_piece(piece):
+    content, start, level = piece
+    data = buffer(content, start, PIECE_SIZE)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    last = start + PIECE_SIZE >= len(content)
+    return compressor.compress(data) + \
+        compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def pieces(content, level):
+    return [
+        (content, start, level)
+        for start in range(0, max(len(content), 1), PIECE_SIZE)
+    ]
+
+
+def deflate(content, level, pool=None):
+    """ Returns the raw deflate stream of ``content``, see the module """
+
+    return ''.join(map_pieces(pieces(content, level), pool))
+
+
+def map_pieces(items, pool):
+    if pool is not None and len(items) > 1:
+        return pool.map(deflate_piece, items)
+    return map(deflate_piece, items)
+
+
+def compress_members(contents, policy=None, pool=None):
+    """
+    Deflates the contents of archive members as the policy has it.
+
+    :param contents: The serialized members
+    :type contents: list of str
+    :param policy: A :class:`CompressionPolicy`, or the default policy
+    :param pool: A thread pool deflating the pieces, if any
+    :returns:
+        The level used, and the raw deflate stream of each member or None
+        if it is to be stored
+    :rtype: tuple
+    """
+
+    policy = policy or CompressionPolicy()
+    deflated = [
+        idx for idx, content in enumerate(contents)
+        if not policy.stored(content)
+    ]
+    level = policy.level(sum(len(contents[idx]) for idx in deflated))
+    items = []
+    owners = []
+    for idx in deflated:
+        member_pieces = pieces(contents[idx], level)
+        items.extend(member_pieces)
+        owners.extend([idx] * len(member_pieces))
+    streams = dict((idx, []) for idx in deflated)
+    for idx, data in zip(owners, map_pieces(items, pool)):
+        streams[idx].append(data)
+    results = []
+    for idx, content in enumerate(contents):
+        stream = ''.join(streams[idx]) if idx in streams else None
+        if stream is not None and len(stream) >= len(content):
+            # Deflate doesn't pay off
+            stream = None
+        results.append(stream)
+    return level, results
+
+
+@cached
+def get_compression_policy():
+    """ Returns the application's :class:`CompressionPolicy` """
+
+    settings = get_settings()
+    return CompressionPolicy(budget=settings.archive_compression_budget)
+
+
+@cached
+def get_compression_pool():
+    """
+    Returns the thread pool deflating archive members, or None if
+    ``compression_threads`` is 0.
+    """
+
+    from multiprocessing.pool import ThreadPool
+    threads = get_settings().compression_threads
+    if not threads:
+        return None
+    return ThreadPool(threads)
@@ -4,24 +4,23 @@
 
 
 import datetime
-import docutils.core
 import os
 import cStringIO
 import shutil
-import zipfile as ZIPFILE
-import simplejson
 import collections
-import csv
-import yaml
 import cgi
+import gzip
 import mimetypes
 
 
 from cached_property import cached_property
 from webob import Response
 from webob.static import FileIter, BLOCK_SIZE
-from webob.exc import HTTPMethodNotAllowed
+from webob.exc import HTTPMethodNotAllowed, HTTPNotFound, HTTPNoContent
 from rex.core import (
+    BoolVal,
+    IntVal,
+    MaybeVal,
     StrVal,
     Error,
     Validate,
@@ -35,28 +34,58 @@ from rex.web import (
     HandleLocation,
     Parameter,
     render_to_response,
+    url_for,
 )
-from rios.core import (
-    ValidationError,
-    validate_instrument,
-    validate_form,
-    validate_calculationset,
+from .admission import client_key, get_admission
+from .assets import serve_asset
+from .compression import get_compression_policy, get_compression_pool
+from .engine import (
+    FROM_RIOS_CONVERTERS,
+    build_archive,
+    build_csv,
+    build_tar,
+    from_rios_members,
+    from_rios_params,
+    iter_member,
+    load_converter,
+    output_formats,
+    result_failure,
+    to_rios_converter,
+    to_rios_members,
+    to_rios_params,
 )
-from rios.conversion import (
-    redcap_to_rios,
-    qualtrics_to_rios,
-    rios_to_redcap,
-    rios_to_qualtrics,
+from .health import get_latency_monitor, readiness
+from .ingest import IngestedFile, ingest
+from .incremental import (
+    convert_incremental,
+    load_previous_session,
+    load_previous_upload,
 )
-from rios.conversion.base import (
-    DEFAULT_LOCALIZATION,
-    DEFAULT_VERSION,
+from .parallel import get_conversion_pool
+from .reports import REPORT_NAME, SUMMARY_NAME, StoredReport
+from .results import (
+    file_digest,
+    get_conversion_cache,
+    get_result_store,
+    on_disk,
+    request_digest,
 )
-from rios.conversion.utils import CsvReader
-from .csv_validation import (
-    RedcapLegacyCsvValidator,
-    RedcapModernCsvValidator,
-    StringLoader,
+from .scratch import get_scratch_space, hand_off
+from .serialization import dump_json
+from .sniff import route_upload
+from .tracing import (
+    TRACE_ID_PATTERN,
+    annotate,
+    current_trace_id,
+    span,
+    traced,
+)
+from .uploads import CHUNK_SIZE, get_upload_store
+from .validation import (
+    check_upload,
+    get_validation_memo,
+    get_validation_pool,
+    load_and_validate_rios,
 )
 
 
@@ -66,124 +95,44 @@ def log(session, filename, content):
     log_dir = os.path.join(get_settings().log_dir, session)
     if not os.path.isdir(log_dir):
         os.makedirs(log_dir)
-    with open(os.path.join(log_dir, filename), 'wb') as fp:
-        if hasattr(content, 'read'):
-            fp.write(content.read())
+    with span('log', filename=filename) as logging:
+        path = os.path.join(log_dir, filename)
+        source = on_disk(content)
+        if source is not None:
+            # Scratch files are linked rather than copied
+            hand_off(source, path)
         else:
-            fp.write(content)
+            with open(path, 'wb') as fp:
+                if hasattr(content, 'read'):
+                    shutil.copyfileobj(content, fp, BLOCK_SIZE)
+                else:
+                    fp.write(content)
+        logging.set(bytes=os.path.getsize(path))
     if hasattr(content, 'seek'):
         # Rewind file object
         content.seek(0)
 
 
 def log_file(session, filepath):
-    """ Copy uploaded instrument files to the log_dir directory """
+    """ Link or copy uploaded instrument files to the log_dir directory """
 
     log_dir = os.path.join(get_settings().log_dir, session)
     if not os.path.isdir(log_dir):
         os.makedirs(log_dir)
-    shutil.copy(filepath, log_dir)
-
-
-def write_to_buffer(file_object, payload, data_type=None, *args, **kwargs):
-    """
-    Writes stuctured data to a file object of the corresponding data type. The
-    ``args`` and ``kwargs`` are passed to the underlying loader_type instance.
-    If ``data_type`` is not specified or the function can't handle writing the
-    data type of payload, the payload is written as a text file.
-
-    If payload is a dict to be written to a CSV, a dict with a key of name
-    ``fieldnames`` and value of type list containing separate field names must
-    be passed via ``kwargs`` to enable writing the payload to a CSV with
-    :class:csv.DictWriter. The payload will be written to a text file if the
-    field names list is not passed in.
-
-    All file objects will be rewound with ``file_object.seek(0)`` after a
-    checked for a ``seek`` attribute is successful.
-
-    :param data_type:
-        The type of structured data payload will be written too. If None, the
-        payload will be written to a text file.
-    :type data_type: str of value 'json', 'yaml', or 'csv' or None
-    :param file_object: File object to write too.
-    :type file_object: file or buffer/stream
-    :param payload: Structured dataset.
-    :type payload: dict, list, or str
-    """
-
-    if data_type == 'json':
-        simplejson.dump(
-            payload,
-            file_object,
-            sort_keys=True,
-            indent='    ',
-            *args,
-            **kwargs
-        )
-    elif data_type == 'yaml':
-        yaml.dump(
-            payload,
-            file_object,
-            default_flow_style=False,
-            *args,
-            **kwargs
-        )
-    elif data_type == 'csv':
-        if isinstance(payload, list):
-            # Payload must contain one CSV line per list item
-            csv_writer = csv.writer(
-                file_object,
-                delimiter=',',
-                quotechar='\"',
-                quoting=csv.QUOTE_MINIMAL,
-                *args,
-                **kwargs
-            )
-            csv_writer.writerows(payload[0])
-        elif isinstance(payload, dict) and 'fieldnames' in kwargs:
-            fieldnames = kwargs['fieldnames']
-            csv_writer = csv.DictWriter(
-                file_object,
-                fieldnames=fieldnames,
-                delimeter=',',
-                quotechar='\"',
-                quoting=csv.QUOTE_MINIMAL,
-                *args,
-                **kwargs
-            )
-    else:  # Load data to text file
-        if isinstance(payload, list):
-            for record in payload:
-                file_object.write(
-                    record if isinstance(record, str) else repr(record)
-                )
-        else:
-            file_object.write(
-                str(payload) if isinstance(payload, str) else repr(payload)
-            )
-
-    # Rewind ALL THE THINGS! (files)
-    if hasattr(file_object, 'seek'):
-        file_object.seek(0)
+    hand_off(filepath, os.path.join(log_dir, os.path.basename(filepath)))
 
 
-def write_to_zip(zipfile, name, payload, format, *args, **kwargs):
+def log_report(session, report):
     """
-    Writes the specified container to a zipfile.
+    Logs the validation report of a session; returns its summary.
 
-    The ``args`` and ``kwargs`` are passed to the underlying function call. See
-    :function:write_to_buffer for more details.
+    The summary is logged last, as it tells whether the report is complete.
     """
 
-    container = cStringIO.StringIO()
-    write_to_buffer(
-        data_type=str(format),
-        file_object=container,
-        payload=payload,
-        *args,
-        **kwargs
-    )
-    zipfile.writestr(name, container.read())
+    content, summary = report.dump()
+    log(session, REPORT_NAME, content)
+    log(session, SUMMARY_NAME, dump_json(summary))
+    return summary
 
 
 class AttachmentMaybeVal(Validate):
@@ -197,6 +146,8 @@ class AttachmentMaybeVal(Validate):
     Attachment = collections.namedtuple('Attachment', 'name content')
 
     def __call__(self, data):
+        if isinstance(data, IngestedFile):
+            return self.Attachment(data.filename, data.file)
         if (isinstance(data, cgi.FieldStorage) and
                 data.filename is not None and data.file is not None):
             bffr = (
@@ -230,6 +181,8 @@ class AttachmentVal(Validate):
     Attachment = collections.namedtuple('Attachment', 'name content')
 
     def __call__(self, data):
+        if isinstance(data, IngestedFile):
+            return self.Attachment(data.filename, data.file)
         if (isinstance(data, cgi.FieldStorage) and
                 data.filename is not None and data.file is not None):
             bffr = (
@@ -254,37 +207,188 @@ class BufferedFileApp(object):
     """
     Like `webob.static.FileApp`, but takes an open file object instead.
 
+    The ETag is the SHA-1 digest of the content unless given. Pass the
+    ``last_modified`` time of a retained result so that it is stable across
+    requests; ``location`` is the URL the result can be fetched from again,
+    which is where range requests are honored.
+
     Forked from rex.attach 2.0.4 and modified.
     """
 
-    def __init__(self, bffr, filename):
+    def __init__(self, bffr, filename, etag=None, last_modified=None,
+                 location=None):
         self.file = bffr
         self.filename = filename
+        self.etag = etag
+        self.last_modified = last_modified
+        self.location = location
 
     def __call__(self, req):
         # Adapted from `FileApp.__call__()`.
-        if 'wsgi.file_wrapper' in req.environ:
-            app_iter = req.environ['wsgi.file_wrapper'](self.file, BLOCK_SIZE)
-        else:
-            app_iter = FileIter(self.file)
-        last_modified = datetime.datetime.now()
+        etag = self.etag
+        if etag is None:
+            etag = file_digest(self.file)
         # Need to seek to end of cStringIO.StringIO buffer to get size.
         self.file.seek(0, os.SEEK_END)
         content_length = self.file.tell()
         # Remember to seek back to the beginning before the buffer is sent!
         self.file.seek(0)
+        if 'wsgi.file_wrapper' in req.environ:
+            app_iter = req.environ['wsgi.file_wrapper'](self.file, BLOCK_SIZE)
+        else:
+            app_iter = FileIter(self.file)
+        last_modified = self.last_modified or datetime.datetime.now()
         content_type, content_encoding = mimetypes.guess_type(self.filename)
         content_disposition = "attachment; filename=%s" % self.filename
-        accept_ranges = 'bytes'
-        return Response(
+        response = Response(
                 app_iter=app_iter,
+                etag=etag,
                 last_modified=last_modified,
                 content_length=content_length,
                 content_type=content_type,
                 content_encoding=content_encoding,
                 content_disposition=content_disposition,
-                accept_ranges=accept_ranges,
                 conditional_response=True)
+        if self.location:
+            response.content_location = self.location
+            response.accept_ranges = 'bytes'
+        return response
+
+
+def upload_size(*uploads):
+    """ Returns the total size of the uploaded file objects in bytes """
+
+    size = 0
+    for upload in uploads:
+        if upload is None:
+            continue
+        upload.seek(0, os.SEEK_END)
+        size += upload.tell()
+        upload.seek(0)
+    return size
+
+
+# JSON responses are only compressed from this size up
+GZIP_MIN_SIZE = 1 << 10
+
+# Compression level of JSON responses; higher levels cost more CPU for
+# little gain on JSON
+GZIP_LEVEL = 6
+
+# Version of the JSON conversion API, see `ConvertToRiosJsonApi`
+API_VERSION = 1
+
+# Validation reports hold rows of an upload, so they aren't kept in caches
+REPORT_CACHE_CONTROL = 'private, no-store'
+
+
+def gzip_body(body):
+    """ Compresses a response body with gzip """
+
+    bffr = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=bffr, mode='wb', compresslevel=GZIP_LEVEL,
+                       mtime=0) as fp:
+        fp.write(body)
+    return bffr.getvalue()
+
+
+def render_json(payload, status=200, req=None):
+    """
+    Returns a compact JSON response. Given the request, the body is
+    gzip-encoded if the client accepts it.
+    """
+
+    body = dump_json(payload, compact=True)
+    response = Response(content_type='application/json', status=status)
+    if req is not None:
+        response.vary = ('Accept-Encoding',)
+        if len(body) >= GZIP_MIN_SIZE and 'gzip' in req.accept_encoding:
+            body = gzip_body(body)
+            response.content_encoding = 'gzip'
+    response.body = body
+    return response
+
+
+def upload_errors(system, errors, report):
+    """
+    Returns the JSON API errors of an uploaded file that fails validation,
+    see :func:`check_upload`: one per failing line and column of the
+    ``report`` of a data dictionary, with the validator that failed, if
+    there is one, otherwise the error log.
+    """
+
+    if report is None:
+        return [{'source': system, 'message': errors}]
+    return [
+        {
+            'source': system,
+            'line': line,
+            'column': column,
+            'validator': validator,
+            'message': message,
+        }
+        for line, column, validator, message in report.failures
+    ]
+
+
+def render_api_report(req, system, errors=(), documents=None, logs=()):
+    """
+    Returns the JSON API response of a conversion.
+
+    :param errors:
+        (source, message) pairs, or errors with more fields such as those of
+        :func:`upload_errors`; the status is 400 if the source is an
+        uploaded file or the parameters, otherwise 422
+    :param documents: The converted documents, by name
+    """
+
+    errors = [
+        error if isinstance(error, dict)
+        else {'source': error[0], 'message': error[1]}
+        for error in errors
+    ]
+    if documents is not None:
+        status, code = 'converted', 200
+    elif any(error['source'] != 'conversion' for error in errors):
+        status, code = 'invalid', 400
+    else:
+        status, code = 'failed', 422
+    report = {
+        'version': API_VERSION,
+        'status': status,
+        'system': system,
+        'documents': documents,
+        'logs': list(logs),
+        'errors': errors,
+    }
+    return render_json(report, status=code, req=req)
+
+
+def serve_result(req, result):
+    """ Serves a :class:`StoredResult` from the result store """
+
+    location = "%s?id=%s" % (
+        url_for(req, 'rios.converter:/convert/result'),
+        result.etag,
+    )
+    gzipped = result.filename.endswith('.tar') and \
+        'gzip' in req.accept_encoding
+    if gzipped:
+        # Tar archives aren't compressed, so they are sent gzip-encoded
+        result = get_result_store().gzipped(result)
+    app = BufferedFileApp(
+        get_result_store().open(result),
+        result.filename,
+        etag=result.etag,
+        last_modified=result.last_modified,
+        location=location,
+    )
+    response = app(req)
+    if result.filename.endswith('.tar'):
+        response.vary = ('Accept-Encoding',)
+        if gzipped:
+            response.content_encoding = 'gzip'
+    return response
 
 
 class Home(Command):
@@ -314,6 +418,7 @@ class ConvertDocumentationSource(Command):
     template = 'rios.converter:/templates/convert.rst'
 
     def render(self, req):
+        import docutils.core
         response = render_to_response(self.template, req, status=200)
         html_output = docutils.core.publish_string(
             response.body,
@@ -342,24 +447,110 @@ class ConvertToRiosWebForm(Command):
         return render_to_response(self.template, req, status=200)
 
 
+class ConvertResultServe(Command):
+
+    path = '/convert/result'
+    access = 'anybody'
+    parameters = [
+        Parameter('id', StrVal(r'^[0-9a-f]{40}$')),
+    ]
+
+    def render(self, req, id):
+        # Allow only GET and HEAD requests.
+        if req.method not in ('GET', 'HEAD',):
+            raise HTTPMethodNotAllowed()
+
+        result = get_result_store().get(id)
+        if result is None:
+            raise HTTPNotFound()
+        return serve_result(req, result)
+
+
+class ValidationReportServe(Command):
+
+    path = '/convert/report'
+    access = 'anybody'
+    parameters = [
+        Parameter('session', StrVal(TRACE_ID_PATTERN)),
+        Parameter('page', IntVal(min_bound=1), default=1),
+    ]
+
+    template = 'rios.converter:/templates/validation_report.html'
+
+    def render(self, req, session, page):
+        # Allow only GET and HEAD requests.
+        if req.method not in ('GET', 'HEAD',):
+            raise HTTPMethodNotAllowed()
+
+        report = StoredReport.load(
+            os.path.join(get_settings().log_dir, session))
+        failures = report.page(page) if report is not None else None
+        if failures is None:
+            raise HTTPNotFound()
+        response = render_to_response(
+            self.template,
+            req,
+            session=session,
+            page=page,
+            pages=report.pages,
+            report=report.summary,
+            failures=failures,
+        )
+        response.cache_control = REPORT_CACHE_CONTROL
+        return response
+
+
+class ValidationReportDownload(Command):
+
+    path = '/convert/report/csv'
+    access = 'anybody'
+    parameters = [
+        Parameter('session', StrVal(TRACE_ID_PATTERN)),
+    ]
+
+    def render(self, req, session):
+        # Allow only GET and HEAD requests.
+        if req.method not in ('GET', 'HEAD',):
+            raise HTTPMethodNotAllowed()
+
+        report = StoredReport.load(
+            os.path.join(get_settings().log_dir, session))
+        if report is None:
+            raise HTTPNotFound()
+        # Streamed from the session log
+        app = BufferedFileApp(
+            report.open(),
+            REPORT_NAME,
+            last_modified=datetime.datetime.fromtimestamp(
+                os.path.getmtime(report.report_path)),
+        )
+        response = app(req)
+        response.cache_control = REPORT_CACHE_CONTROL
+        return response
+
+
 class ConvertToRiosProcessorApi(Command):
 
     path = '/convert/to/rios'
     access = 'anybody'
     parameters = [
-        Parameter('system', StrVal(r'(qualtrics)|(redcap)'), ),
-        Parameter('format', StrVal(r'(yaml)|(json)')),
+        Parameter('system', MaybeVal(StrVal(r'(qualtrics)|(redcap)')),
+                  default=None),
+        Parameter('format', StrVal(r'(yaml|json)(,(yaml|json))*')),
         Parameter('instrument_title', StrVal(r'^[a-zA-Z0-9_\s]*$')),
         Parameter('instrument_id', StrVal(r'([a-z0-9]{3}[a-z0-9]*)?')),
         Parameter('outname', StrVal(r'^[a-zA-Z0-9_]+$')),
         Parameter('infile', AttachmentVal()),
+        Parameter('compact', BoolVal(), default=False),
+        Parameter('archive', StrVal(r'(zip)|(tar)'), default='zip'),
+        Parameter('previous_session', MaybeVal(StrVal(TRACE_ID_PATTERN)),
+                  default=None),
+        Parameter('previous_infile', AttachmentMaybeVal(), default=None),
+        Parameter('previous_instrument_file', AttachmentMaybeVal(),
+                  default=None),
+        Parameter('previous_form_file', AttachmentMaybeVal(), default=None),
     ]
 
-    converters = {
-        'qualtrics': qualtrics_to_rios,
-        'redcap': redcap_to_rios,
-        }
-
     convert_fail_template = \
         'rios.converter:/templates/convert_fail.html'
     form_params_fail_template = \
@@ -367,209 +558,410 @@ class ConvertToRiosProcessorApi(Command):
     validation_fail_template = \
         'rios.converter:/templates/validation_fail.html'
 
-    validator = None
-
     @cached_property
     def settings(self):
         return get_settings()
 
+    def __call__(self, req):
+        # Uploads are hashed, sniffed and spooled as the body is received
+        with ingest(req):
+            return super(ConvertToRiosProcessorApi, self).__call__(req)
+
+    @traced('convert.to_rios')
     def render(self, req, system, format, instrument_title,
-                                        instrument_id, outname, infile):
+                                instrument_id, outname, infile, compact,
+                                archive, previous_session, previous_infile,
+                                previous_instrument_file, previous_form_file):
 
         # Allow only GET and HEAD requests.
         if req.method not in ('POST',):
             raise HTTPMethodNotAllowed()
 
+        return self.process(req, system, format, instrument_title,
+                            instrument_id, outname, infile.content, compact,
+                            previous_session, previous_infile,
+                            previous_instrument_file, previous_form_file,
+                            archive=archive)
+
+    def process(self, req, system, format, instrument_title, instrument_id,
+                            outname, upload_file, compact, previous_session,
+                            previous_infile, previous_instrument_file,
+                            previous_form_file, archive='zip'):
+
+        # Detect the system from the start of the upload, or check that the
+        # upload matches it, before the upload is parsed
+        try:
+            system = route_upload(system, upload_file)
+        except Error as exc:
+            return render_to_response(
+                self.validation_fail_template,
+                req,
+                errors=str(exc),
+                system=system,
+            )
+        annotate(
+            system=system,
+            format=format,
+            bytes=upload_size(upload_file),
+            rows=getattr(upload_file, 'rows', None),
+        )
+
         # Construct proper instrument ID
         if 'urn:' not in instrument_id:
             instrument_id = 'urn:%s' % (instrument_id,)
         # Check for required redcap paramters
+        initialization_errors = []
         if system == 'redcap':
-            initialization_errors = []
             if not instrument_id:
                 initialization_errors.append('Instrument ID is required')
             if not instrument_title:
                 initialization_errors.append('Instrument Title is required')
-            if len(initialization_errors) > 0:
-                return render_to_response(
-                    self.form_params_fail_template,
-                    req,
-                    errors=initialization_errors,
+        # Check the parameters of an incremental conversion
+        previous_files = (
+            previous_infile,
+            previous_instrument_file,
+            previous_form_file,
+        )
+        if previous_session or any(previous_files):
+            if system != 'redcap':
+                initialization_errors.append(
+                    'Incremental conversion requires a REDCap data'
+                    ' dictionary'
+                )
+            if previous_session and any(previous_files):
+                initialization_errors.append(
+                    'Either a previous session or previous files are'
+                    ' required, not both'
+                )
+            elif not previous_session and not all(previous_files):
+                initialization_errors.append(
+                    'The previous data dictionary, instrument and form'
+                    ' are all required'
                 )
+        if len(initialization_errors) > 0:
+            return render_to_response(
+                self.form_params_fail_template,
+                req,
+                errors=initialization_errors,
+            )
 
         # Validate file with props.csvtoolkit validator API
-        upload_file = infile.content
         upload_file.seek(0)
 
+        # Serve a previously produced archive for the same inputs, which
+        # include the previous conversion of an incremental conversion
+        format = ','.join(output_formats(format))
+        previous_parts = []
+        if previous_session or any(previous_files):
+            previous_parts = [previous_session] + [
+                attachment.content if attachment is not None else None
+                for attachment in previous_files
+            ]
+        result_key = request_digest(
+            'to_rios',
+            system,
+            format,
+            instrument_title,
+            instrument_id,
+            outname,
+            compact,
+            archive,
+            upload_file,
+            *previous_parts
+        )
+        stored = get_result_store().lookup(result_key)
+        if stored is not None:
+            annotate(cached=True)
+            return serve_result(req, stored)
+
+        # Serialize the same conversion done for another format; a full
+        # conversion is a valid output of an incremental one
+        conversion_key = request_digest(
+            'to_rios',
+            system,
+            instrument_title,
+            instrument_id,
+            upload_file,
+        )
+        found, result = get_conversion_cache().get(conversion_key)
+        if found:
+            annotate(reused=True)
+            session = current_trace_id()
+            log(session, '%s_to_rios' % (system,), '')
+            # So that the session can be a previous conversion too
+            upload_file.seek(0)
+            log(session, 'uploaded_file_contents.log', upload_file)
+            with get_scratch_space().request() as scratch:
+                return self.respond(req, session, result, outname, format,
+                                    compact, archive, result_key, scratch)
+
+        # Wait for a free conversion slot
+        with get_latency_monitor().measure(), \
+                get_admission().admit(upload_size(upload_file),
+                                      client_key(req)), \
+                get_scratch_space().request() as scratch:
+            return self.convert(req, system, format, instrument_title,
+                                instrument_id, outname, upload_file,
+                                compact, result_key, previous_session,
+                                previous_files, scratch, archive,
+                                conversion_key)
+
+    def load_previous(self, previous_session, previous_files):
+        """ Loads the previous conversion of an incremental conversion """
+
+        if previous_session:
+            return load_previous_session(
+                self.settings.log_dir,
+                previous_session,
+            )
+        elif all(previous_files):
+            previous_infile, previous_instrument_file, previous_form_file = \
+                previous_files
+            return load_previous_upload(
+                previous_infile.content,
+                previous_instrument_file,
+                previous_form_file,
+            )
+        return None
+
+    def convert(self, req, system, format, instrument_title, instrument_id,
+                            outname, upload_file, compact, result_key,
+                            previous_session=None, previous_files=(),
+                            scratch=None, archive='zip',
+                            conversion_key=None):
+
+        # LOAD PREVIOUS CONVERSION
+        try:
+            previous = self.load_previous(previous_session, previous_files)
+        except Error as exc:
+            return render_to_response(
+                self.form_params_fail_template,
+                req,
+                errors=[str(exc)],
+            )
+
         # VALIDATE UPLOADED FILE
-        if system == 'redcap':
-            try:
-                # Pre-validation processing
-                self.reader = CsvReader(upload_file)  # noqa: F821
-                self.reader.load_attributes()
-                upload_file.seek(0)
-
-                # Determine and initialize validator
-                first_field = self.reader.attributes[0]
-                if first_field == 'Variable / Field Name':
-                    # Process new CSV format
-                    self.validator = RedcapModernCsvValidator
-                elif first_field == 'fieldID':
-                    # Process legacy CSV format
-                    self.validator = RedcapLegacyCsvValidator
-                else:
-                    error = Error(
-                        "Unknown input CSV header format. Got values:",
-                        ", ".join(self.reader.attributes)
-                    )
-                    error.wrap(
-                        "Expected first header/field name value to be:",
-                        "\"Variable / Field Name\" or \"fieldID\""
-                    )
-                    raise error
-            except Exception as exc:
-                error = Error(
-                    "Unable to parse REDCap data dictionary. Got error:",
-                    (str(exc) if isinstance(exc, Error) else repr(exc))
-                )
-                return render_to_response(
-                    self.validation_fail_template,
-                    req,
-                    errors=str(error),
-                    system=system,
-                )
-            else:
-                # Perform validation
-                result = self.validator(StringLoader(upload_file))()
-                if not result.validation:
-                    return render_to_response(
-                        self.validation_fail_template,
-                        req,
-                        errors=result.log,
-                        system=system,
-                    )
-        else:  # system == 'qualtrics', pre-validated in self.parameters
-            try:
-                simplejson.load(infile)
-            except Exception:
-                error = Error(
-                    "Qualtrics file validation failed:",
-                    "The file content is not valid JSON text"
-                )
-                error.wrap("Error:", str(exc))
-                error.wrap("Please try again with a valid QSF file")
-                return render_to_response(
-                    self.validation_fail_template,
-                    req,
-                    errors=str(error),
-                    system=system,
-                )
+        session = current_trace_id()
+        errors, report = check_upload(system, upload_file)
+        if errors is not None:
+            summary = None
+            if report is not None:
+                summary = log_report(session, report)
+            response = render_to_response(
+                self.validation_fail_template,
+                req,
+                errors=errors,
+                system=system,
+                report=summary,
+                session=session,
+            )
+            if summary is not None:
+                response.headers['X-Conversion-Session'] = session
+            return response
 
         # Rewind file
         upload_file.seek(0)
 
         # API INITIALIATION
-        session = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
-        if system == 'redcap':
-            converter_kwargs = {
-                'instrument_version': DEFAULT_VERSION,
-                'localization': DEFAULT_LOCALIZATION,
-                'description': '',
-                'title': instrument_title,
-                'id': instrument_id,
-                'stream': upload_file,
-                'suppress': True,  # Need logged messages
-            }
-        else:  # system == 'qualtrics'
-            converter_kwargs = {
-                'stream': upload_file,
-                'suppress': True,  # Need logged messages
-                'filemetadata': True,  # Pull metadata from file
-            }
+        converter_kwargs = to_rios_params(
+            system,
+            upload_file,
+            instrument_title=instrument_title,
+            instrument_id=instrument_id,
+        )
 
         # LOG INITIALIZATION
         log(session, '%s_to_rios' % (system,), '')
-        log(session, 'uploaded_file_contents.log', upload_file.read())
+        log(session, 'uploaded_file_contents.log', upload_file)
         log(session, 'conversion_params.log', repr(converter_kwargs))
 
         # PROCESS FILE
-        result = self.converters[system](**converter_kwargs)
-
-        # PROCESS RESULT AND RETURN RELEVANT FILES
-        if all(key in result for key in ('form', 'instrument',)):
-            # Initialize zip file
-            zip_container = cStringIO.StringIO()
-            zip_filename = outname + '.zip'
-
-            # Process data structures and insert into zip
-            with ZIPFILE.ZipFile(zip_container, 'a', ZIPFILE.ZIP_DEFLATED) \
-                        as zipfile:
-                # Write instrument file to zip
-                instrument_name = str(outname) + '_i.' + str(format)
-                write_to_zip(
-                    zipfile=zipfile,
-                    name=instrument_name,
-                    payload=result['instrument'],
-                    format=format,
-                )
-
-                # Write form file to zip
-                form_name = str(outname) + '_f.' + str(format)
-                write_to_zip(
-                    zipfile=zipfile,
-                    name=form_name,
-                    payload=result['form'],
-                    format=format,
+        converted = None
+        if previous is not None:
+            # Only the rows changed since the previous conversion are
+            # converted, the output is the same as a full conversion's
+            with span('convert', system=system, incremental=True):
+                result, converted = convert_incremental(
+                    previous,
+                    **converter_kwargs
                 )
+            log(session, 'incremental.log', (
+                'Converted %d blocks' % (converted,)
+                if converted is not None
+                else 'Converted from scratch'
+            ))
+        else:
+            pool = get_conversion_pool() if system == 'qualtrics' else None
+            converter = to_rios_converter(system, pool)
+            with span('convert', system=system):
+                result = converter(**converter_kwargs)
 
-                # Write calculationset to zipfile
-                if 'calculationset' in result:
-                    calc_name = str(outname) + '_c.' + str(format)
-                    write_to_zip(
-                        zipfile=zipfile,
-                        name=calc_name,
-                        payload=result['calculationset'],
-                        format=format,
-                    )
-
-                # Write log file to zip
-                if 'logs' in result:
-                    log_name = 'conversion_log.txt'
-                    write_to_zip(
-                        zipfile=zipfile,
-                        name=log_name,
-                        payload=result['logs'],
-                        format=None
-                    )
-
-            # Rewrind zipfile object
-            zip_container.seek(0)
-
-            log(session, 'output.zip', zip_container)
-            response = BufferedFileApp(zip_container, zip_filename)
-            return response(req)
-        elif 'failure' in result:
-            fail_log = str(result['failure'])
-            log(session, 'failure.log', fail_log)
+        # PROCESS RESULT AND RETURN RELEVANT FILES
+        failure = result_failure(result, ('form', 'instrument',))
+        if failure is None:
+            # Only full conversions are shared with other requests
+            if conversion_key is not None and converted is None:
+                get_conversion_cache().put(conversion_key, result)
+            return self.respond(req, session, result, outname, format,
+                                compact, archive, result_key, scratch)
+        else:
+            log(
+                session,
+                'failure.log' if 'failure' in result else 'error.log',
+                failure
+            )
             return render_to_response(
                 self.convert_fail_template,
                 req,
-                errors=[fail_log, ],
+                errors=[failure, ],
                 system=system
             )
+
+    def respond(self, req, session, result, outname, format, compact,
+                            archive, result_key, scratch=None):
+        """
+        Serializes a conversion to every requested format into an archive,
+        stores it and serves it.
+        """
+
+        members = to_rios_members(result, outname, format, compact=compact)
+        if archive == 'tar':
+            output = build_tar(members, scratch=scratch)
         else:
-            # Conversion result does not contain the proper structure
-            error = Error(
-                'Unexpected serve side error occured',
-                'Unable to convert data dictionary at this time'
+            output = build_archive(
+                members,
+                scratch=scratch,
+                policy=get_compression_policy(),
+                pool=get_compression_pool(),
             )
-            log(session, 'error.log', str(error))
-            return render_to_response(
-                self.convert_fail_template,
-                req,
-                errors=[str(error), ],
-                system=system
+        filename = outname + '.' + archive
+
+        log(session, 'output.' + archive, output)
+        with span('store'):
+            stored = get_result_store().put(
+                output,
+                filename,
+                key=result_key,
             )
+        response = serve_result(req, stored)
+        response.headers['X-Conversion-Session'] = session
+        return response
+
+
+def render_upload(upload, status=200, req=None):
+    """ Returns the state of a chunked upload as JSON """
+
+    return render_json({
+        'upload_id': upload.upload_id,
+        'chunk_size': CHUNK_SIZE,
+        'chunks': sorted(upload.chunks()),
+    }, status=status, req=req)
+
+
+class UploadApi(Command):
+    """
+    Starts a chunked upload with a POST, reports the chunks received so far
+    with a GET, so a client knows which ones to send again, and discards it
+    with a DELETE.
+    """
+
+    path = '/convert/upload'
+    access = 'anybody'
+    parameters = [
+        Parameter('upload_id', MaybeVal(StrVal(r'^[0-9a-f]{32}$')),
+                  default=None),
+    ]
+
+    def render(self, req, upload_id):
+        if req.method == 'POST':
+            return render_upload(get_upload_store().create(), status=201)
+        if req.method not in ('GET', 'HEAD', 'DELETE'):
+            raise HTTPMethodNotAllowed()
+
+        upload = get_upload_store().get(upload_id) if upload_id else None
+        if upload is None:
+            raise HTTPNotFound()
+        if req.method == 'DELETE':
+            upload.remove()
+            return HTTPNoContent()
+        return render_upload(upload, req=req)
+
+
+class UploadChunkApi(Command):
+    """
+    Stores a chunk of a chunked upload, sent as the body of a PUT with its
+    SHA-1 digest.
+    """
+
+    path = '/convert/upload/chunk'
+    access = 'anybody'
+    parameters = [
+        Parameter('upload_id', StrVal(r'^[0-9a-f]{32}$')),
+        Parameter('index', IntVal(min_bound=0, max_bound=999999)),
+        Parameter('sha1', StrVal(r'^[0-9a-f]{40}$')),
+    ]
+
+    def render(self, req, upload_id, index, sha1):
+        # Allow only PUT requests.
+        if req.method not in ('PUT',):
+            raise HTTPMethodNotAllowed()
+
+        upload = get_upload_store().get(upload_id)
+        if upload is None:
+            raise HTTPNotFound()
+        try:
+            upload.put(index, sha1, req.body_file)
+        except Error as exc:
+            return render_json({
+                'errors': [{'source': 'upload', 'message': str(exc)}],
+            }, status=400, req=req)
+        return render_upload(upload, req=req)
+
+
+class ConvertToRiosUploadApi(ConvertToRiosProcessorApi):
+    """
+    Assembles a chunked upload in the scratch space and converts it to RIOS
+    like ``/convert/to/rios`` converts ``infile``.
+    """
+
+    path = '/convert/upload/finalize'
+    parameters = [
+        Parameter('upload_id', StrVal(r'^[0-9a-f]{32}$')),
+        Parameter('chunks', IntVal(min_bound=1)),
+    ] + [
+        parameter
+        for parameter in ConvertToRiosProcessorApi.parameters
+        if parameter.name != 'infile'
+    ]
+
+    @traced('convert.upload')
+    def render(self, req, upload_id, chunks, system, format,
+                                instrument_title, instrument_id, outname,
+                                compact, archive, previous_session,
+                                previous_infile, previous_instrument_file,
+                                previous_form_file):
+
+        # Allow only POST requests.
+        if req.method not in ('POST',):
+            raise HTTPMethodNotAllowed()
+
+        upload = get_upload_store().get(upload_id)
+        if upload is None:
+            raise HTTPNotFound()
+        with get_scratch_space().request() as scratch:
+            try:
+                upload_file = upload.assemble(scratch, chunks)
+            except Error as exc:
+                return render_to_response(
+                    self.form_params_fail_template,
+                    req,
+                    errors=[str(exc)],
+                )
+            return self.process(req, system, format, instrument_title,
+                                instrument_id, outname, upload_file,
+                                compact, previous_session, previous_infile,
+                                previous_instrument_file, previous_form_file,
+                                archive=archive)
 
 
 class ConvertFromRiosProcessorApi(Command):
@@ -583,12 +975,11 @@ class ConvertFromRiosProcessorApi(Command):
         Parameter('form_file', AttachmentVal()),
         Parameter('calculationset_file', AttachmentMaybeVal()),
         Parameter('outname', StrVal(r'^[a-zA-Z0-9_]+$')),
+        Parameter('single_file', BoolVal(), default=False),
+        Parameter('archive', StrVal(r'(zip)|(tar)'), default='zip'),
     ]
 
-    converter_class = {
-        'qualtrics': rios_to_qualtrics,
-        'redcap': rios_to_redcap,
-        }
+    converter_class = FROM_RIOS_CONVERTERS
 
     convert_fail_template = 'rios.converter:/templates/convert_fail.html'
     form_params_fail_template = \
@@ -598,56 +989,85 @@ class ConvertFromRiosProcessorApi(Command):
     def settings(self):
         return get_settings()
 
-    def load_file(self, session, file_field):
-        filename = os.path.join(self.temp_dir, file_field.filename)
-        with open(filename, 'w') as fo:
-            fo.write(file_field.file.read())
+    def __call__(self, req):
+        # Uploads are hashed and spooled as the body is received
+        with ingest(req):
+            return super(ConvertFromRiosProcessorApi, self).__call__(req)
+
+    def load_file(self, session, scratch, field, attachment):
+        """
+        Saves an uploaded file to the scratch directory under the name of
+        its form field and logs it.
+        """
+
+        extension = os.path.splitext(attachment.name)[1]
+        filename = scratch.save(field + extension, attachment.content)
         log_file(session, filename)
         return filename
 
+    @traced('convert.from_rios')
     def render(self, req, system, format, instrument_file,
-                                form_file, calculationset_file, outname):
+                                form_file, calculationset_file, outname,
+                                single_file, archive):
 
         # Allow only GET and HEAD requests.
         if req.method not in ('POST',):
             raise HTTPMethodNotAllowed()
 
+        # Serve a previously produced archive for the same inputs
+        result_key = request_digest(
+            'from_rios',
+            system,
+            format,
+            outname,
+            single_file,
+            archive,
+            instrument_file.content,
+            form_file.content,
+            calculationset_file.content if calculationset_file else None,
+        )
+        stored = get_result_store().lookup(result_key)
+        if stored is not None:
+            annotate(cached=True)
+            return serve_result(req, stored)
+
+        # Wait for a free conversion slot
+        size = upload_size(
+            instrument_file.content,
+            form_file.content,
+            calculationset_file.content if calculationset_file else None,
+        )
+        annotate(system=system, format=format, bytes=size)
+        with get_latency_monitor().measure(), \
+                get_admission().admit(size, client_key(req)), \
+                get_scratch_space().request() as scratch:
+            return self.convert(req, system, format, instrument_file,
+                                form_file, calculationset_file, outname,
+                                result_key, single_file, scratch, archive)
+
+    def convert(self, req, system, format, instrument_file, form_file,
+                            calculationset_file, outname, result_key,
+                            single_file=False, scratch=None,
+                            archive='zip'):
+
         # GENERATE DATA OBJECTS
-        if format == 'yaml':
-            instrument = yaml.safe_load(instrument_file.content)
-            form = yaml.safe_load(form_file.content)
-            calculationset = (
-                yaml.safe_load(calculationset_file.content)
-                if calculationset_file and
-                hasattr(calculationset_file, 'content')
-                else None
-            )
-        else:  # JSON files
-            instrument = simplejson.loads(instrument_file.content.read())
-            form = simplejson.loads(form_file.content.read())
-            calculationset = (
-                simplejson.loads(calculationset_file.content.read())
-                if calculationset_file and
-                hasattr(calculationset_file, 'content')
-                else None
-            )
+        documents, failure = load_and_validate_rios(
+            format,
+            [
+                instrument_file.content,
+                form_file.content,
+                calculationset_file.content if calculationset_file else None,
+            ],
+            memo=get_validation_memo(),
+            pool=get_validation_pool(),
+        )
 
         # VALIDATE UPLOADED RIOS FILES
-        try:
-            val_type = 'Instrument'
-            validate_instrument(instrument)
-            val_type = 'Form'
-            validate_form(form, instrument=instrument)
-            if calculationset:
-                val_type = 'Calculationset'
-                validate_calculationset(
-                    calculationset,
-                    instrument=instrument
-                )
-        except ValidationError as exc:
+        if failure is not None:
+            val_type, message = failure
             error = Error(
                 (val_type + ' file validation error:'),
-                str(exc)
+                message
             )
             return render_to_response(
                 self.convert_fail_template,
@@ -655,88 +1075,290 @@ class ConvertFromRiosProcessorApi(Command):
                 errors=[str(error), ],
                 system=system
             )
-        else:
-            # Rewind file objects
-            instrument_file.content.seek(0)
-            form_file.content.seek(0)
-            calculationset_file.content.seek(0)
+
+        instrument, form, calculationset = documents
 
         # API INITALIZATION
-        session = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
-        converter_kwargs = {
-            'instrument': instrument,
-            'form': form,
-            'calculationset': calculationset,
-            'localization': DEFAULT_LOCALIZATION,
-            'suppress': True,  # Need logged messages
-        }
+        session = current_trace_id()
+        converter_kwargs = from_rios_params(
+            instrument,
+            form,
+            calculationset,
+        )
         log(session, 'rios_to_%s' % (system,), '')
         log(session, 'conversion_params.log', repr(converter_kwargs))
+        if scratch is not None:
+            for field, attachment in (
+                    ('instrument_file', instrument_file),
+                    ('form_file', form_file),
+                    ('calculationset_file', calculationset_file)):
+                if attachment is not None:
+                    self.load_file(session, scratch, field, attachment)
 
         # PROCESS FILE
-        if system == 'redcap':
-            result = rios_to_redcap(**converter_kwargs)
-        else:  # system == 'qualtrics'
-            result = rios_to_qualtrics(**converter_kwargs)
+        converter = load_converter(self.converter_class[system])
+        with span('convert', system=system):
+            result = converter(**converter_kwargs)
 
         # PROCESS RESULT AND RETURN RELEVANT FILE
-        if 'instrument' in result:
-            # Initialize zip file
-            zip_container = cStringIO.StringIO()
-            zip_filename = outname + '.zip'
-
-            # Process data structures and insert into zip
-            with ZIPFILE.ZipFile(zip_container, 'a', ZIPFILE.ZIP_DEFLATED) \
-                        as zipfile:
-                # Write instrument file to zip
-                instrument_name = (
-                    str(outname) + ('.csv' if system == 'redcap' else '.txt')
+        failure = result_failure(result, ('instrument',))
+        if failure is None:
+            members = from_rios_members(result, outname, system)
+            if single_file and len(members) == 1:
+                # No log to bundle, the converted file is served as is
+                filename, payload, data_type, kwargs = members[0]
+                output = build_csv(
+                    payload,
+                    scratch=scratch,
+                    data_type=data_type,
+                    **kwargs
                 )
-                write_to_zip(
-                    zipfile=zipfile,
-                    name=instrument_name,
-                    payload=result['instrument'],
-                    format='csv',
+            elif archive == 'tar':
+                filename = outname + '.tar'
+                output = build_tar(members, scratch=scratch)
+            else:
+                filename = outname + '.zip'
+                output = build_archive(
+                    members,
+                    scratch=scratch,
+                    policy=get_compression_policy(),
+                    pool=get_compression_pool(),
                 )
 
-                # Write log file to zip
-                if 'logs' in result:
-                    log_name = 'conversion_log.txt'
-                    write_to_zip(
-                        zipfile=zipfile,
-                        name=log_name,
-                        payload=result['logs'],
-                        format=None
-                    )
-
-            # Rewrind zipfile object
-            zip_container.seek(0)
-
-            log(session, 'output.zip', zip_container)
-            response = BufferedFileApp(zip_container, zip_filename)
-            return response(req)
-        elif 'failure' in result:
-            fail_log = str(result['failure'])
-            log(session, 'failure.log', fail_log)
+            log(session, 'output' + os.path.splitext(filename)[1], output)
+            with span('store'):
+                stored = get_result_store().put(
+                    output,
+                    filename,
+                    key=result_key,
+                )
+            response = serve_result(req, stored)
+            response.headers['X-Conversion-Session'] = session
+            return response
+        else:
+            log(
+                session,
+                'failure.log' if 'failure' in result else 'error.log',
+                failure
+            )
             return render_to_response(
                 self.convert_fail_template,
                 req,
-                errors=[fail_log, ],
+                errors=[failure, ],
                 system=system
             )
+
+
+class ValidateToRiosApi(Command):
+
+    path = '/validate/to/rios'
+    access = 'anybody'
+    parameters = [
+        Parameter('system', MaybeVal(StrVal(r'(qualtrics)|(redcap)')),
+                  default=None),
+        Parameter('infile', AttachmentVal()),
+    ]
+
+    def render(self, req, system, infile):
+        # Allow only POST requests.
+        if req.method not in ('POST',):
+            raise HTTPMethodNotAllowed()
+
+        try:
+            system = route_upload(system, infile.content)
+        except Error as exc:
+            errors, report = str(exc), None
         else:
-            # Conversion result does not contain the proper structure
-            error = Error(
-                'Unexpected serve side error occured',
-                'Unable to convert data dictionary at this time'
+            errors, report = check_upload(system, infile.content)
+        result = {'valid': errors is None, 'system': system, 'errors': []}
+        if errors is not None:
+            result['errors'] = upload_errors(system or 'upload', errors,
+                                             report)
+        return render_json(result, req=req)
+
+
+class ValidateFromRiosApi(Command):
+
+    path = '/validate/from/rios'
+    access = 'anybody'
+    parameters = [
+        Parameter('format', StrVal('(yaml)|(json)')),
+        Parameter('instrument_file', AttachmentVal()),
+        Parameter('form_file', AttachmentVal()),
+        Parameter('calculationset_file', AttachmentMaybeVal()),
+    ]
+
+    def render(self, req, format, instrument_file, form_file,
+                                                calculationset_file):
+        # Allow only POST requests.
+        if req.method not in ('POST',):
+            raise HTTPMethodNotAllowed()
+
+        documents, failure = load_and_validate_rios(
+            format,
+            [
+                instrument_file.content,
+                form_file.content,
+                calculationset_file.content if calculationset_file else None,
+            ],
+            memo=get_validation_memo(),
+            parse=False,
+            pool=get_validation_pool(),
+        )
+
+        report = {'valid': failure is None, 'errors': []}
+        if failure is not None:
+            val_type, message = failure
+            report['errors'].append({'source': val_type, 'message': message})
+        return render_json(report, req=req)
+
+
+class ConvertToRiosJsonApi(Command):
+    """
+    Converts to RIOS like ``/convert/to/rios`` for scripted clients: the
+    RIOS definitions, the conversion log and the errors are returned
+    inline in a JSON report.
+    """
+
+    path = '/api/v1/convert/to/rios'
+    access = 'anybody'
+    parameters = [
+        Parameter('system', MaybeVal(StrVal(r'(qualtrics)|(redcap)')),
+                  default=None),
+        Parameter('instrument_title',
+                  MaybeVal(StrVal(r'^[a-zA-Z0-9_\s]*$')), default=None),
+        Parameter('instrument_id',
+                  MaybeVal(StrVal(r'([a-z0-9]{3}[a-z0-9]*)?')), default=None),
+        Parameter('infile', AttachmentVal()),
+    ]
+
+    @traced('api.convert.to_rios')
+    def render(self, req, system, instrument_title, instrument_id, infile):
+        # Allow only POST requests.
+        if req.method not in ('POST',):
+            raise HTTPMethodNotAllowed()
+
+        upload_file = infile.content
+        try:
+            system = route_upload(system, upload_file)
+        except Error as exc:
+            return render_api_report(req, system, [('upload', str(exc))])
+        if system == 'redcap':
+            errors = []
+            if not instrument_id:
+                errors.append(('parameters', 'Instrument ID is required'))
+            if not instrument_title:
+                errors.append(
+                    ('parameters', 'Instrument Title is required'))
+            if errors:
+                return render_api_report(req, system, errors)
+        if instrument_id and 'urn:' not in instrument_id:
+            instrument_id = 'urn:%s' % (instrument_id,)
+
+        with get_latency_monitor().measure(), \
+                get_admission().admit(upload_size(upload_file),
+                                      client_key(req)):
+            errors, report = check_upload(system, upload_file)
+            if errors is not None:
+                return render_api_report(
+                    req,
+                    system,
+                    upload_errors(system, errors, report),
+                )
+            pool = get_conversion_pool() if system == 'qualtrics' else None
+            converter = to_rios_converter(system, pool)
+            with span('convert', system=system):
+                result = converter(**to_rios_params(
+                    system,
+                    upload_file,
+                    instrument_title=instrument_title,
+                    instrument_id=instrument_id,
+                ))
+
+        failure = result_failure(result, ('form', 'instrument',))
+        if failure is not None:
+            return render_api_report(
+                req,
+                system,
+                [('conversion', failure)],
+                logs=result.get('logs', ()),
             )
-            log(session, 'error.log', str(error))
-            return render_to_response(
-                self.convert_fail_template,
+        documents = {
+            'instrument': result['instrument'],
+            'form': result['form'],
+        }
+        if 'calculationset' in result:
+            documents['calculationset'] = result['calculationset']
+        return render_api_report(
+            req,
+            system,
+            documents=documents,
+            logs=result.get('logs', ()),
+        )
+
+
+class ConvertFromRiosJsonApi(Command):
+    """
+    Converts from RIOS like ``/convert/from/rios`` for scripted clients:
+    the converted instrument file, the conversion log and the errors are
+    returned inline in a JSON report.
+    """
+
+    path = '/api/v1/convert/from/rios'
+    access = 'anybody'
+    parameters = [
+        Parameter('system', StrVal('(qualtrics)|(redcap)')),
+        Parameter('format', StrVal('(yaml)|(json)')),
+        Parameter('instrument_file', AttachmentVal()),
+        Parameter('form_file', AttachmentVal()),
+        Parameter('calculationset_file', AttachmentMaybeVal()),
+    ]
+
+    @traced('api.convert.from_rios')
+    def render(self, req, system, format, instrument_file, form_file,
+                                                calculationset_file):
+        # Allow only POST requests.
+        if req.method not in ('POST',):
+            raise HTTPMethodNotAllowed()
+
+        streams = [
+            instrument_file.content,
+            form_file.content,
+            calculationset_file.content if calculationset_file else None,
+        ]
+        with get_latency_monitor().measure(), \
+                get_admission().admit(upload_size(*streams),
+                                      client_key(req)):
+            documents, failure = load_and_validate_rios(
+                format,
+                streams,
+                memo=get_validation_memo(),
+                pool=get_validation_pool(),
+            )
+            if failure is not None:
+                return render_api_report(req, system, [failure])
+            converter = load_converter(FROM_RIOS_CONVERTERS[system])
+            with span('convert', system=system):
+                result = converter(**from_rios_params(*documents))
+
+        failure = result_failure(result, ('instrument',))
+        if failure is not None:
+            return render_api_report(
                 req,
-                errors=[str(error), ],
-                system=system
+                system,
+                [('conversion', failure)],
+                logs=result.get('logs', ()),
             )
+        # Serialized like the instrument file of the archive
+        _, payload, data_type, kwargs = \
+            from_rios_members(result, 'instrument', system)[0]
+        instrument = ''.join(iter_member(payload, data_type, **kwargs))
+        return render_api_report(
+            req,
+            system,
+            documents={'instrument': instrument},
+            logs=result.get('logs', ()),
+        )
 
 
 class HandleNotFound(HandleError):
@@ -757,6 +1379,8 @@ class HandleRST(HandleFile):
     ext = '.rst'
 
     def __call__(self, req):
+        import docutils.core
+
         # Load the file.
         packages = get_packages()
         with packages.open(self.path) as rst_file:
@@ -771,9 +1395,43 @@ class HandleRST(HandleFile):
         return Response(html_output)
 
 
+class HandleAsset(HandleFile):
+    """
+    Serves static assets with the cache headers of fingerprinted files, see
+    `rios.converter.assets`, and their precompressed variants.
+    """
+
+    def __call__(self, req):
+        return serve_asset(req, self.path)
+
+
+class HandleJS(HandleAsset):
+
+    ext = '.js'
+
+
+class HandleCSS(HandleAsset):
+
+    ext = '.css'
+
+
+class HandlePNG(HandleAsset):
+
+    ext = '.png'
+
+
 class HandlePing(HandleLocation):
 
     path = '/ping'
 
     def __call__(self, req):
         return Response(content_type='text/plain', body="pong!")
+
+
+class HandleReady(HandleLocation):
+
+    path = '/ready'
+
+    def __call__(self, req):
+        ready, report = readiness()
+        return render_json(report, status=200 if ready else 503)
@@ -27,11 +27,16 @@ __all__ = (
     'RedcapLegacyCsvValidator',
     'RedcapModernCsvValidator',
     'StringLoader',
+    'failure_rows',
 )
 
 
 DEFAULT_DISPLAY_LIMIT = 30
 
+# Number of failing lines detailed in the error log; all of them are in the
+# validation report, see `failure_rows`
+DETAIL_LIMIT = 100
+
 
 class RequiredStrVal(BaseTypeValidator):
     """ Required string field must contain a string """
@@ -200,6 +205,8 @@ class RedcapModernCsvValidator(SimpleCSVFileValidator):
                         try:
                             validator.validate(field, row=row)
                         except ValidationException as exc:
+                            # For the validation report
+                            exc.validator = validator.__class__.__name__
                             self.failures[field_name][line].append(exc)
                             validator.failure_count += 1
                 except KeyError as exc:
@@ -264,13 +271,53 @@ class RedcapLegacyCsvValidator(SimpleCSVFileValidator):
         return super(RedcapLegacyCsvValidator, self).validate(self)
 
 
-def log_failures(failures, logger):
-    for field_name, field_failure in six.iteritems(failures):
+def log_failures(failures, logger, limit=DETAIL_LIMIT):
+    logged = 0
+    for field_name, field_failure in sorted(six.iteritems(failures)):
+        if logged >= limit:
+            break
         logger.log("  Failure in column: \"{}\":".format(field_name))
-        for i, (row, errors) in enumerate(six.iteritems(field_failure)):
+        for row, errors in sorted(six.iteritems(field_failure)):
+            if logged >= limit:
+                break
             logger.log("    Line: {}".format(row))
             for error in errors:
                 logger.log("      {}".format(error))
+            logged += 1
+    hidden = sum(len(field_failure) for field_failure in failures.values()) \
+        - logged
+    if hidden:
+        logger.log(
+            "  ({} more failing lines suppressed)".format(hidden))
+
+
+def failure_rows(validators, failures):
+    """
+    Lists the failures of a validation pass by line and column.
+
+    :param validators: The validators of the pass, by column
+    :param failures: The failures of the pass, by column and line
+    :returns: A list of (line, column, validator, message) tuples
+    :rtype: list
+    """
+
+    rows = []
+    for field_name, field_failure in six.iteritems(failures):
+        # The failures of legacy files don't name their validator
+        default = '/'.join(
+            validator.__class__.__name__
+            for validator in validators.get(field_name, ())
+        )
+        for line, errors in six.iteritems(field_failure):
+            for error in errors:
+                rows.append((
+                    line,
+                    field_name,
+                    getattr(error, 'validator', default),
+                    str(error),
+                ))
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return rows
 
 
 def log_validator_failures(validators, logger):
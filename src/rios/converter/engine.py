@@ -0,0 +1,672 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+import collections
+import cStringIO
+import csv
+import functools
+import os
+import tarfile
+import tempfile
+import zlib
+import zipfile as ZIPFILE
+
+
+from rex.core import Error
+from .compression import STREAM_LEVEL, compress_members
+from .serialization import dump_json, dump_yaml
+from .tracing import span
+from .validation import load_and_validate_rios, validate_upload
+
+
+__all__ = (
+    'Outcome',
+    'build_archive',
+    'build_csv',
+    'build_tar',
+    'iter_csv',
+    'iter_member',
+    'iter_rows',
+    'from_rios_members',
+    'from_rios_params',
+    'load_converter',
+    'output_formats',
+    'result_failure',
+    'run_from_rios',
+    'run_to_rios',
+    'to_rios_converter',
+    'to_rios_members',
+    'to_rios_params',
+    'serialize',
+    'serialize_members',
+    'write_csv_to_zip',
+    'write_member',
+    'write_to_buffer',
+    'write_to_zip',
+)
+
+
+# Timestamp given to every archive member, so that archives built from the
+# same conversion are byte-for-byte identical and share an ETag.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Size of the serialized CSV chunks written to an archive at a time
+CSV_CHUNK_SIZE = 1 << 16
+
+# Archives are kept in memory up to this size, then on disk
+SPOOL_SIZE = 1 << 22
+
+# Converters by system, named after the ``rios.conversion`` functions, which
+# are only imported when a conversion runs, see `load_converter`.
+TO_RIOS_CONVERTERS = {
+    'qualtrics': 'qualtrics_to_rios',
+    'redcap': 'redcap_to_rios',
+}
+
+FROM_RIOS_CONVERTERS = {
+    'qualtrics': 'rios_to_qualtrics',
+    'redcap': 'rios_to_redcap',
+}
+
+# Extension of the instrument file converted from RIOS
+FROM_RIOS_EXTENSIONS = {
+    'qualtrics': '.txt',
+    'redcap': '.csv',
+}
+
+LOG_NAME = 'conversion_log.txt'
+
+
+# Result of running a whole pipeline. ``stage`` is None on success,
+# otherwise ``validation`` or ``conversion``; ``errors`` is a list of error
+# messages; ``members`` is the list of output files, see `to_rios_members`.
+Outcome = collections.namedtuple('Outcome', 'stage errors members')
+
+
+def load_converter(name):
+    """ Imports ``rios.conversion`` and returns the named converter """
+
+    import rios.conversion
+    return getattr(rios.conversion, name)
+
+
+def to_rios_converter(system, pool=None):
+    """
+    Returns the converter to RIOS of ``system``. Given a process ``pool``,
+    large Qualtrics surveys are converted in parallel, see
+    :mod:`rios.converter.parallel`.
+    """
+
+    if system == 'qualtrics' and pool is not None:
+        from .parallel import convert_qualtrics
+        return functools.partial(convert_qualtrics, pool)
+    return load_converter(TO_RIOS_CONVERTERS[system])
+
+
+def iter_rows(rows):
+    """
+    Iterates over the rows of a CSV payload. The rows ``rios_to_redcap``
+    collects in a deque are removed from it as they are produced, so each
+    row is released once it is written.
+    """
+
+    if isinstance(rows, collections.deque):
+        while rows:
+            yield rows.popleft()
+    else:
+        for row in rows:
+            yield row
+
+
+def iter_csv(rows, *args, **kwargs):
+    """
+    Serializes CSV rows like :func:`write_to_buffer`, yielding the output in
+    chunks of about ``CSV_CHUNK_SIZE`` bytes as the rows are produced.
+    """
+
+    chunk = cStringIO.StringIO()
+    csv_writer = csv.writer(
+        chunk,
+        delimiter=',',
+        quotechar='\"',
+        quoting=csv.QUOTE_MINIMAL,
+        *args,
+        **kwargs
+    )
+    for row in iter_rows(rows):
+        csv_writer.writerow(row)
+        if chunk.tell() >= CSV_CHUNK_SIZE:
+            yield chunk.getvalue()
+            chunk.seek(0)
+            chunk.truncate()
+    if chunk.tell():
+        yield chunk.getvalue()
+
+
+def iter_member(payload, data_type=None, **kwargs):
+    """
+    Serializes an output file listed by :func:`to_rios_members` or
+    :func:`from_rios_members` like :func:`write_to_buffer`, in chunks: a CSV
+    payload is written row by row, see :func:`iter_csv`.
+    """
+
+    if data_type == 'csv' and isinstance(payload, list):
+        return iter_csv(payload[0], **kwargs)
+    return iter([serialize(payload, data_type, **kwargs)])
+
+
+def write_to_buffer(file_object, payload, data_type=None, *args, **kwargs):
+    """
+    Writes stuctured data to a file object of the corresponding data type. The
+    ``args`` and ``kwargs`` are passed to the underlying loader_type instance.
+    If ``data_type`` is not specified or the function can't handle writing the
+    data type of payload, the payload is written as a text file.
+
+    If payload is a dict to be written to a CSV, a dict with a key of name
+    ``fieldnames`` and value of type list containing separate field names must
+    be passed via ``kwargs`` to enable writing the payload to a CSV with
+    :class:csv.DictWriter. The payload will be written to a text file if the
+    field names list is not passed in.
+
+    All file objects will be rewound with ``file_object.seek(0)`` after a
+    checked for a ``seek`` attribute is successful.
+
+    :param data_type:
+        The type of structured data payload will be written too. If None, the
+        payload will be written to a text file.
+    :type data_type: str of value 'json', 'yaml', or 'csv' or None
+    :param file_object: File object to write too.
+    :type file_object: file or buffer/stream
+    :param payload: Structured dataset.
+    :type payload: dict, list, or str
+    :param compact:
+        Keyword only. Write JSON and YAML without indentation or key sorting.
+    :type compact: bool
+    """
+
+    compact = kwargs.pop('compact', False)
+    if data_type == 'json':
+        dump_json(
+            payload,
+            file_object,
+            compact=compact,
+            *args,
+            **kwargs
+        )
+    elif data_type == 'yaml':
+        dump_yaml(
+            payload,
+            file_object,
+            compact=compact,
+            *args,
+            **kwargs
+        )
+    elif data_type == 'csv':
+        if isinstance(payload, list):
+            # Payload must contain one CSV line per list item
+            csv_writer = csv.writer(
+                file_object,
+                delimiter=',',
+                quotechar='\"',
+                quoting=csv.QUOTE_MINIMAL,
+                *args,
+                **kwargs
+            )
+            csv_writer.writerows(iter_rows(payload[0]))
+        elif isinstance(payload, dict) and 'fieldnames' in kwargs:
+            fieldnames = kwargs['fieldnames']
+            csv_writer = csv.DictWriter(
+                file_object,
+                fieldnames=fieldnames,
+                delimeter=',',
+                quotechar='\"',
+                quoting=csv.QUOTE_MINIMAL,
+                *args,
+                **kwargs
+            )
+    else:  # Load data to text file
+        if isinstance(payload, list):
+            for record in payload:
+                file_object.write(
+                    record if isinstance(record, str) else repr(record)
+                )
+        else:
+            file_object.write(
+                str(payload) if isinstance(payload, str) else repr(payload)
+            )
+
+    # Rewind ALL THE THINGS! (files)
+    if hasattr(file_object, 'seek'):
+        file_object.seek(0)
+
+
+def serialize(payload, format, *args, **kwargs):
+    """ Returns the content :func:`write_to_buffer` writes as a string """
+
+    container = cStringIO.StringIO()
+    write_to_buffer(
+        data_type=str(format),
+        file_object=container,
+        payload=payload,
+        *args,
+        **kwargs
+    )
+    return container.getvalue()
+
+
+def serialize_member(member):
+    _, payload, data_type, kwargs = member
+    return serialize(payload, data_type, **kwargs)
+
+
+def serialize_members(members, pool=None):
+    """
+    Serializes the output files listed in ``members``, concurrently by the
+    thread pool ``pool`` if given, and returns their contents in order.
+    """
+
+    if pool is not None and len(members) > 1:
+        return pool.map(serialize_member, members)
+    return map(serialize_member, members)
+
+
+def write_to_zip(zipfile, name, payload, format, *args, **kwargs):
+    """
+    Writes the specified container to a zipfile, compressed according to
+    the default :class:`~rios.converter.compression.CompressionPolicy`.
+
+    The ``args`` and ``kwargs`` are passed to the underlying function call. See
+    :function:write_to_buffer for more details.
+    """
+
+    content = serialize(payload, format, *args, **kwargs)
+    _, (deflated,) = compress_members([content])
+    write_member(zipfile, name, content, deflated)
+
+
+def write_member(zipfile, name, content, deflated=None):
+    """
+    Adds a member to a zipfile given its content and its raw deflate
+    stream, see :func:`~rios.converter.compression.compress_members`, or
+    stores it if ``deflated`` is None.
+    """
+
+    with span('write_to_zip', member=name) as written:
+        info = member_info(zipfile, name)
+        info.file_size = len(content)
+        info.CRC = zlib.crc32(content) & 0xffffffff
+        if deflated is None:
+            info.compress_type = ZIPFILE.ZIP_STORED
+            deflated = content
+        info.compress_size = len(deflated)
+        info.header_offset = zipfile.fp.tell()
+        zipfile._writecheck(info)
+        zipfile._didModify = True
+        zipfile.fp.write(info.FileHeader(False))
+        zipfile.fp.write(deflated)
+        zipfile.filelist.append(info)
+        zipfile.NameToInfo[info.filename] = info
+        written.set(
+            bytes=info.file_size,
+            compressed=info.compress_size,
+            stored=info.compress_type == ZIPFILE.ZIP_STORED,
+        )
+
+
+def member_info(zipfile, name):
+    info = ZIPFILE.ZipInfo(name, date_time=ZIP_DATE_TIME)
+    info.compress_type = zipfile.compression
+    info.external_attr = 0o600 << 16
+    return info
+
+
+def write_csv_to_zip(zipfile, name, rows, *args, **kwargs):
+    """
+    Writes CSV rows to a zipfile member as they are produced, see
+    :func:`iter_csv`, without holding the whole member in memory.
+
+    The member is the same as the one :func:`write_to_zip` writes. Python 2
+    can only add whole strings or files to an archive, so this follows
+    ``ZipFile.write()``: the local header is written first and rewritten
+    with the sizes and the CRC once the content is compressed.
+    """
+
+    with span('write_to_zip', member=name, streamed=True) as written:
+        _write_csv_member(zipfile, name, rows, *args, **kwargs)
+        written.set(
+            bytes=zipfile.NameToInfo[name].file_size,
+            compressed=zipfile.NameToInfo[name].compress_size,
+        )
+
+
+def _write_csv_member(zipfile, name, rows, *args, **kwargs):
+    info = member_info(zipfile, name)
+    info.flag_bits = 0x00
+    info.file_size = info.compress_size = info.CRC = 0
+    info.header_offset = zipfile.fp.tell()
+    zipfile._writecheck(info)
+    zipfile._didModify = True
+    zipfile.fp.write(info.FileHeader(False))
+
+    if info.compress_type == ZIPFILE.ZIP_DEFLATED:
+        compressor = zlib.compressobj(STREAM_LEVEL, zlib.DEFLATED, -15)
+    else:
+        compressor = None
+    crc = file_size = compress_size = 0
+    for chunk in iter_csv(rows, *args, **kwargs):
+        file_size += len(chunk)
+        crc = zlib.crc32(chunk, crc) & 0xffffffff
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        compress_size += len(chunk)
+        zipfile.fp.write(chunk)
+    if compressor is not None:
+        chunk = compressor.flush()
+        compress_size += len(chunk)
+        zipfile.fp.write(chunk)
+    if max(file_size, compress_size) > ZIPFILE.ZIP64_LIMIT:
+        raise ZIPFILE.LargeZipFile('CSV member exceeds the ZIP64 limit')
+    info.CRC = crc
+    info.file_size = file_size
+    info.compress_size = compress_size
+
+    position = zipfile.fp.tell()
+    zipfile.fp.seek(info.header_offset)
+    zipfile.fp.write(info.FileHeader(False))
+    zipfile.fp.seek(position)
+    zipfile.filelist.append(info)
+    zipfile.NameToInfo[info.filename] = info
+
+
+def to_rios_params(system, stream, instrument_title=None,
+                                                    instrument_id=None):
+    """ Builds the keyword arguments of the converter to RIOS """
+
+    from rios.conversion.base import DEFAULT_LOCALIZATION, DEFAULT_VERSION
+    if system == 'redcap':
+        return {
+            'instrument_version': DEFAULT_VERSION,
+            'localization': DEFAULT_LOCALIZATION,
+            'description': '',
+            'title': instrument_title,
+            'id': instrument_id,
+            'stream': stream,
+            'suppress': True,  # Need logged messages
+        }
+    else:  # system == 'qualtrics'
+        return {
+            'stream': stream,
+            'suppress': True,  # Need logged messages
+            'filemetadata': True,  # Pull metadata from file
+        }
+
+
+def from_rios_params(instrument, form, calculationset=None):
+    """ Builds the keyword arguments of the converter from RIOS """
+
+    from rios.conversion.base import DEFAULT_LOCALIZATION
+    return {
+        'instrument': instrument,
+        'form': form,
+        'calculationset': calculationset,
+        'localization': DEFAULT_LOCALIZATION,
+        'suppress': True,  # Need logged messages
+    }
+
+
+def result_failure(result, required):
+    """
+    Checks that a conversion result contains the ``required`` keys.
+
+    :returns: None if it does, otherwise the error message
+    :rtype: None or str
+    """
+
+    if all(key in result for key in required):
+        return None
+    elif 'failure' in result:
+        return str(result['failure'])
+    else:
+        # Conversion result does not contain the proper structure
+        return str(Error(
+            'Unexpected serve side error occured',
+            'Unable to convert data dictionary at this time'
+        ))
+
+
+def output_formats(format):
+    """
+    Returns the distinct formats of a comma-separated list such as
+    ``yaml,json``, in order.
+    """
+
+    formats = []
+    for name in str(format).split(','):
+        if name not in formats:
+            formats.append(name)
+    return formats
+
+
+def to_rios_members(result, outname, format, compact=False):
+    """
+    Lists the output files of a conversion to RIOS.
+
+    :param format:
+        The output format, or several separated by commas, in which case
+        the definitions are written in each of them, see
+        :func:`output_formats`
+    :returns:
+        A list of (filename, payload, data type, keyword arguments) tuples
+        in the order they are written, for :func:`write_to_buffer`
+    :rtype: list
+    """
+
+    kwargs = {'compact': compact}
+    members = []
+    for output_format in output_formats(format):
+        members.extend([
+            (str(outname) + '_i.' + output_format, result['instrument'],
+             output_format, kwargs),
+            (str(outname) + '_f.' + output_format, result['form'],
+             output_format, kwargs),
+        ])
+        if 'calculationset' in result:
+            members.append((
+                str(outname) + '_c.' + output_format,
+                result['calculationset'],
+                output_format,
+                kwargs,
+            ))
+    if 'logs' in result:
+        members.append((LOG_NAME, result['logs'], None, {}))
+    return members
+
+
+def from_rios_members(result, outname, system):
+    """
+    Lists the output files of a conversion from RIOS, like
+    :func:`to_rios_members`. A REDCap data dictionary is a CSV file, a
+    Qualtrics survey a text file of the lines of the instrument.
+    """
+
+    name = str(outname) + FROM_RIOS_EXTENSIONS[system]
+    if system == 'redcap':
+        members = [(name, result['instrument'], 'csv', {})]
+    else:  # system == 'qualtrics'
+        lines = [line + '\n' for line in result['instrument']]
+        members = [(name, lines, None, {})]
+    if 'logs' in result:
+        members.append((LOG_NAME, result['logs'], None, {}))
+    return members
+
+
+def output_file(name, scratch=None):
+    """
+    Opens a new output file: a file of the request's
+    :class:`~rios.converter.scratch.ScratchDirectory` if given, which can be
+    handed off without copying, otherwise a spooled temporary file.
+    """
+
+    if scratch is not None:
+        return scratch.open(name)
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+
+def build_archive(members, scratch=None, policy=None, pool=None):
+    """
+    Writes the output files to a new zip archive and rewinds it.
+
+    Members are serialized and compressed as ``policy`` has it, see
+    :mod:`rios.converter.compression`, by ``pool`` if given. CSV files are
+    written row by row instead, see :func:`write_csv_to_zip`. The archive
+    is spooled to disk once it grows past ``SPOOL_SIZE`` bytes, or written
+    to the ``scratch`` directory of the request, if given.
+    """
+
+    with span('build_archive', members=len(members)) as archive:
+        zip_container = output_file('output.zip', scratch)
+        streamed = [
+            data_type == 'csv' and isinstance(payload, list)
+            for _, payload, data_type, _ in members
+        ]
+        contents = serialize_members(
+            [
+                member
+                for member, is_streamed in zip(members, streamed)
+                if not is_streamed
+            ],
+            pool,
+        )
+        with span('compress', bytes=sum(len(content)
+                                        for content in contents)) \
+                as compressing:
+            level, deflated = compress_members(contents, policy, pool)
+            compressing.set(level=level)
+        with ZIPFILE.ZipFile(zip_container, 'a', ZIPFILE.ZIP_DEFLATED) \
+                as zipfile:
+            for (name, payload, _, kwargs), is_streamed in \
+                    zip(members, streamed):
+                if is_streamed:
+                    write_csv_to_zip(zipfile, name, payload[0], **kwargs)
+                else:
+                    write_member(
+                        zipfile,
+                        name,
+                        contents.pop(0),
+                        deflated.pop(0),
+                    )
+        archive.set(bytes=zip_container.tell())
+    # Rewrind zipfile object
+    zip_container.seek(0)
+    return zip_container
+
+
+def build_tar(members, scratch=None):
+    """
+    Writes the output files to a new uncompressed tar archive and rewinds
+    it, for clients that take the archive gzip-encoded, which compresses it
+    as a whole in transit instead of member by member.
+    """
+
+    with span('build_tar', members=len(members)) as archive:
+        tar_container = output_file('output.tar', scratch)
+        with tarfile.open(fileobj=tar_container, mode='w',
+                          format=tarfile.USTAR_FORMAT) as tar:
+            for name, payload, data_type, kwargs in members:
+                if data_type == 'csv' and isinstance(payload, list):
+                    content = build_csv(payload, **kwargs)
+                    content.seek(0, os.SEEK_END)
+                    size = content.tell()
+                    content.seek(0)
+                else:
+                    content = cStringIO.StringIO(
+                        serialize(payload, data_type, **kwargs))
+                    size = len(content.getvalue())
+                # Like zip members, tar members are the same for the same
+                # conversion
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mtime = 0
+                info.mode = 0o600
+                tar.addfile(info, content)
+        archive.set(bytes=tar_container.tell())
+    tar_container.seek(0)
+    return tar_container
+
+
+def build_csv(payload, scratch=None, data_type='csv', **kwargs):
+    """
+    Writes a CSV payload to a new file, row by row, and rewinds it, or any
+    other output file of ``data_type``, see :func:`iter_member`. Like an
+    archive, the file is spooled to disk past ``SPOOL_SIZE`` bytes, or
+    written to the ``scratch`` directory of the request, if given.
+    """
+
+    with span('build_csv') as output:
+        csv_file = output_file('output.csv', scratch)
+        for chunk in iter_member(payload, data_type, **kwargs):
+            csv_file.write(chunk)
+        output.set(bytes=csv_file.tell())
+    csv_file.seek(0)
+    return csv_file
+
+
+def run_to_rios(system, stream, outname, format='yaml',
+                instrument_title=None, instrument_id=None, compact=False,
+                pool=None):
+    """
+    Validates, converts and serializes a REDCap or Qualtrics data dictionary
+    the way ``/convert/to/rios`` does, without logging.
+
+    :param pool: The process pool of :func:`to_rios_converter`
+    :rtype: Outcome
+    """
+
+    errors = validate_upload(system, stream)
+    if errors is not None:
+        return Outcome('validation', [errors], None)
+    if instrument_id and 'urn:' not in instrument_id:
+        instrument_id = 'urn:%s' % (instrument_id,)
+    result = to_rios_converter(system, pool)(**to_rios_params(
+        system,
+        stream,
+        instrument_title=instrument_title,
+        instrument_id=instrument_id,
+    ))
+    failure = result_failure(result, ('form', 'instrument',))
+    if failure is not None:
+        return Outcome('conversion', [failure], None)
+    return Outcome(
+        None,
+        [],
+        to_rios_members(result, outname, format, compact=compact),
+    )
+
+
+def run_from_rios(system, format, streams, outname, memo=None):
+    """
+    Validates, converts and serializes RIOS definitions the way
+    ``/convert/from/rios`` does, without logging.
+
+    :param streams:
+        The instrument, form and calculationset file objects. The
+        calculationset may be None.
+    :rtype: Outcome
+    """
+
+    documents, failure = load_and_validate_rios(format, streams, memo=memo)
+    if failure is not None:
+        val_type, message = failure
+        return Outcome(
+            'validation',
+            [str(Error((val_type + ' file validation error:'), message))],
+            None,
+        )
+    converter = load_converter(FROM_RIOS_CONVERTERS[system])
+    result = converter(**from_rios_params(*documents))
+    failure = result_failure(result, ('instrument',))
+    if failure is not None:
+        return Outcome('conversion', [failure], None)
+    return Outcome(None, [], from_rios_members(result, outname, system))
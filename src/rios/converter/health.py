@@ -0,0 +1,237 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+import collections
+import contextlib
+import errno
+import os
+import resource
+import tempfile
+import threading
+import time
+
+
+from rex.core import cached, get_settings
+from .admission import get_admission
+from .results import get_conversion_cache, get_result_store
+from .validation import get_validation_memo
+
+
+__all__ = (
+    'LatencyMonitor',
+    'free_space',
+    'get_latency_monitor',
+    'memory_use',
+    'readiness',
+)
+
+
+# Seconds of conversions the latency percentiles are computed over
+LATENCY_WINDOW = 300
+
+# Maximum number of latency samples kept per worker
+LATENCY_SAMPLES = 1024
+
+# Minimum number of seconds between two writes of a worker's samples
+FLUSH_INTERVAL = 1.0
+
+
+class LatencyMonitor(object):
+    """
+    Collects the latency of recent conversions across all the worker
+    processes sharing ``path``.
+
+    Every worker keeps its own samples in memory and writes them to a file
+    of its own at most every :data:`FLUSH_INTERVAL` seconds, so recording a
+    sample costs no I/O most of the time. Percentiles are computed over the
+    samples of the live workers that are younger than ``window`` seconds.
+    """
+
+    def __init__(self, path, window=LATENCY_WINDOW, size=LATENCY_SAMPLES):
+        self.path = path
+        self.window = window
+        self.samples = collections.deque(maxlen=size)
+        self.flushed = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    @contextlib.contextmanager
+    def measure(self):
+        """ Records the duration of the block unless it raises """
+
+        start = time.time()
+        yield
+        self.record(time.time() - start)
+
+    def record(self, seconds):
+        now = time.time()
+        with self.lock:
+            self.samples.append((now, seconds))
+            if now - self.flushed < FLUSH_INTERVAL:
+                return
+            self.flushed = now
+            content = ''.join(
+                '%r %r\n' % sample
+                for sample in self.samples
+                if now - sample[0] <= self.window
+            )
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='.')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        os.rename(temp_path, os.path.join(self.path, str(os.getpid())))
+
+    def recent(self):
+        """ Returns the recent latencies of all live workers, in seconds """
+
+        now = time.time()
+        latencies = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                os.kill(int(name), 0)
+            except OSError as exc:
+                if exc.errno == errno.ESRCH:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        # Removed by another worker
+                        pass
+                    continue
+            except ValueError:
+                continue
+            try:
+                with open(path, 'rb') as fp:
+                    lines = fp.read().splitlines()
+            except IOError:
+                continue
+            for line in lines:
+                timestamp, seconds = line.split()
+                if now - float(timestamp) <= self.window:
+                    latencies.append(float(seconds))
+        return latencies
+
+    def percentile(self, percent):
+        """ Returns the given percentile of recent latencies, or None """
+
+        latencies = sorted(self.recent())
+        if not latencies:
+            return None
+        idx = int(round(percent / 100.0 * (len(latencies) - 1)))
+        return latencies[idx]
+
+
+@cached
+def get_latency_monitor():
+    """ Returns the application's :class:`LatencyMonitor` """
+
+    settings = get_settings()
+    return LatencyMonitor(os.path.join(
+        settings.temp_dir or tempfile.gettempdir(),
+        'rios.converter',
+        'latency'
+    ))
+
+
+def free_space(path):
+    """
+    Returns the bytes available to the worker on the disk of ``path``, or
+    of its nearest existing parent directory.
+    """
+
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def memory_use():
+    """
+    Returns the resident memory of the worker and the memory available on
+    the host in bytes. The latter is None where ``/proc/meminfo`` isn't.
+    """
+
+    try:
+        with open('/proc/self/statm', 'rb') as fp:
+            resident = int(fp.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # Peak resident memory, in kilobytes on Linux
+        resident = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    available = None
+    try:
+        with open('/proc/meminfo', 'rb') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except IOError:
+        pass
+    return resident, available
+
+
+def readiness():
+    """
+    Checks whether the node should receive more conversions.
+
+    :returns:
+        A pair: whether the node is ready, and a report of its load and of
+        the reasons it isn't ready
+    :rtype: tuple
+    """
+
+    settings = get_settings()
+    problems = []
+
+    conversions = get_admission().stats()
+    max_queued = settings.readiness_max_queued
+    if max_queued is None:
+        max_queued = settings.conversion_queue_length
+    if conversions['limit'] and conversions['queued'] >= max_queued:
+        problems.append('%d conversions queued' % (conversions['queued'],))
+
+    p95 = get_latency_monitor().percentile(95)
+    if (settings.readiness_max_latency and p95 is not None and
+            p95 > settings.readiness_max_latency):
+        problems.append('p95 latency is %.1f s' % (p95,))
+
+    disks = {}
+    directories = [
+        ('log_dir', settings.log_dir),
+        ('temp_dir', settings.temp_dir or tempfile.gettempdir()),
+        ('result_dir', get_result_store().path),
+    ]
+    for name, path in directories:
+        try:
+            disks[name] = free_space(path)
+        except OSError as exc:
+            problems.append('%s is unavailable: %s' % (name, exc.strerror))
+            continue
+        if disks[name] < settings.readiness_min_free_space:
+            problems.append('%s has %d bytes free' % (name, disks[name]))
+
+    resident, available = memory_use()
+    if (available is not None and
+            available < settings.readiness_min_free_memory):
+        problems.append('%d bytes of memory available' % (available,))
+
+    return not problems, {
+        'ready': not problems,
+        'problems': problems,
+        'conversions': conversions,
+        'latency_p95': p95,
+        'free_space': disks,
+        'memory': {
+            'resident': resident,
+            'available': available,
+        },
+        'validation_memo': get_validation_memo().stats(),
+        'conversion_cache': get_conversion_cache().stats(),
+    }
@@ -0,0 +1,501 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Incremental conversion of revised REDCap data dictionaries.
+
+``redcap_to_rios`` converts a data dictionary row by row, and the output of
+a row only depends on the row itself, except for matrix questions, which
+span consecutive rows of the same matrix group. The rows of a dictionary
+are therefore split into blocks: a single row, or the rows of a matrix
+question along with the calculations between them. A block whose rows are
+unchanged since a previous conversion yields the same form elements and
+instrument fields as before, so only the changed blocks are converted and
+validated again, and the other fragments are spliced in from the previous
+result.
+
+Fragments are only taken as they are from a previous result the
+application produced itself, i.e. from a session; the fragments of a
+result uploaded by the client are checked against a conversion of their
+rows first. The spliced instrument and form are validated in full.
+
+Whenever the previous result can't be matched to its data dictionary, or a
+changed block behaves in a way a block on its own can't reproduce, the
+whole dictionary is converted with ``redcap_to_rios``, so the output is
+always the same as that of a full conversion.
+"""
+
+
+import collections
+import cStringIO
+import functools
+import os
+import tarfile
+import zipfile
+
+from rex.core import Error
+from .serialization import load_json, load_yaml
+
+
+__all__ = (
+    'Previous',
+    'convert_incremental',
+    'load_previous_session',
+    'load_previous_upload',
+    'split_blocks',
+)
+
+
+# A previous conversion: the data dictionary file object, the instrument
+# and form definitions produced from it, and whether they were produced by
+# the application, rather than uploaded.
+Previous = collections.namedtuple('Previous', 'stream instrument form trusted')
+Previous.__new__.__defaults__ = (False,)
+
+# Rows of a block along with their line numbers in the data dictionary
+Block = collections.namedtuple('Block', 'lines rows')
+
+# Output of a block: (page name, form element) pairs, instrument fields and
+# the warnings logged while converting it
+Fragment = collections.namedtuple('Fragment', 'elements fields warnings')
+
+
+class Fallback(Exception):
+    """ Raised when a conversion has to start over from scratch """
+
+
+def read_dictionary(stream):
+    """
+    Reads a REDCap data dictionary the way ``redcap_to_rios`` does.
+
+    Rows are plain dictionaries, which are much cheaper to build than the
+    ordered dictionaries of the reader; see :func:`convert_block`.
+
+    :returns: The reader and the list of rows
+    :rtype: tuple
+    """
+
+    from rios.conversion.redcap.to_rios import CsvReaderWithGetName
+    stream.seek(0)
+    reader = CsvReaderWithGetName(stream)
+    reader.load_attributes()
+    rows = [
+        dict(zip(reader.attributes, [value.strip() for value in row]))
+        for row in reader.reader
+    ]
+    stream.seek(0)
+    return reader, rows
+
+
+def matrix_group(reader, row):
+    return reader.get_name(row.get('matrix_group_name', ''))
+
+
+def split_blocks(reader, rows):
+    """
+    Splits the rows of a data dictionary into blocks that convert
+    independently of each other.
+
+    The converter keeps track of the current matrix group: a matrix row sets
+    it, any other question resets it and calculations leave it alone. Rows
+    that continue the current matrix group belong to the block of the
+    matrix.
+    """
+
+    blocks = []
+    current = None
+    for line, row in enumerate(rows, start=2):
+        if row.get('field_type') == 'calc':
+            if current is not None:
+                blocks[-1].lines.append(line)
+                blocks[-1].rows.append(row)
+                continue
+        else:
+            group = matrix_group(reader, row)
+            if group and group == current:
+                blocks[-1].lines.append(line)
+                blocks[-1].rows.append(row)
+                continue
+            current = group or None
+        blocks.append(Block([line], [row]))
+    return blocks
+
+
+def page_name(reader, row):
+    return reader.get_name(row['form_name'])
+
+
+def question_id(reader, row):
+    """ Returns the field ID the question of a non-matrix row gets """
+
+    field_name = reader.get_name(row['variable_field_name'])
+    if row['section_header']:
+        field_name = '%s_%s' % (
+            field_name,
+            reader.get_name(row['section_header']),
+        )
+    return field_name
+
+
+def match_fragments(reader, blocks, instrument, form):
+    """
+    Matches the elements and fields of a previous result to the blocks of
+    the data dictionary it was produced from.
+
+    :returns:
+        A fragment for every block, or None for blocks that need to be
+        converted again because they logged a warning
+    :raises Fallback: If the result doesn't match the data dictionary
+    """
+
+    elements = dict(
+        (page['id'], list(page.get('elements', [])))
+        for page in form.get('pages', [])
+    )
+    fields = list(instrument.get('record', []))
+
+    def take_element(page, element_type, field_id=None):
+        pending = elements.get(page)
+        if not pending or pending[0].get('type') != element_type:
+            return None
+        if field_id is not None and \
+                pending[0].get('options', {}).get('fieldId') != field_id:
+            return None
+        return pending.pop(0)
+
+    def take_field(field_id):
+        if not fields or fields[0].get('id') != field_id:
+            raise Fallback('Field %s not found' % (field_id,))
+        return fields.pop(0)
+
+    fragments = []
+    for block in blocks:
+        fragment = Fragment([], [], [])
+        group = None
+        for row in block.rows:
+            page = page_name(reader, row)
+            if row['field_type'] == 'calc':
+                if row['section_header']:
+                    element = take_element(page, 'header')
+                    if element is None:
+                        raise Fallback('Header not found')
+                    fragment.elements.append((page, element))
+                continue
+            if group is not None:
+                # Rows of a matrix add to its first question and field
+                continue
+            group = matrix_group(reader, row)
+            field_id = group or question_id(reader, row)
+            element = take_element(page, 'question', field_id)
+            if element is None:
+                if group:
+                    raise Fallback('Matrix %s not found' % (group,))
+                # The row was skipped with a warning
+                fragment = None
+                break
+            fragment.elements.append((page, element))
+            fragment.fields.append(take_field(field_id))
+        fragments.append(fragment)
+
+    if fields or any(elements.values()):
+        raise Fallback('Previous result has unmatched elements')
+    return fragments
+
+
+def convert_block(reader, localization, block):
+    """
+    Converts a block of rows the way ``redcap_to_rios`` does.
+
+    :raises Fallback:
+        If the block can't be converted on its own: it defines a
+        calculation, a matrix row is skipped, or conversion fails
+    """
+
+    from rios.conversion.base import structures
+    from rios.conversion.exception import ConversionValueError
+    from rios.conversion.exception import Error as ConversionError
+    from rios.conversion.redcap.to_rios import Processor
+
+    process = Processor(reader, localization)
+    elements = []
+    fields = []
+    warnings = []
+    for line, row in zip(block.lines, block.rows):
+        row = collections.OrderedDict(
+            (key, row[key]) for key in reader.attributes if key in row
+        )
+        page = structures.PageObject(id=page_name(reader, row))
+        try:
+            row_fields, calcs = process(page, row)
+            process.clear_storage()
+        except ConversionValueError as exc:
+            if len(block.rows) > 1:
+                raise Fallback('Matrix row skipped')
+            warnings.append(str(ConversionError(
+                "Skipping line: " + str(line) + ". Error:",
+                str(exc)
+            )))
+            continue
+        except Exception as exc:
+            raise Fallback(repr(exc))
+        if calcs:
+            raise Fallback('Calculations are converted from scratch')
+        elements.extend((page['id'], element) for element in page['elements'])
+        fields.extend(row_fields)
+    # Matrix rows modify the question and field of the first row, so the
+    # output is only final once the whole block is converted.
+    return Fragment(
+        [
+            (name, element.clean().as_dict())
+            for name, element in elements
+        ],
+        [field.clean().as_dict() for field in fields],
+        warnings,
+    )
+
+
+def validate_definitions(instrument, form):
+    """
+    Validates the spliced instrument and form like ``redcap_to_rios``
+    validates its output.
+
+    :raises Fallback: If they aren't valid
+    """
+
+    from rios.core import validate_form, validate_instrument
+    try:
+        validate_instrument(instrument)
+        validate_form(form, instrument=instrument)
+    except Exception as exc:
+        # The full conversion reports the error
+        raise Fallback(repr(exc))
+
+
+def definition_header(params):
+    """
+    Returns the instrument and the form definitions ``redcap_to_rios``
+    produces for the given parameters, without fields and pages.
+    """
+
+    from rios.conversion.redcap.to_rios import RedcapToRios
+    converter = RedcapToRios(
+        id=params['id'],
+        title=params['title'],
+        description=params['description'],
+        stream=params['stream'],
+        localization=params.get('localization'),
+        instrument_version=params.get('instrument_version'),
+    )
+    instrument = converter.instrument
+    form = converter.form
+    instrument.pop('record', None)
+    form.pop('pages', None)
+    return instrument, form
+
+
+def splice(previous, params):
+    """
+    Converts the data dictionary in ``params['stream']`` reusing the
+    fragments of the ``previous`` conversion.
+
+    :returns: The conversion payload and the number of converted blocks
+    :raises Fallback: If the dictionary has to be converted from scratch
+    """
+
+    from rios.conversion.base import SUCCESS_MESSAGE
+    from rios.conversion.utils import InMemoryLogger
+
+    header = definition_header(params)
+    previous_header = (
+        dict((key, value) for key, value in previous.instrument.items()
+             if key != 'record'),
+        dict((key, value) for key, value in previous.form.items()
+             if key != 'pages'),
+    )
+    if header != previous_header:
+        raise Fallback('Instrument or form attributes changed')
+
+    reader, rows = read_dictionary(params['stream'])
+    previous_reader, previous_rows = read_dictionary(previous.stream)
+    if reader.attributes != previous_reader.attributes:
+        raise Fallback('Data dictionary columns changed')
+    if not reader.attributes or \
+            reader.attributes[0] != 'variable_field_name' or \
+            'form_name' not in reader.attributes:
+        raise Fallback('Only current data dictionaries are supported')
+
+    # Diff the blocks by the variable names of their rows
+    previous_blocks = split_blocks(previous_reader, previous_rows)
+    try:
+        previous_fragments = match_fragments(
+            previous_reader,
+            previous_blocks,
+            previous.instrument,
+            previous.form,
+        )
+    except (AttributeError, KeyError, TypeError):
+        raise Fallback('Previous result is malformed')
+    reusable = {}
+    for block, fragment in zip(previous_blocks, previous_fragments):
+        if fragment is not None:
+            key = tuple(row['variable_field_name'] for row in block.rows)
+            reusable[key] = (block.rows, fragment)
+
+    fragments = []
+    converted = []
+    for block in split_blocks(reader, rows):
+        key = tuple(row['variable_field_name'] for row in block.rows)
+        if key in reusable and reusable[key][0] == block.rows:
+            reused = reusable[key][1]
+            if not previous.trusted and reused != convert_block(
+                    previous_reader, params.get('localization'), block):
+                raise Fallback('Previous result differs from its rows')
+            fragments.append(reused)
+        else:
+            converted.append(
+                convert_block(reader, params.get('localization'), block)
+            )
+            fragments.append(converted[-1])
+
+    # Checks that span blocks, which validating a delta can't see
+    fields = [field for fragment in fragments for field in fragment.fields]
+    field_ids = [field.get('id') for field in fields]
+    if not fields or len(set(field_ids)) != len(field_ids):
+        raise Fallback('Instrument fields are missing or not unique')
+
+    # Pages are ordered the way the converter's page dictionary orders them
+    page_names = set(page_name(reader, row) for row in rows)
+    pages = dict()
+    for name in page_names:
+        pages[name] = []
+    for fragment in fragments:
+        for page, element in fragment.elements:
+            pages[page].append(element)
+    if not all(pages.values()):
+        raise Fallback('Pages without elements')
+
+    logger = InMemoryLogger()
+    for fragment in fragments:
+        for warning in fragment.warnings:
+            logger.warning(warning)
+    logger.info(SUCCESS_MESSAGE)
+
+    instrument = dict(header[0], record=fields)
+    form = dict(header[1], pages=[
+        {'id': name, 'elements': elements}
+        for name, elements in pages.items()
+    ])
+    validate_definitions(instrument, form)
+    return {
+        'instrument': instrument,
+        'form': form,
+        'logs': logger.logs,
+    }, len(converted)
+
+
+def convert_incremental(previous, **params):
+    """
+    Converts a REDCap data dictionary like ``redcap_to_rios``, reusing the
+    output of a ``previous`` conversion for the rows that didn't change.
+
+    :param previous: The previous conversion
+    :type previous: Previous
+    :param params: The keyword arguments of ``redcap_to_rios``
+    :returns:
+        A pair: the conversion payload, and the number of blocks converted
+        or None if the whole dictionary was converted
+    :rtype: tuple
+    """
+
+    from rios.conversion import redcap_to_rios
+    try:
+        payload, converted = splice(previous, params)
+    except Fallback:
+        params['stream'].seek(0)
+        return redcap_to_rios(**params), None
+    return payload, converted
+
+
+def archive_members(path):
+    """
+    Iterates over the files of the zip or tar archive a session in ``path``
+    produced as (name, read) pairs, where ``read()`` returns the content of
+    the file while the iteration lasts.
+    """
+
+    if os.path.exists(os.path.join(path, 'output.zip')):
+        with zipfile.ZipFile(os.path.join(path, 'output.zip')) as archive:
+            for name in archive.namelist():
+                yield name, functools.partial(archive.read, name)
+    else:
+        with tarfile.open(os.path.join(path, 'output.tar')) as archive:
+            for member in archive:
+                yield member.name, archive.extractfile(member).read
+
+
+def load_previous_session(log_dir, session):
+    """
+    Loads a previous conversion to RIOS from its session directory in
+    ``log_dir``.
+
+    :raises Error: If the session isn't a successful REDCap conversion
+    """
+
+    path = os.path.join(log_dir, session)
+    if not os.path.exists(os.path.join(path, 'redcap_to_rios')) or not any(
+            os.path.exists(os.path.join(path, 'output.' + archive))
+            for archive in ('zip', 'tar')):
+        raise Error(
+            "Unknown REDCap conversion session:",
+            session
+        )
+    with open(os.path.join(path, 'uploaded_file_contents.log'), 'rb') as fp:
+        stream = cStringIO.StringIO(fp.read())
+    documents = {}
+    for name, read in archive_members(path):
+        base, extension = os.path.splitext(name)
+        if base[-2:] in ('_i', '_f') and extension in ('.yaml', '.json'):
+            load = load_yaml if extension == '.yaml' else load_json
+            documents[base[-1]] = load(read())
+    if set(documents) != set(['i', 'f']):
+        raise Error(
+            "No instrument and form in REDCap conversion session:",
+            session
+        )
+    return Previous(stream, documents['i'], documents['f'], trusted=True)
+
+
+def load_previous_upload(stream, instrument_file, form_file):
+    """
+    Loads a previous conversion to RIOS from uploaded files, whose
+    fragments are checked before they are reused.
+
+    :param stream: The previous data dictionary file object
+    :param instrument_file:
+        The file name and the file object of the previous instrument
+    :param form_file:
+        The file name and the file object of the previous form
+    :raises Error: If a definition can't be parsed
+    """
+
+    documents = []
+    for name, content in (instrument_file, form_file):
+        load = load_json if name.lower().endswith('.json') else load_yaml
+        content.seek(0)
+        try:
+            document = load(content.read())
+        except Exception as exc:
+            raise Error(
+                "Unable to parse previous RIOS definition %s:" % (name,),
+                str(exc)
+            )
+        if not isinstance(document, dict):
+            raise Error(
+                "Unable to parse previous RIOS definition:",
+                name
+            )
+        documents.append(document)
+    stream.seek(0)
+    return Previous(stream, *documents)
@@ -0,0 +1,337 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Streaming ingestion of multipart uploads.
+
+``cgi.FieldStorage`` reads a whole request body before any of it is looked
+at, and the steps after it (copying the uploads, hashing, logging, format
+detection) each read the uploaded files again. Instead, the body of a
+conversion request is parsed here as it is received, and every uploaded
+file passes once through a pipeline of stages: its content digest, a
+bounded prefix kept for format detection, a CSV row counter for CSV files
+and a spool to the scratch space.
+
+The parsed form is handed to webob as if it had parsed it itself, so
+commands get their parameters as usual; uploaded files are
+:class:`IngestedFile` values, which ``AttachmentVal`` takes as they are.
+"""
+
+
+import cgi
+import contextlib
+import hashlib
+import re
+
+
+from webob.exc import HTTPBadRequest
+from webob.multidict import MultiDict
+from .results import DIGEST_BLOCK_SIZE, combine_digests
+from .scratch import BLOCK_SIZE, get_scratch_space
+from .sniff import SNIFF_SIZE
+
+
+__all__ = (
+    'IngestedFile',
+    'ingest',
+    'ingest_multipart',
+    'parse_multipart',
+)
+
+
+# Maximum size of the headers of a part
+MAX_HEADER_SIZE = 1 << 14
+
+# Maximum size of a form field that isn't a file
+MAX_FIELD_SIZE = 1 << 20
+
+# Boundaries are 1 to 70 characters, see RFC 2046
+BOUNDARY = re.compile(
+    r'^[0-9A-Za-z\'()+_,./:=? -]{0,69}[0-9A-Za-z\'()+_,./:=?-]$'
+)
+
+# Uploads whose rows are counted
+CSV_EXTENSION = '.csv'
+CSV_MIME_TYPES = ('text/csv', 'application/csv')
+
+# Events of `parse_multipart`
+PART = 'part'
+DATA = 'data'
+END = 'end'
+
+
+class IngestedFile(object):
+    """
+    A file uploaded in a form field, spooled to the scratch file ``file``.
+
+    The file has the attributes ``content_digest``, ``prefix``, its first
+    ``SNIFF_SIZE`` bytes, and ``rows``, the number of CSV rows or None,
+    computed as it was received.
+    """
+
+    def __init__(self, name, filename, file):
+        self.name = name
+        self.filename = filename
+        self.file = file
+
+
+class ContentDigest(object):
+    """ Computes the `content_digest` of a file block by block """
+
+    def __init__(self):
+        self.digests = []
+        self.block = hashlib.sha1()
+        self.size = 0
+
+    def update(self, data):
+        while data:
+            chunk = data[:DIGEST_BLOCK_SIZE - self.size]
+            data = data[len(chunk):]
+            self.block.update(chunk)
+            self.size += len(chunk)
+            if self.size == DIGEST_BLOCK_SIZE:
+                self.digests.append(self.block.hexdigest())
+                self.block = hashlib.sha1()
+                self.size = 0
+
+    def close(self):
+        if self.size:
+            self.digests.append(self.block.hexdigest())
+        return combine_digests(self.digests)
+
+
+class PrefixBuffer(object):
+    """ Keeps the first ``SNIFF_SIZE`` bytes of a file """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def update(self, data):
+        if self.size < SNIFF_SIZE:
+            chunk = data[:SNIFF_SIZE - self.size]
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+
+    def close(self):
+        return ''.join(self.chunks)
+
+
+class RowCounter(object):
+    """
+    Counts the rows of a CSV file, i.e. its line breaks outside of quoted
+    values, plus an unterminated last row.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.quoted = False
+        self.last = ''
+
+    def update(self, data):
+        for idx, segment in enumerate(data.split('"')):
+            # Doubled quotes toggle twice, which leaves the state as is
+            if idx:
+                self.quoted = not self.quoted
+            if not self.quoted:
+                self.rows += segment.count('\n')
+        if data:
+            self.last = data[-1]
+
+    def close(self):
+        return self.rows + (1 if self.last not in ('', '\n') else 0)
+
+
+class Ingestion(object):
+    """ Passes the content of an uploaded file through the stages """
+
+    def __init__(self, scratch, index, name, filename, count_rows=False):
+        self.name = name
+        self.filename = filename
+        # Numbered, in case a field is repeated
+        self.file = scratch.open('%s.%d' % (name, index))
+        self.digest = ContentDigest()
+        self.prefix = PrefixBuffer()
+        self.rows = RowCounter() if count_rows else None
+
+    def write(self, data):
+        self.digest.update(data)
+        self.prefix.update(data)
+        if self.rows is not None:
+            self.rows.update(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.content_digest = self.digest.close()
+        self.file.prefix = self.prefix.close()
+        self.file.rows = self.rows.close() if self.rows is not None else None
+        return IngestedFile(self.name, self.filename, self.file)
+
+
+class FieldBuffer(object):
+    """ Collects the value of a form field that isn't a file """
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > MAX_FIELD_SIZE:
+            raise HTTPBadRequest(
+                'Form field %s is longer than %d bytes' % (
+                    self.name, MAX_FIELD_SIZE)
+            )
+        self.chunks.append(data)
+
+    def close(self):
+        try:
+            return ''.join(self.chunks).decode('utf-8')
+        except UnicodeDecodeError:
+            raise HTTPBadRequest('Form field %s is not UTF-8' % (self.name,))
+
+
+def parse_headers(block):
+    headers = {}
+    for line in block.split('\r\n'):
+        if not line:
+            continue
+        if ':' not in line:
+            raise HTTPBadRequest('Malformed multipart header')
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def parse_multipart(stream, boundary):
+    """
+    Parses a ``multipart/form-data`` body as it is read from ``stream``.
+
+    Yields ``('part', headers)`` at the start of every part, with a
+    dictionary of its headers by lowercase name, ``('data', bytes)`` for
+    its content, in blocks, and ``('end', None)`` at its end.
+
+    :raises HTTPBadRequest: If the body is malformed or truncated
+    """
+
+    # The first delimiter may come without its line break
+    delimiter = '\r\n--' + boundary
+    buffer = '\r\n'
+    in_part = False
+    state = DATA
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        buffer += block
+        while True:
+            if state == DATA:
+                pos = buffer.find(delimiter)
+                if pos < 0:
+                    # Keep what may be the start of a delimiter
+                    done = len(buffer) - len(delimiter) + 1
+                    if done > 0:
+                        if in_part:
+                            yield DATA, buffer[:done]
+                        buffer = buffer[done:]
+                    break
+                if in_part:
+                    if pos:
+                        yield DATA, buffer[:pos]
+                    yield END, None
+                    in_part = False
+                buffer = buffer[pos + len(delimiter):]
+                state = END
+            if state == END:
+                if buffer.startswith('--'):
+                    # The closing delimiter, the epilogue is ignored
+                    return
+                pos = buffer.find('\r\n')
+                if pos < 0:
+                    if len(buffer) > MAX_HEADER_SIZE:
+                        raise HTTPBadRequest('Malformed multipart delimiter')
+                    break
+                buffer = buffer[pos + 2:]
+                state = PART
+            if state == PART:
+                if buffer.startswith('\r\n'):
+                    # A part without headers
+                    pos = -2
+                else:
+                    pos = buffer.find('\r\n\r\n')
+                if pos == -1:
+                    if len(buffer) > MAX_HEADER_SIZE:
+                        raise HTTPBadRequest('Multipart headers too long')
+                    break
+                yield PART, parse_headers(buffer[:max(pos, 0)])
+                buffer = buffer[pos + 4:]
+                in_part = True
+                state = DATA
+        if not block:
+            raise HTTPBadRequest('Truncated multipart body')
+
+
+def is_csv(filename, headers):
+    content_type = cgi.parse_header(headers.get('content-type', ''))[0]
+    return filename.lower().endswith(CSV_EXTENSION) or \
+        content_type.lower() in CSV_MIME_TYPES
+
+
+def ingest_multipart(req, scratch):
+    """
+    Parses the ``multipart/form-data`` body of ``req`` as it is read,
+    spooling uploaded files to the :class:`ScratchDirectory` ``scratch``.
+
+    :returns: The form fields and :class:`IngestedFile` values by name
+    :rtype: ``webob.multidict.MultiDict``
+    """
+
+    boundary = cgi.parse_header(req.environ.get('CONTENT_TYPE', ''))[1] \
+        .get('boundary', '')
+    if not BOUNDARY.match(boundary):
+        raise HTTPBadRequest('Invalid multipart boundary')
+    fields = MultiDict()
+    current = None
+    for event, value in parse_multipart(req.body_file, boundary):
+        if event == PART:
+            params = cgi.parse_header(
+                value.get('content-disposition', ''))[1]
+            name = params.get('name', '')
+            filename = params.get('filename')
+            if filename:
+                current = Ingestion(
+                    scratch,
+                    len(fields),
+                    name,
+                    filename.decode('utf-8', 'replace'),
+                    count_rows=is_csv(filename, value),
+                )
+            else:
+                # A file input left empty is sent as an empty filename
+                current = FieldBuffer(name)
+        elif event == DATA:
+            current.write(value)
+        else:
+            fields.add(current.name, current.close())
+    return fields
+
+
+@contextlib.contextmanager
+def ingest(req):
+    """
+    Parses the body of a ``multipart/form-data`` POST as it is received,
+    making the form available as ``req.POST``. Uploaded files are spooled
+    to a scratch directory, which is removed after the block. Other
+    requests are left to webob.
+    """
+
+    if req.method != 'POST' or req.content_type != 'multipart/form-data':
+        yield
+        return
+    with get_scratch_space().request() as scratch:
+        fields = ingest_multipart(req, scratch)
+        # Where webob keeps the form it parsed
+        req.environ['webob._parsed_post_vars'] = (fields, req.body_file_raw)
+        yield
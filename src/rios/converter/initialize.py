@@ -3,20 +3,53 @@
 #
 
 
+import logging
 import os
 
 
 from rex.core import Error, Initialize, get_settings
+from rex.web import get_jinja
+from .assets import asset
+from .parallel import check_conversion_pool
+from .warmup import warm_up
 
 
 __all__ = ('ConverterInitialize',)
 
 
 class ConverterInitialize(Initialize):
-    """ Initialize log_dir directory to make sure it exists and is writable """
+    """
+    Initialize log_dir directory to make sure it exists and is writable,
+    make ``asset()`` available to templates, check the pool converting large
+    Qualtrics surveys, then warm up the application unless ``warmup`` is
+    disabled.
+
+    Initialization runs before the server forks its workers, so the workers
+    share the loaded modules and the compiled templates.
+    """
     def __call__(self):
-        log_dir = get_settings().log_dir
+        settings = get_settings()
+        log_dir = settings.log_dir
         if not os.path.isdir(log_dir):
             raise Error('Log Directory (%s) doesn\'t exist' % (log_dir,))
         if not os.access(log_dir, os.R_OK | os.W_OK | os.X_OK):
             raise Error('Log Directory (%s) not writable' % (log_dir,))
+
+        # Before the templates are compiled, which copies the globals
+        get_jinja().globals['asset'] = asset
+
+        check_conversion_pool()
+
+        if settings.warmup:
+            logger = logging.getLogger('rios.converter')
+            timings, errors = warm_up()
+            for step, exc in errors.items():
+                logger.warning('Warm-up step %s failed: %r', step, exc)
+            logger.info(
+                'Warmed up in %.2f s (%s)',
+                sum(timings.values()),
+                ', '.join(
+                    '%s: %.2f s' % (step, seconds)
+                    for step, seconds in timings.items()
+                ),
+            )
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Compact in-memory representation of parsed RIOS documents.
+
+A large form repeats the same localization keys (``en``), type names and
+enumeration IDs thousands of times, and often the same enumerations, each
+as objects of their own once parsed. :func:`intern_document` rebuilds a
+parsed document so that equal strings and numbers are one object and
+equal subtrees are one node, hash-consed bottom-up.
+
+Shared nodes are :class:`FrozenDict` and :class:`FrozenList` values, which
+``rios.core`` and ``rios.conversion`` take as dictionaries and lists, but
+which can't be modified, so that a change to one occurrence can't leak into
+the others. Copies of them are plain, mutable dictionaries and lists, as
+``rios.core`` modifies the copies it makes of type definitions.
+"""
+
+
+import copy
+
+
+__all__ = (
+    'FrozenDict',
+    'FrozenList',
+    'intern_document',
+)
+
+
+CONTAINERS = (dict, list)
+
+# Values copies of frozen nodes share, as they can't be modified either
+ATOMS = (str, unicode, int, long, float, bool, type(None))
+
+
+def immutable(self, *args, **kwargs):
+    raise TypeError('%s objects are immutable' % (type(self).__name__,))
+
+
+class FrozenDict(dict):
+    """ A dictionary that can't be modified """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = immutable
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        result = memo[id(self)] = {}
+        for key, value in self.iteritems():
+            result[key] = value if type(value) in ATOMS \
+                else copy.deepcopy(value, memo)
+        return result
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """ A list that can't be modified """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = \
+        __imul__ = append = extend = insert = pop = remove = reverse = \
+        sort = immutable
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        result = memo[id(self)] = []
+        for value in self:
+            result.append(value if type(value) in ATOMS
+                          else copy.deepcopy(value, memo))
+        return result
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def intern_document(document):
+    """
+    Returns a copy of a parsed JSON or YAML document in which equal scalars
+    are the same object and equal dictionaries and lists are the same
+    :class:`FrozenDict` or :class:`FrozenList`.
+    """
+
+    # Canonical objects by value; containers are keyed by the identities
+    # of their canonical items, which the table keeps alive. 1, 1.0 and
+    # True are equal, but are kept apart by their type.
+    table = {}
+    setdefault = table.setdefault
+
+    def share(value):
+        if isinstance(value, dict):
+            # Keys are hashable scalars
+            items = [
+                (setdefault((type(key), key), key),
+                 share(item) if isinstance(item, CONTAINERS)
+                 else share_scalar(item))
+                for key, item in value.iteritems()
+            ]
+            key = (dict, frozenset(
+                (id(item_key), id(item)) for item_key, item in items
+            ))
+            node = table.get(key)
+            if node is None:
+                node = table[key] = FrozenDict(items)
+            return node
+        if isinstance(value, list):
+            items = [
+                share(item) if isinstance(item, CONTAINERS)
+                else share_scalar(item)
+                for item in value
+            ]
+            key = (list, tuple(map(id, items)))
+            node = table.get(key)
+            if node is None:
+                node = table[key] = FrozenList(items)
+            return node
+        return share_scalar(value)
+
+    def share_scalar(value):
+        try:
+            return setdefault((type(value), value), value)
+        except TypeError:
+            # Unhashable values of YAML tags such as ``!!set`` are kept
+            return value
+
+    return share(document)
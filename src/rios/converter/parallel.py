@@ -0,0 +1,439 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Parallel conversion of large Qualtrics surveys.
+
+``qualtrics_to_rios`` converts every question of a survey on its own, then
+validates the whole instrument and form. The questions are therefore split
+into chunks, in the order the converter walks them, and a process pool
+converts and validates each chunk; the chunks are merged back in order.
+
+Whenever the result might differ from a serial conversion, e.g. if the
+survey is malformed, a question fails in an unexpected way or a chunk
+doesn't validate, the survey is converted serially with
+``qualtrics_to_rios``, so the output is always the same as its output.
+
+The chunks are built the way the internals of ``rios.conversion`` 0.6.1
+walk a survey, including the iteration order of its dictionaries. So the
+pool is only used once a synthetic survey converts the same in chunks and
+serially, which is checked at startup, see :func:`check_conversion_pool`.
+"""
+
+
+import cStringIO
+import logging
+import multiprocessing
+
+from rex.core import Error, cached, get_settings
+from .serialization import dump_json
+
+
+__all__ = (
+    'check_conversion_pool',
+    'check_pool',
+    'convert_qualtrics',
+    'get_conversion_pool',
+    'sample_survey',
+)
+
+
+# Number of questions a worker converts at a time
+CHUNK_SIZE = 50
+
+# Surveys with fewer questions are converted serially
+MIN_QUESTIONS = 2 * CHUNK_SIZE
+
+# Questions per page of `sample_survey`
+SAMPLE_PAGE_SIZE = 10
+
+
+class Fallback(Exception):
+    """ Raised when a survey has to be converted serially """
+
+
+def is_plain(value):
+    """
+    Checks that ``value`` only contains builtin types. Converter structures
+    left over by ``as_dict()`` can't be copied and fail validation.
+    """
+
+    if type(value) is dict:
+        return all(is_plain(item) for item in value.values())
+    if type(value) is list:
+        return all(is_plain(item) for item in value)
+    return value is None or \
+        isinstance(value, (basestring, bool, int, long, float))
+
+
+def page_questions(reader):
+    """
+    Lists the (page name, question ID, question data) triples of a survey
+    in the order ``QualtricsToRios`` converts them.
+
+    The converter keeps pages and their questions in dictionaries, which
+    are built here with the same operations so they iterate alike.
+    """
+
+    from rios.conversion.qualtrics.to_rios import PageName
+    question_data = reader.data['questions']
+    page_name = PageName()
+
+    page_question_map = {}
+    page_names = set()
+    name = page_name.next()
+    page_names.add(name)
+    for form_element in reader.data['block_elements']:
+        element_type = form_element.get('Type', None)
+        if element_type == 'Page Break':
+            name = page_name.next()
+            page_names.add(name)
+        elif element_type == 'Question':
+            question_id = form_element.get('QuestionID', None)
+            if question_id is None or question_id not in question_data:
+                raise Fallback('Unknown question')
+            elif name not in page_question_map:
+                page_question_map[name] = {
+                    question_id: question_data[question_id],
+                }
+            else:
+                page_question_map[name].update(
+                    {question_id: question_data[question_id]}
+                )
+        else:
+            raise Fallback('Unknown block element')
+
+    page_container = dict()
+    for name in page_names:
+        page_container.update({name: None})
+    if any(name not in page_question_map for name in page_container):
+        raise Fallback('Page without questions')
+    return [
+        (name, key, data)
+        for name in page_container
+        for key, data in page_question_map[name].items()
+    ]
+
+
+def validate_chunk(header, elements, fields):
+    """
+    Validates converted questions in a minimal instrument and form with the
+    definitions' header.
+
+    :raises Fallback: If they aren't valid
+    """
+
+    from rios.core import validate_form, validate_instrument
+    if not fields:
+        return
+    pages = []
+    for name, element in elements:
+        if not pages or pages[-1]['id'] != name:
+            pages.append({'id': name, 'elements': []})
+        pages[-1]['elements'].append(element)
+    instrument = dict(header[0], record=fields)
+    form = dict(header[1], pages=pages)
+    try:
+        validate_instrument(instrument)
+        validate_form(form, instrument=instrument)
+    except Exception as exc:
+        # The serial conversion reports the error
+        raise Fallback(repr(exc))
+
+
+def convert_chunk(args):
+    """
+    Converts and validates a chunk of questions in a worker process.
+
+    :returns:
+        The (page name, form element) pairs, the instrument fields and the
+        warnings of the chunk, or None if the survey has to be converted
+        serially
+    """
+
+    from rios.conversion.base import structures
+    from rios.conversion.exception import ConversionValueError, Error
+    from rios.conversion.qualtrics.to_rios import Processor
+
+    header, localization, questions = args
+    process = Processor(None, localization)
+    elements = []
+    fields = []
+    warnings = []
+    try:
+        for name, question_id, question_data in questions:
+            page = structures.PageObject(id=name)
+            try:
+                question_fields = process(page, question_data)
+                process.clear_storage()
+            except ConversionValueError as exc:
+                warnings.append(str(Error(
+                    "Skipping question: " + str(question_id) + ". Error:",
+                    str(exc)
+                )))
+                continue
+            question_elements = [
+                element.clean().as_dict()
+                for element in page['elements']
+            ]
+            question_fields = [
+                field.clean().as_dict()
+                for field in question_fields
+            ]
+            if not is_plain(question_elements) or \
+                    not is_plain(question_fields):
+                raise Fallback('Unserializable output')
+            elements.extend((name, element) for element in question_elements)
+            fields.extend(question_fields)
+        validate_chunk(header, elements, fields)
+    except Fallback:
+        return None
+    except Exception:
+        logging.getLogger('rios.converter').exception(
+            'Converting a chunk of questions failed')
+        return None
+    return elements, fields, warnings
+
+
+def definition_header(reader, params):
+    """
+    Returns the instrument and the form definitions ``qualtrics_to_rios``
+    produces for the given parameters, without fields and pages.
+    """
+
+    from rios.conversion import _JsonReaderMetaDataProcessor
+    from rios.conversion.qualtrics.to_rios import QualtricsToRios
+    metadata = {
+        'id': params.get('id'),
+        'title': params.get('title'),
+        'localization': params.get('localization'),
+        'description': params.get('description'),
+    }
+    if params.get('filemetadata'):
+        metadata_reader = _JsonReaderMetaDataProcessor(params['stream'])
+        metadata_reader.reader = reader.reader
+        metadata_reader.process()
+        metadata.update(metadata_reader.data)
+    elif None in (metadata['id'], metadata['title'],
+                  metadata['description']):
+        raise Fallback('Missing metadata')
+    converter = QualtricsToRios(
+        id=metadata['id'],
+        instrument_version=params.get('instrument_version'),
+        title=metadata['title'],
+        localization=metadata['localization'],
+        description=metadata['description'],
+        stream=params['stream'],
+    )
+    instrument = converter.instrument
+    form = converter.form
+    instrument.pop('record', None)
+    form.pop('pages', None)
+    return (instrument, form), converter.localization
+
+
+def convert_chunks(pool, params):
+    """
+    Converts a survey in chunks in ``pool``.
+
+    :raises Fallback: If the survey has to be converted serially
+    """
+
+    import simplejson
+    from rios.conversion.base import SUCCESS_MESSAGE
+    from rios.conversion.qualtrics.to_rios import JsonReaderMainProcessor
+    from rios.conversion.utils import InMemoryLogger
+
+    stream = params['stream']
+    stream.seek(0)
+    reader = JsonReaderMainProcessor(stream)
+    try:
+        # Parsed once for the metadata and the questions
+        reader.reader = simplejson.load(stream)
+        reader.process()
+        header, localization = definition_header(reader, params)
+        questions = page_questions(reader)
+    except Fallback:
+        raise
+    except Exception:
+        raise Fallback('Malformed survey')
+
+    if len(questions) < MIN_QUESTIONS:
+        raise Fallback('Small survey')
+    chunks = []
+    for chunk in pool.imap(convert_chunk, [
+            (header, localization, questions[start:start + CHUNK_SIZE])
+            for start in range(0, len(questions), CHUNK_SIZE)]):
+        if chunk is None:
+            raise Fallback('Chunk failed')
+        chunks.append(chunk)
+
+    # Checks that span chunks, which validating a chunk can't see
+    pages = dict((name, []) for name, _, _ in questions)
+    fields = []
+    for elements, chunk_fields, _ in chunks:
+        for name, element in elements:
+            pages[name].append(element)
+        fields.extend(chunk_fields)
+    field_ids = [field.get('id') for field in fields]
+    if not fields or len(set(field_ids)) != len(field_ids):
+        raise Fallback('Instrument fields are missing or not unique')
+    if not all(pages.values()):
+        raise Fallback('Pages without elements')
+
+    logger = InMemoryLogger()
+    for _, _, warnings in chunks:
+        for warning in warnings:
+            logger.warning(warning)
+    logger.info(SUCCESS_MESSAGE)
+
+    # Pages are in the order of the first question of each page
+    page_order = []
+    for name, _, _ in questions:
+        if not page_order or page_order[-1] != name:
+            page_order.append(name)
+    return {
+        'instrument': dict(header[0], record=fields),
+        'form': dict(header[1], pages=[
+            {'id': name, 'elements': pages[name]}
+            for name in page_order
+        ]),
+        'logs': logger.logs,
+    }
+
+
+def convert_qualtrics(pool, **params):
+    """
+    Converts a Qualtrics survey like ``qualtrics_to_rios``, in chunks of
+    questions converted by ``pool``.
+
+    :param pool: A ``multiprocessing`` process pool
+    :param params: The keyword arguments of ``qualtrics_to_rios``
+    :returns: The conversion payload
+    :rtype: dict
+    """
+
+    from rios.conversion import qualtrics_to_rios
+    try:
+        return convert_chunks(pool, params)
+    except Fallback:
+        params['stream'].seek(0)
+        return qualtrics_to_rios(**params)
+
+
+def sample_survey(questions):
+    """
+    Builds a Qualtrics survey of text entry and multiple choice questions,
+    with a page break every ``SAMPLE_PAGE_SIZE`` questions.
+    """
+
+    block_elements = []
+    elements = []
+    for idx in range(questions):
+        if idx and not idx % SAMPLE_PAGE_SIZE:
+            block_elements.append({'Type': 'Page Break'})
+        question_id = 'QID%d' % (idx + 1,)
+        block_elements.append({'Type': 'Question', 'QuestionID': question_id})
+        payload = {
+            'QuestionID': question_id,
+            'QuestionType': 'TE',
+            'QuestionText': 'Question %d' % (idx + 1,),
+            'QuestionDescription': 'Question %d' % (idx + 1,),
+            'DataExportTag': 'q%d' % (idx + 1,),
+        }
+        if idx % 2:
+            payload.update(QuestionType='MC', Choices={
+                '1': {'Display': 'Yes'},
+                '2': {'Display': 'No'},
+            })
+        elements.append({'Element': 'SQ', 'Payload': payload})
+    return {
+        'SurveyEntry': {
+            'SurveyID': 'SV_sample',
+            'SurveyName': 'Sample',
+            'SurveyDescription': 'Sample',
+            'SurveyLanguage': 'EN',
+        },
+        'SurveyElements': [{
+            'Element': 'BL',
+            'Payload': [{'Type': 'Default', 'BlockElements': block_elements}],
+        }] + elements,
+    }
+
+
+def check_pool(pool):
+    """
+    Converts a synthetic survey in chunks in ``pool`` and serially.
+
+    :raises Error:
+        If the outputs differ, i.e. ``rios.conversion`` no longer converts
+        surveys the way this module expects
+    """
+
+    from rios.conversion import qualtrics_to_rios
+    content = dump_json(sample_survey(MIN_QUESTIONS))
+    serial = qualtrics_to_rios(
+        stream=cStringIO.StringIO(content),
+        filemetadata=True,
+        suppress=True,
+    )
+    try:
+        chunked = convert_chunks(pool, {
+            'stream': cStringIO.StringIO(content),
+            'filemetadata': True,
+            'suppress': True,
+        })
+    except Fallback as exc:
+        chunked = {'failure': 'Converted serially: %s' % (exc,)}
+    if 'failure' in serial or chunked != serial:
+        raise Error(
+            "Qualtrics surveys can't be converted in chunks with this"
+            " version of rios.conversion:",
+            serial.get('failure') or chunked.get('failure') or
+            'The output differs from that of qualtrics_to_rios'
+        )
+
+
+@cached
+def check_conversion_pool():
+    """
+    Checks a pool of ``conversion_processes`` with :func:`check_pool`.
+
+    Called by ``ConverterInitialize`` before the server forks its workers,
+    so the check runs once. The pool is terminated after the check, since a
+    process pool doesn't survive a fork; each worker starts its own, see
+    :func:`get_conversion_pool`.
+
+    :returns:
+        True if large surveys can be converted in chunks, False if
+        ``conversion_processes`` is 0 or the check fails, which is logged
+    :rtype: bool
+    """
+
+    processes = get_settings().conversion_processes
+    if not processes:
+        return False
+    pool = multiprocessing.Pool(processes)
+    try:
+        check_pool(pool)
+    except Exception as exc:
+        logging.getLogger('rios.converter').error(
+            'Qualtrics surveys are converted serially: %s', exc)
+        return False
+    finally:
+        pool.terminate()
+    return True
+
+
+@cached
+def get_conversion_pool():
+    """
+    Returns the process pool converting large Qualtrics surveys, or None if
+    they are converted serially, see :func:`check_conversion_pool`.
+    """
+
+    if not check_conversion_pool():
+        return None
+    return multiprocessing.Pool(get_settings().conversion_processes)
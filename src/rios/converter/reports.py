@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Structured reports of failed data dictionary validations.
+
+A data dictionary with thousands of failing lines makes an error log of
+megabytes, which is slow to render and to display as a single page.
+Instead, the failures are kept in the session log as a CSV report, by line
+and column, next to a summary that counts them per column and per
+validator. The failure page shows the summary, the failures are served a
+page at a time from the stored report, and the whole report can be
+downloaded.
+
+The summary records where every page starts in the report, so a page is
+read without reading the pages before it.
+"""
+
+
+import collections
+import cStringIO
+import csv
+import itertools
+import os
+
+import simplejson
+
+
+__all__ = (
+    'PAGE_SIZE',
+    'REPORT_NAME',
+    'SUMMARY_NAME',
+    'StoredReport',
+    'ValidationReport',
+)
+
+
+# Names of the report and of its summary in the session log
+REPORT_NAME = 'validation_report.csv'
+SUMMARY_NAME = 'validation_report.json'
+
+# Number of failures per page
+PAGE_SIZE = 100
+
+HEADER = ('line', 'column', 'validator', 'message')
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class ValidationReport(object):
+    """
+    The failures of a data dictionary validation.
+
+    :param failures: (line, column, validator, message) tuples, in order
+    :type failures: list
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def counts(self, idx):
+        counts = collections.Counter(failure[idx] for failure in self.failures)
+        # Most frequent first
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def summary(self):
+        """ Returns the numbers of failures, failing lines and the counts """
+
+        return {
+            'failures': len(self.failures),
+            'lines': len(set(failure[0] for failure in self.failures)),
+            'columns': self.counts(1),
+            'validators': self.counts(2),
+        }
+
+    def dump(self):
+        """
+        Returns the report as CSV, and the summary, with the page size and
+        the offset of every page in the CSV.
+
+        :rtype: tuple
+        """
+
+        content = cStringIO.StringIO()
+        writer = csv.writer(content)
+        writer.writerow(HEADER)
+        offsets = []
+        for idx, failure in enumerate(self.failures):
+            if idx % PAGE_SIZE == 0:
+                offsets.append(content.tell())
+            writer.writerow([encode(value) for value in failure])
+        summary = self.summary()
+        summary.update(page_size=PAGE_SIZE, offsets=offsets)
+        content.seek(0)
+        return content, summary
+
+
+class StoredReport(object):
+    """ A validation report stored in the directory ``path`` """
+
+    def __init__(self, path):
+        self.path = path
+        self.report_path = os.path.join(path, REPORT_NAME)
+        with open(os.path.join(path, SUMMARY_NAME), 'rb') as fp:
+            self.summary = simplejson.load(fp)
+
+    @classmethod
+    def load(cls, path):
+        """ Returns the report stored in ``path`` or None """
+
+        try:
+            return cls(path)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @property
+    def pages(self):
+        return max(len(self.summary['offsets']), 1)
+
+    def page(self, number):
+        """
+        Returns the failures on page ``number``, counting from 1, as lists
+        of strings, or None past the last page.
+        """
+
+        offsets = self.summary['offsets']
+        if not offsets and number == 1:
+            return []
+        if not 1 <= number <= len(offsets):
+            return None
+        with open(self.report_path, 'rb') as fp:
+            fp.seek(offsets[number - 1])
+            reader = csv.reader(fp)
+            return [
+                [value.decode('utf-8') for value in row]
+                for row in itertools.islice(reader, self.summary['page_size'])
+            ]
+
+    def open(self):
+        """ Opens the CSV report """
+
+        return open(self.report_path, 'rb')
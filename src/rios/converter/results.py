@@ -0,0 +1,348 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+import collections
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import simplejson
+
+
+from rex.core import cached, get_settings
+from .scratch import hand_off
+
+
+__all__ = (
+    'DIGEST_BLOCK_SIZE',
+    'LRUCache',
+    'ResultStore',
+    'StoredResult',
+    'combine_digests',
+    'content_digest',
+    'file_digest',
+    'on_disk',
+    'get_conversion_cache',
+    'get_result_store',
+    'request_digest',
+    'upload_digest',
+)
+
+
+# Size of the blocks read while computing digests
+BLOCK_SIZE = 1 << 16
+
+# Size of the blocks of a content digest, see `content_digest`
+DIGEST_BLOCK_SIZE = 1 << 20
+
+# Minimum number of seconds between two sweeps of expired results
+PRUNE_INTERVAL = 600
+
+
+StoredResult = collections.namedtuple(
+    'StoredResult',
+    'etag filename path last_modified'
+)
+
+
+def request_digest(*parts):
+    """
+    Computes a hex digest over the given request parts.
+
+    Each part is length-prefixed so that adjacent parts can't be shifted into
+    one another. File-like parts contribute their `upload_digest`.
+
+    :param parts: Request parameters and uploaded file objects
+    :type parts: str, unicode, None, or file-like object
+    :returns: SHA-1 hex digest
+    :rtype: str
+    """
+
+    digest = hashlib.sha1()
+    for part in parts:
+        if hasattr(part, 'read'):
+            part = upload_digest(part)
+        elif part is None:
+            part = ''
+        elif isinstance(part, unicode):
+            part = part.encode('utf-8')
+        else:
+            part = str(part)
+        digest.update('%d:' % (len(part),))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def file_digest(bffr):
+    """ Returns the SHA-1 hex digest of a file's content and rewinds it """
+
+    bffr.seek(0)
+    digest = hashlib.sha1()
+    for block in iter(lambda: bffr.read(BLOCK_SIZE), ''):
+        digest.update(block)
+    bffr.seek(0)
+    return digest.hexdigest()
+
+
+def combine_digests(digests):
+    """ Combines the SHA-1 hex digests of consecutive blocks """
+
+    return hashlib.sha1(''.join(digests)).hexdigest()
+
+
+def content_digest(bffr):
+    """
+    Returns the digest identifying a file's content in request digests, and
+    rewinds the file: the SHA-1 hex digest of the SHA-1 hex digests of its
+    blocks of ``DIGEST_BLOCK_SIZE`` bytes. Unlike a plain digest, it can be
+    computed from blocks received out of order, as chunked uploads are.
+    """
+
+    bffr.seek(0)
+    digests = [
+        hashlib.sha1(block).hexdigest()
+        for block in iter(lambda: bffr.read(DIGEST_BLOCK_SIZE), '')
+    ]
+    bffr.seek(0)
+    return combine_digests(digests)
+
+
+def upload_digest(bffr):
+    """
+    Returns the `content_digest` of an uploaded file, as computed while it
+    was received if it has a ``content_digest`` attribute, otherwise by
+    reading and rewinding it.
+    """
+
+    return getattr(bffr, 'content_digest', None) or content_digest(bffr)
+
+
+def on_disk(content):
+    """
+    Returns the path of the file ``content`` is an open file of, flushing
+    it first, or None if it isn't a file on disk.
+    """
+
+    path = getattr(content, 'name', None)
+    if not isinstance(path, basestring) or not os.path.isfile(path):
+        return None
+    content.flush()
+    return path
+
+
+class ResultStore(object):
+    """
+    Retains produced output archives on disk.
+
+    Archives are kept under the SHA-1 digest of their content and filename,
+    which is also used as the ETag: the filename is served too, so outputs
+    that only differ in name, such as single CSV files, are distinct
+    results. A request index maps the digest of the conversion inputs to the
+    archive, so a repeated request is answered from disk without running
+    the conversion again.
+    """
+
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        self.last_pruned = 0
+
+    def archive_path(self, etag):
+        return os.path.join(self.path, 'archives', etag)
+
+    def index_path(self, key):
+        return os.path.join(self.path, 'requests', key)
+
+    def get(self, etag):
+        """ Returns the :class:`StoredResult` with the given ETag or None """
+
+        meta_path = self.archive_path(etag) + '.json'
+        try:
+            with open(meta_path, 'rb') as fp:
+                meta = simplejson.load(fp)
+            last_modified = os.path.getmtime(self.archive_path(etag))
+        except (IOError, OSError, ValueError):
+            return None
+        return StoredResult(
+            etag=etag,
+            filename=meta['filename'],
+            path=self.archive_path(etag),
+            last_modified=int(last_modified),
+        )
+
+    def lookup(self, key):
+        """ Returns the result previously stored for the request ``key`` """
+
+        try:
+            with open(self.index_path(key), 'rb') as fp:
+                etag = fp.read().strip()
+        except (IOError, OSError):
+            return None
+        return self.get(etag) if etag else None
+
+    def put(self, bffr, filename, key=None):
+        """
+        Stores the file in ``bffr`` and returns its :class:`StoredResult`.
+
+        The buffer is rewound afterwards. If ``key`` is given, it is indexed
+        so :meth:`lookup` finds the archive for the same request inputs.
+        """
+
+        etag = request_digest(file_digest(bffr), filename)
+        if not os.path.exists(self.archive_path(etag)):
+            self._write(self.archive_path(etag), bffr)
+            bffr.seek(0)
+            self._write(
+                self.archive_path(etag) + '.json',
+                simplejson.dumps({'filename': filename})
+            )
+        if key is not None:
+            self._write(self.index_path(key), etag)
+        self.prune()
+        return self.get(etag)
+
+    def open(self, result):
+        return open(result.path, 'rb')
+
+    def gzipped(self, result):
+        """
+        Returns the gzip-encoded variant of a :class:`StoredResult`, which
+        is compressed on first use and kept next to it, with its own ETag.
+        """
+
+        path = result.path + '.gz'
+        if not os.path.exists(path):
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path),
+                prefix='.',
+            )
+            with os.fdopen(fd, 'wb') as fp, self.open(result) as source:
+                with gzip.GzipFile(filename='', fileobj=fp, mode='wb',
+                                   mtime=0) as compressed:
+                    shutil.copyfileobj(source, compressed, BLOCK_SIZE)
+            os.rename(temp_path, path)
+        return result._replace(etag=result.etag + '-gzip', path=path)
+
+    def prune(self):
+        """ Removes results older than ``max_age`` seconds """
+
+        now = time.time()
+        if not self.max_age or now - self.last_pruned < PRUNE_INTERVAL:
+            return
+        self.last_pruned = now
+        for section in ('requests', 'archives'):
+            directory = os.path.join(self.path, section)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if now - os.path.getmtime(path) > self.max_age:
+                        os.remove(path)
+                except OSError:
+                    # Removed by a concurrent sweep
+                    pass
+
+    @staticmethod
+    def _write(path, content):
+        # Write to a temporary file first so that readers never see a
+        # partially written archive. Files on disk, such as scratch files,
+        # are handed off by a hard link, other file objects are copied in
+        # blocks.
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.')
+        source = on_disk(content)
+        if source is not None:
+            os.close(fd)
+            hand_off(source, temp_path)
+        else:
+            with os.fdopen(fd, 'wb') as fp:
+                if hasattr(content, 'read'):
+                    shutil.copyfileobj(content, fp, BLOCK_SIZE)
+                else:
+                    fp.write(content)
+        os.rename(temp_path, path)
+
+
+@cached
+def get_result_store():
+    """ Returns the application's :class:`ResultStore` """
+
+    settings = get_settings()
+    path = settings.result_dir
+    if path is None:
+        path = os.path.join(
+            settings.temp_dir or tempfile.gettempdir(),
+            'rios.converter',
+            'results'
+        )
+    return ResultStore(path, max_age=settings.result_max_age)
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache of at most ``size`` entries, counting its hits
+    and misses. Cached values must not be modified afterwards.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns a pair: whether ``key`` is cached, and its value """
+
+        with self.lock:
+            if key in self.entries:
+                # Move the entry to the most recently used end
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return True, value
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+@cached
+def get_conversion_cache():
+    """
+    Returns the application's :class:`LRUCache` of converted definitions,
+    before they are serialized.
+
+    Results are keyed by the digest of the conversion inputs, the upload
+    and the conversion parameters, but not the output format, so a request
+    for the same conversion in another format is only serialized.
+    """
+
+    return LRUCache(get_settings().conversion_cache_size)
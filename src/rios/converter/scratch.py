@@ -0,0 +1,293 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Scratch space for the files of a request.
+
+Every request gets a directory of its own under ``scratch_dir``, which may
+be on a tmpfs such as ``/dev/shm``. The directory is removed when the
+request ends; the directories of workers that died are removed by a
+periodic sweep. The bytes written to scratch files count against a
+per-request quota and against a quota for all the requests of the host.
+"""
+
+
+import contextlib
+import errno
+import os
+import re
+import shutil
+import tempfile
+import time
+
+
+from webob.exc import HTTPInsufficientStorage, HTTPRequestEntityTooLarge
+from rex.core import cached, get_settings
+
+
+__all__ = (
+    'ScratchDirectory',
+    'ScratchFile',
+    'ScratchSpace',
+    'get_scratch_space',
+    'hand_off',
+)
+
+
+# Size of the blocks uploads are copied in
+BLOCK_SIZE = 1 << 16
+
+# Minimum number of seconds between two sweeps of orphaned directories
+SWEEP_INTERVAL = 600
+
+# Seconds the global usage measured on disk is relied upon
+USAGE_INTERVAL = 1.0
+
+# Prefix of request directories, followed by the process ID
+PREFIX = 'request-'
+
+
+def safe_name(name):
+    """ Turns a client-supplied file name into a safe base name """
+
+    name = os.path.basename(name.replace('\\', '/'))
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name).lstrip('.')
+    return name or 'file'
+
+
+def hand_off(source, target):
+    """
+    Makes the file at ``source`` available at ``target`` by a hard link,
+    falling back to a copy across file systems. An existing ``target`` is
+    replaced.
+    """
+
+    try:
+        os.link(source, target)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            os.remove(target)
+            return hand_off(source, target)
+        shutil.copyfile(source, target)
+
+
+def directory_size(path):
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                # Removed by its request in the meantime
+                pass
+    return size
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+class ScratchFile(object):
+    """
+    An open file of a :class:`ScratchDirectory`, whose growth is charged to
+    the quotas as it is written.
+    """
+
+    def __init__(self, directory, path, fp):
+        self.directory = directory
+        self.path = path
+        self.name = path
+        self.fp = fp
+        self.size = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        end = self.fp.tell()
+        if end > self.size:
+            growth = end - self.size
+            self.size = end
+            self.directory.charge(growth)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def __iter__(self):
+        return iter(self.fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fp.close()
+
+
+class ScratchDirectory(object):
+    """ The scratch directory of a request """
+
+    def __init__(self, space, path):
+        self.space = space
+        self.path = path
+        self.used = 0
+
+    def charge(self, size):
+        """
+        Charges ``size`` more bytes to the quotas.
+
+        :raises HTTPRequestEntityTooLarge: Beyond the request quota
+        :raises HTTPInsufficientStorage: Beyond the global quota
+        """
+
+        self.used += size
+        self.space.charge(self, size)
+
+    def open(self, name, mode='w+b'):
+        """ Opens a new :class:`ScratchFile` under a safe form of ``name`` """
+
+        path = os.path.join(self.path, safe_name(name))
+        return ScratchFile(self, path, open(path, mode))
+
+    def save(self, name, stream):
+        """
+        Copies the content of ``stream`` to a new scratch file, block by
+        block, rewinds the stream and returns the path of the file.
+        """
+
+        stream.seek(0)
+        with self.open(name) as fp:
+            for block in iter(lambda: stream.read(BLOCK_SIZE), ''):
+                fp.write(block)
+        stream.seek(0)
+        return fp.path
+
+    def spool(self, max_size):
+        """
+        Returns a spooled temporary file, which is moved to the scratch
+        directory once it grows past ``max_size`` bytes.
+        """
+
+        return tempfile.SpooledTemporaryFile(max_size=max_size, dir=self.path)
+
+    def hand_off(self, name, target):
+        """ Links the scratch file ``name`` to ``target``, see `hand_off` """
+
+        hand_off(os.path.join(self.path, safe_name(name)), target)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ScratchSpace(object):
+    """
+    Hands out a scratch directory per request under ``path``.
+
+    :param request_quota:
+        Maximum number of bytes a request may write to its directory; 0
+        sets no limit
+    :param quota:
+        Maximum number of bytes in all the request directories under
+        ``path``, across workers; 0 sets no limit
+    :param max_age:
+        Seconds after which the directory of a running request is
+        considered orphaned as well
+    """
+
+    def __init__(self, path, request_quota=0, quota=0, max_age=None):
+        self.path = path
+        self.request_quota = request_quota
+        self.quota = quota
+        self.max_age = max_age
+        self.last_swept = 0
+        self.usage = None
+        self.measured = 0
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    @contextlib.contextmanager
+    def request(self):
+        """ Yields a new :class:`ScratchDirectory` and removes it after """
+
+        self.sweep()
+        directory = ScratchDirectory(self, tempfile.mkdtemp(
+            dir=self.path,
+            prefix='%s%d-' % (PREFIX, os.getpid()),
+        ))
+        try:
+            yield directory
+        finally:
+            directory.cleanup()
+            if self.usage is not None:
+                self.usage = max(self.usage - directory.used, 0)
+
+    def charge(self, directory, size):
+        if self.request_quota and directory.used > self.request_quota:
+            raise HTTPRequestEntityTooLarge(
+                'The request needs more than %d bytes of scratch space' % (
+                    self.request_quota,)
+            )
+        if not self.quota:
+            return
+        now = time.time()
+        if self.usage is None or now - self.measured > USAGE_INTERVAL:
+            # The bytes just written may not have been flushed yet
+            self.usage = directory_size(self.path) + size
+            self.measured = now
+        else:
+            self.usage += size
+        if self.usage > self.quota:
+            raise HTTPInsufficientStorage(
+                'The converter is out of scratch space, please try again'
+                ' later'
+            )
+
+    def sweep(self):
+        """
+        Removes the directories of requests whose worker is gone, or that
+        are older than ``max_age`` seconds.
+        """
+
+        now = time.time()
+        if now - self.last_swept < SWEEP_INTERVAL:
+            return
+        self.last_swept = now
+        for name in os.listdir(self.path):
+            if not name.startswith(PREFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                pid = int(name[len(PREFIX):].split('-', 1)[0])
+                age = now - os.path.getmtime(path)
+            except (ValueError, OSError):
+                continue
+            if not process_alive(pid) or \
+                    (self.max_age and age > self.max_age):
+                shutil.rmtree(path, ignore_errors=True)
+
+
+@cached
+def get_scratch_space():
+    """ Returns the application's :class:`ScratchSpace` """
+
+    settings = get_settings()
+    path = settings.scratch_dir
+    if path is None:
+        path = os.path.join(
+            settings.temp_dir or tempfile.gettempdir(),
+            'rios.converter',
+            'scratch'
+        )
+    return ScratchSpace(
+        path,
+        request_quota=settings.scratch_request_quota,
+        quota=settings.scratch_quota,
+        max_age=settings.scratch_max_age,
+    )
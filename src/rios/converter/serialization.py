@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+import simplejson
+
+
+__all__ = (
+    'HAS_JSON_SPEEDUPS',
+    'dump_json',
+    'dump_yaml',
+    'has_libyaml',
+    'load_json',
+    'load_yaml',
+    'yaml_backend',
+)
+
+
+try:
+    from simplejson import _speedups  # noqa:F401
+    HAS_JSON_SPEEDUPS = True
+except ImportError:
+    HAS_JSON_SPEEDUPS = False
+
+
+JSON_INDENT = '    '
+JSON_COMPACT_SEPARATORS = (',', ':')
+
+# Set by `yaml_backend` on first use
+_yaml_backend = None
+
+
+def yaml_backend():
+    """
+    Imports PyYAML on first use, which is slow to import.
+
+    :returns:
+        A triple: the ``yaml`` module, the fastest available emitter and the
+        fastest available safe loader
+    :rtype: tuple
+    """
+
+    global _yaml_backend
+    if _yaml_backend is None:
+        import yaml
+        # The libyaml emitter folds long, quoted, multi-line and non-ASCII
+        # strings differently from ``yaml.Dumper``, so `dump_yaml` only uses
+        # it in compact mode, whose output has no prior format to keep.
+        try:
+            from yaml import CDumper as dumper, CSafeLoader as loader
+        except ImportError:
+            from yaml import Dumper as dumper, SafeLoader as loader
+        _yaml_backend = (yaml, dumper, loader)
+    return _yaml_backend
+
+
+def has_libyaml():
+    """ Tells whether YAML is parsed, and written compact, with libyaml """
+
+    yaml, dumper, _ = yaml_backend()
+    return dumper is getattr(yaml, 'CDumper', None)
+
+
+def dump_yaml(payload, stream=None, compact=False, dumper=None,
+              *args, **kwargs):
+    """
+    Serializes ``payload`` as YAML. Returns a string if ``stream`` is None.
+
+    The default mode writes block style with ``yaml.Dumper``, as ``yaml.dump``
+    always has. The compact mode writes flow style on as few lines as
+    possible with the fastest available emitter.
+    """
+
+    yaml, fast_dumper, _ = yaml_backend()
+    if dumper is None:
+        dumper = fast_dumper if compact else yaml.Dumper
+    return yaml.dump(
+        payload,
+        stream,
+        Dumper=dumper,
+        default_flow_style=bool(compact),
+        *args,
+        **kwargs
+    )
+
+
+def load_yaml(stream, loader=None):
+    """ Parses a YAML document with the fastest available safe loader """
+
+    yaml, _, default_loader = yaml_backend()
+    return yaml.load(stream, Loader=loader or default_loader)
+
+
+def dump_json(payload, stream=None, compact=False, *args, **kwargs):
+    """
+    Serializes ``payload`` as JSON. Returns a string if ``stream`` is None.
+
+    The default mode sorts keys and indents by four spaces. The compact mode
+    does neither, which lets simplejson use its C encoder.
+    """
+
+    if compact:
+        kwargs.setdefault('separators', JSON_COMPACT_SEPARATORS)
+    else:
+        kwargs.setdefault('sort_keys', True)
+        kwargs.setdefault('indent', JSON_INDENT)
+    # Encode in one shot and write once; ``simplejson.dump`` would bypass
+    # the C encoder and write every chunk separately.
+    output = simplejson.dumps(payload, *args, **kwargs)
+    if stream is None:
+        return output
+    stream.write(output)
+
+
+def load_json(stream):
+    """ Parses a JSON document from a string or a file object """
+
+    if hasattr(stream, 'read'):
+        stream = stream.read()
+    return simplejson.loads(stream)
@@ -3,18 +3,59 @@
 #
 
 
-from rex.core import Setting, StrVal
+from rex.core import (
+    Setting,
+    StrVal,
+    MaybeVal,
+    IntVal,
+    FloatVal,
+    MapVal,
+    SeqVal,
+    BoolVal,
+)
 
 
 __all__ = (
     'TempDirSetting',
     'LogDirSetting',
+    'ResultDirSetting',
+    'ResultMaxAgeSetting',
+    'ScratchDirSetting',
+    'ScratchRequestQuotaSetting',
+    'ScratchQuotaSetting',
+    'ScratchMaxAgeSetting',
+    'UploadMaxAgeSetting',
+    'UploadMaxSizeSetting',
+    'ValidationMemoSizeSetting',
+    'ValidationThreadsSetting',
+    'ConversionProcessesSetting',
+    'ConversionLimitSetting',
+    'ConversionQueueLengthSetting',
+    'ConversionQueueSizeSetting',
+    'ConversionQueueTimeoutSetting',
+    'ConversionRetryAfterSetting',
+    'ConversionClientLimitSetting',
+    'ConversionClientRateSetting',
+    'ConversionClientWeightsSetting',
+    'ConversionClientTokensSetting',
+    'ReadinessMaxQueuedSetting',
+    'ReadinessMaxLatencySetting',
+    'ReadinessMinFreeSpaceSetting',
+    'ReadinessMinFreeMemorySetting',
+    'WarmupSetting',
+    'TraceSampleRateSetting',
+    'TraceFileSetting',
+    'ArchiveCompressionBudgetSetting',
+    'CompressionThreadsSetting',
+    'ConversionCacheSizeSetting',
 )
 
 
-# TODO: Determine if needed
 class TempDirSetting(Setting):
-    """ Directory with temporary data """
+    """
+    Directory with temporary data: the scratch space, retained results and
+    worker state, unless their own settings say otherwise
+    """
 
     name = 'temp_dir'
     default = None
@@ -26,3 +67,317 @@ class LogDirSetting(Setting):
 
     name = 'log_dir'
     validate = StrVal()
+
+
+class ResultDirSetting(Setting):
+    """
+    Dir to retain produced output archives for conditional and range requests.
+    Defaults to a ``rios.converter/results`` directory in ``temp_dir``.
+    """
+
+    name = 'result_dir'
+    default = None
+    validate = MaybeVal(StrVal())
+
+
+class ResultMaxAgeSetting(Setting):
+    """ Seconds to retain produced output archives; 0 retains them forever """
+
+    name = 'result_max_age'
+    default = 86400
+    validate = IntVal(min_bound=0)
+
+
+class ScratchDirSetting(Setting):
+    """
+    Dir for the files of running requests, one directory per request,
+    e.g. on a tmpfs such as ``/dev/shm``. Defaults to a
+    ``rios.converter/scratch`` directory in ``temp_dir``.
+    """
+
+    name = 'scratch_dir'
+    default = None
+    validate = MaybeVal(StrVal())
+
+
+class ScratchRequestQuotaSetting(Setting):
+    """ Bytes of scratch space a request may use; 0 sets no limit """
+
+    name = 'scratch_request_quota'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ScratchQuotaSetting(Setting):
+    """
+    Bytes of scratch space all the running requests may use together;
+    0 sets no limit
+    """
+
+    name = 'scratch_quota'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ScratchMaxAgeSetting(Setting):
+    """
+    Seconds after which a scratch directory is removed even if its worker
+    is still running
+    """
+
+    name = 'scratch_max_age'
+    default = 86400
+    validate = IntVal(min_bound=1)
+
+
+class ValidationMemoSizeSetting(Setting):
+    """ Number of RIOS validation outcomes to memoize per worker """
+
+    name = 'validation_memo_size'
+    default = 1024
+    validate = IntVal(min_bound=0)
+
+
+class ValidationThreadsSetting(Setting):
+    """
+    Threads per worker used to parse and validate uploaded RIOS files
+    concurrently; 0 parses and validates them one after another.
+    """
+
+    name = 'validation_threads'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ConversionProcessesSetting(Setting):
+    """
+    Processes per worker used to convert large Qualtrics surveys in chunks
+    of questions; 0 converts them in the worker itself.
+    """
+
+    name = 'conversion_processes'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ConversionLimitSetting(Setting):
+    """
+    Maximum number of conversions running at the same time across all
+    workers; 0 disables admission control
+    """
+
+    name = 'conversion_limit'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ConversionQueueLengthSetting(Setting):
+    """ Maximum number of conversions waiting for a free slot """
+
+    name = 'conversion_queue_length'
+    default = 8
+    validate = IntVal(min_bound=0)
+
+
+class ConversionQueueSizeSetting(Setting):
+    """ Maximum total upload size, in bytes, of the waiting conversions """
+
+    name = 'conversion_queue_size'
+    default = 64 * 1024 * 1024
+    validate = IntVal(min_bound=0)
+
+
+class ConversionQueueTimeoutSetting(Setting):
+    """ Seconds a conversion may wait for a free slot """
+
+    name = 'conversion_queue_timeout'
+    default = 30
+    validate = IntVal(min_bound=0)
+
+
+class ConversionRetryAfterSetting(Setting):
+    """ Base Retry-After, in seconds, sent when a conversion is refused """
+
+    name = 'conversion_retry_after'
+    default = 5
+    validate = IntVal(min_bound=1)
+
+
+class ConversionClientLimitSetting(Setting):
+    """ Maximum number of running conversions per client (0: no limit) """
+
+    name = 'conversion_client_limit'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ConversionClientRateSetting(Setting):
+    """
+    Upload bytes per second a client may convert while other clients are
+    waiting (0: no limit)
+    """
+
+    name = 'conversion_client_rate'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ConversionClientWeightsSetting(Setting):
+    """
+    Share of the conversion slots of clients by client key, e.g.
+    ``addr:10.0.0.5`` or ``token:<digest>`` as reported by the admission
+    statistics; clients not listed have weight 1
+    """
+
+    name = 'conversion_client_weights'
+    default = {}
+    validate = MapVal(StrVal(), IntVal(min_bound=1))
+
+
+class ConversionClientTokensSetting(Setting):
+    """
+    API tokens that identify clients when sent in the ``X-API-Token``
+    header; requests with other tokens, or none, are told apart by their
+    remote address
+    """
+
+    name = 'conversion_client_tokens'
+    default = []
+    validate = SeqVal(StrVal())
+
+
+class ConversionWorkerThreadsSetting(Setting):
+    """
+    Requests each worker process serves at the same time. A conversion
+    waits in the queue only if that leaves its worker a thread for other
+    requests, so with 1, the default, conversions that find no free slot
+    are refused at once; 0 lets them wait regardless.
+    """
+
+    name = 'conversion_worker_threads'
+    default = 1
+    validate = IntVal(min_bound=0)
+
+
+class ReadinessMaxQueuedSetting(Setting):
+    """
+    Number of queued conversions at which ``/ready`` reports the node as not
+    ready. Defaults to ``conversion_queue_length``, i.e. a full queue.
+    """
+
+    name = 'readiness_max_queued'
+    default = None
+    validate = MaybeVal(IntVal(min_bound=0))
+
+
+class ReadinessMaxLatencySetting(Setting):
+    """
+    Seconds of 95th percentile conversion latency above which ``/ready``
+    reports the node as not ready; 0 disables the check
+    """
+
+    name = 'readiness_max_latency'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ReadinessMinFreeSpaceSetting(Setting):
+    """
+    Bytes of free space in ``log_dir``, ``temp_dir`` and ``result_dir`` below
+    which ``/ready`` reports the node as not ready
+    """
+
+    name = 'readiness_min_free_space'
+    default = 64 * 1024 * 1024
+    validate = IntVal(min_bound=0)
+
+
+class ReadinessMinFreeMemorySetting(Setting):
+    """
+    Bytes of available host memory below which ``/ready`` reports the node
+    as not ready; 0 disables the check
+    """
+
+    name = 'readiness_min_free_memory'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class WarmupSetting(Setting):
+    """
+    Load the converters and validators, compile the templates and run a
+    sample conversion per system at startup, so the first request of a
+    worker isn't slower than the others
+    """
+
+    name = 'warmup'
+    default = True
+    validate = BoolVal()
+
+
+class TraceSampleRateSetting(Setting):
+    """
+    Fraction of requests whose spans are recorded and written to the
+    session log; every request gets a trace ID either way
+    """
+
+    name = 'trace_sample_rate'
+    default = 1.0
+    validate = FloatVal(min_bound=0.0, max_bound=1.0)
+
+
+class TraceFileSetting(Setting):
+    """ File to append the spans of all sampled requests to, as JSON lines """
+
+    name = 'trace_file'
+    default = None
+    validate = MaybeVal(StrVal())
+
+
+class UploadMaxAgeSetting(Setting):
+    """ Seconds a chunked upload is kept after its last chunk """
+
+    name = 'upload_max_age'
+    default = 86400
+    validate = IntVal(min_bound=1)
+
+
+class UploadMaxSizeSetting(Setting):
+    """ Bytes a chunked upload may have; 0 sets no limit """
+
+    name = 'upload_max_size'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ArchiveCompressionBudgetSetting(Setting):
+    """
+    Seconds that compressing the members of an output archive should take;
+    the deflate level is chosen to fit
+    """
+
+    name = 'archive_compression_budget'
+    default = 0.5
+    validate = FloatVal(min_bound=0.0)
+
+
+class CompressionThreadsSetting(Setting):
+    """
+    Number of threads compressing large archive members in pieces;
+    0 compresses them on the request thread
+    """
+
+    name = 'compression_threads'
+    default = 0
+    validate = IntVal(min_bound=0)
+
+
+class ConversionCacheSizeSetting(Setting):
+    """
+    Number of converted definitions kept in memory per worker, so that
+    requests for other output formats don't convert again
+    """
+
+    name = 'conversion_cache_size'
+    default = 32
+    validate = IntVal(min_bound=0)
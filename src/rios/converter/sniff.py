@@ -0,0 +1,183 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Classification of uploads from the first kilobytes of their content.
+
+Only a bounded prefix of an upload is read, so that a file of the wrong
+kind is routed or rejected before it is parsed in full.
+"""
+
+
+import codecs
+import csv
+import re
+
+
+from rex.core import Error
+
+
+__all__ = (
+    'SNIFF_SIZE',
+    'route_upload',
+    'sniff_upload',
+)
+
+
+# Number of bytes read from the start of an upload
+SNIFF_SIZE = 1 << 12
+
+# Kinds of uploads, see `sniff_upload`
+REDCAP = 'redcap'
+REDCAP_LEGACY = 'redcap_legacy'
+QUALTRICS = 'qualtrics'
+RIOS = 'rios'
+JSON = 'json'
+
+# Systems converted to RIOS, by kind
+KIND_SYSTEMS = {
+    REDCAP: 'redcap',
+    REDCAP_LEGACY: 'redcap',
+    QUALTRICS: 'qualtrics',
+}
+
+# First header cell of the REDCap data dictionary formats
+REDCAP_HEADERS = {
+    'Variable / Field Name': REDCAP,
+    'fieldID': REDCAP_LEGACY,
+}
+
+# Top-level keys of a QSF file
+QSF_KEYS = ('"SurveyEntry"', '"SurveyElements"')
+
+# RIOS definitions carry or reference an instrument URN
+RIOS_JSON = re.compile(r'"id"\s*:\s*"urn:')
+RIOS_YAML = re.compile(r'^\s*id:\s*[\'"]?urn:', re.MULTILINE)
+
+# MIME types libmagic reports for text files outside of ``text/*``
+TEXT_MIME_TYPES = (
+    'application/csv',
+    'application/json',
+    'application/x-empty',
+    'inode/x-empty',
+)
+
+
+def read_prefix(upload_file):
+    """
+    Returns the first ``SNIFF_SIZE`` bytes of a file: its ``prefix``
+    attribute if it was kept as the file was received, otherwise read from
+    the file, which is rewound.
+    """
+
+    prefix = getattr(upload_file, 'prefix', None)
+    if prefix is not None:
+        return prefix
+    upload_file.seek(0)
+    prefix = upload_file.read(SNIFF_SIZE)
+    upload_file.seek(0)
+    return prefix
+
+
+def describe(prefix):
+    """
+    Returns the MIME type of a binary prefix as identified by
+    ``python-magic``, or None if it is text or libmagic is unavailable.
+    """
+
+    try:
+        import magic
+        mime_type = magic.from_buffer(prefix, mime=True)
+    except Exception:
+        # The bindings are missing or libmagic can't be loaded
+        return None
+    if isinstance(mime_type, bytes):
+        mime_type = mime_type.decode('ascii', 'replace')
+    if mime_type.startswith('text/') or mime_type in TEXT_MIME_TYPES:
+        return None
+    return str(mime_type)
+
+
+def sniff_upload(upload_file):
+    """
+    Classifies an upload from its first ``SNIFF_SIZE`` bytes, less any
+    UTF-8 byte order mark.
+
+    :returns:
+        ``'redcap'`` or ``'redcap_legacy'`` for a REDCap data dictionary,
+        ``'qualtrics'`` for a QSF file, ``'rios'`` for a RIOS definition,
+        ``'json'`` for any other JSON object, or None if the kind can't be
+        told
+    :raises Error: If the upload is empty or isn't a text file
+    """
+
+    prefix = read_prefix(upload_file)
+    if prefix.startswith(codecs.BOM_UTF8):
+        # Excel starts the CSV files it saves with a byte order mark
+        prefix = prefix[len(codecs.BOM_UTF8):]
+    if not prefix.strip():
+        raise Error("The uploaded file is empty")
+    if '\0' in prefix:
+        error = Error("The uploaded file is not a text file")
+        mime_type = describe(prefix)
+        if mime_type is not None:
+            error.wrap("Got:", mime_type)
+        raise error
+
+    text = prefix.lstrip()
+    if text.startswith('{'):
+        if any(key in text for key in QSF_KEYS):
+            return QUALTRICS
+        elif RIOS_JSON.search(text):
+            return RIOS
+        return JSON
+    elif RIOS_YAML.search(text):
+        return RIOS
+
+    # Lines are read the way ``rios.conversion`` reads CSV files
+    lines = (re.sub(r'(\r\n)|(\r)', r'', line) for line in
+             prefix.splitlines(True))
+    try:
+        header = next(csv.reader(lines), [])
+    except csv.Error:
+        return None
+    return REDCAP_HEADERS.get(header[0] if header else None)
+
+
+def route_upload(system, upload_file):
+    """
+    Determines the system to convert an upload from, checking that it
+    matches ``system`` when one is given.
+
+    :param system: ``'redcap'``, ``'qualtrics'`` or None to detect it
+    :returns: The system to convert from
+    :raises Error: If the upload can't be converted from the system
+    """
+
+    kind = sniff_upload(upload_file)
+    if kind == RIOS:
+        error = Error("The uploaded file is a RIOS definition")
+        error.wrap("Convert it with:", "/convert/from/rios")
+        raise error
+    detected = KIND_SYSTEMS.get(kind)
+    if system is None:
+        if detected is None:
+            error = Error("Unable to detect the format of the uploaded file")
+            error.wrap(
+                "Expected:",
+                "A REDCap data dictionary or a Qualtrics QSF file"
+            )
+            raise error
+        return detected
+    # A QSF file whose top-level keys are past the prefix is plain JSON
+    if detected != system and not (system == 'qualtrics' and kind == JSON):
+        error = Error(
+            "The uploaded file is not a %s file" % (
+                'REDCap CSV' if system == 'redcap' else 'Qualtrics QSF',),
+        )
+        if detected is not None:
+            error.wrap("It looks like a file from:", detected)
+        raise error
+    return system
@@ -0,0 +1,248 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Per-request tracing.
+
+Every conversion request runs in a trace, whose ID is returned in the
+``X-Trace-Id`` header and is the session key the request is logged under in
+``log_dir``; session logs hold uploaded files, so IDs can't be guessed.
+The stages of a request run in nested spans recording their duration and
+attributes such as byte counts. The spans of a sampled trace are written as
+JSON lines to ``trace.jsonl`` in the session directory and to the
+``trace_file`` collector, if set.
+
+Spans are recorded in the thread that started the trace; stages run on a
+thread pool, such as pipelined RIOS validation, are covered by the span of
+the step that waits for them.
+"""
+
+
+import contextlib
+import datetime
+import functools
+import os
+import random
+import threading
+import time
+import uuid
+
+
+from rex.core import get_settings
+from .serialization import dump_json
+
+
+__all__ = (
+    'TRACE_HEADER',
+    'TRACE_ID_PATTERN',
+    'annotate',
+    'current_trace',
+    'current_trace_id',
+    'span',
+    'start_trace',
+    'traced',
+)
+
+
+# Response header carrying the trace ID
+TRACE_HEADER = 'X-Trace-Id'
+
+# Trace IDs, see `new_trace_id`
+TRACE_ID_PATTERN = r'^[0-9]{20}[0-9a-f]{32}$'
+
+# Spans of a trace are written to this file of the session directory
+TRACE_NAME = 'trace.jsonl'
+
+_local = threading.local()
+
+
+class Span(object):
+    """ A timed stage of a request """
+
+    def __init__(self, span_id, parent_id, name, attributes):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def as_dict(self, trace_id):
+        record = {
+            'trace_id': trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+        if self.error is not None:
+            record['error'] = self.error
+        return record
+
+
+class NullSpan(object):
+    """ Stands in for a span when the trace isn't sampled """
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Trace(object):
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+        self.stack = []
+
+    def open(self, name, attributes):
+        record = Span(
+            len(self.spans) + 1,
+            self.stack[-1].span_id if self.stack else None,
+            name,
+            attributes,
+        )
+        self.spans.append(record)
+        self.stack.append(record)
+        return record
+
+    def close(self, record):
+        record.duration = time.time() - record.start
+        self.stack.remove(record)
+
+    def dump(self):
+        return ''.join(
+            dump_json(record.as_dict(self.trace_id), compact=True) + '\n'
+            for record in self.spans
+        )
+
+
+def new_trace_id():
+    """
+    Returns a new trace ID. Like the session keys it replaces, it starts
+    with the current time down to microseconds, so session directories sort
+    by time; a random UUID follows, so that IDs are distinct and can't be
+    guessed.
+    """
+
+    return '%s%s' % (
+        datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),
+        uuid.uuid4().hex,
+    )
+
+
+def current_trace():
+    """ Returns the trace of the current thread or None """
+
+    return getattr(_local, 'trace', None)
+
+
+def current_trace_id():
+    """ Returns the ID of the current trace, or a new ID without one """
+
+    trace = current_trace()
+    if trace is None:
+        return new_trace_id()
+    return trace.trace_id
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Runs the block in a span of the current trace, nested in the innermost
+    open span. Yields the span, whose attributes can be added to with
+    ``set()``.
+    """
+
+    trace = current_trace()
+    if trace is None or not trace.sampled:
+        yield NULL_SPAN
+        return
+    record = trace.open(name, attributes)
+    try:
+        yield record
+    except Exception as exc:
+        record.error = exc.__class__.__name__
+        raise
+    finally:
+        trace.close(record)
+
+
+def annotate(**attributes):
+    """ Adds attributes to the innermost open span, if any """
+
+    trace = current_trace()
+    if trace is not None and trace.stack:
+        trace.stack[-1].set(**attributes)
+
+
+def export(trace):
+    """ Appends the spans of a trace to the session log and collector """
+
+    content = trace.dump()
+    settings = get_settings()
+    paths = []
+    session_dir = os.path.join(settings.log_dir, trace.trace_id)
+    if os.path.isdir(session_dir):
+        paths.append(os.path.join(session_dir, TRACE_NAME))
+    if settings.trace_file:
+        paths.append(settings.trace_file)
+    for path in paths:
+        try:
+            # A single write, so lines of concurrent workers don't mix
+            with open(path, 'ab') as fp:
+                fp.write(content)
+        except (IOError, OSError):
+            # Tracing never fails a request
+            pass
+
+
+@contextlib.contextmanager
+def start_trace(name, **attributes):
+    """
+    Starts a trace in the current thread, with a root span of the given
+    name. The trace is sampled at ``trace_sample_rate`` and exported when
+    the block exits. Yields the :class:`Trace`.
+    """
+
+    trace = Trace(
+        new_trace_id(),
+        random.random() < get_settings().trace_sample_rate,
+    )
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _local.trace = previous
+        if trace.sampled:
+            export(trace)
+
+
+def traced(name):
+    """
+    Decorates the ``render()`` method of a command so that each request runs
+    in a new trace, whose ID is set in the ``X-Trace-Id`` response header.
+    """
+
+    def decorate(render):
+        @functools.wraps(render)
+        def wrapper(self, req, *args, **kwargs):
+            with start_trace(name, method=req.method) as trace:
+                response = render(self, req, *args, **kwargs)
+            response.headers[TRACE_HEADER] = trace.trace_id
+            return response
+        return wrapper
+    return decorate
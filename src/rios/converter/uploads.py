@@ -0,0 +1,251 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+"""
+Resumable chunked uploads.
+
+A large file is uploaded in numbered chunks of ``CHUNK_SIZE`` bytes, each
+sent with its SHA-1 digest, so a chunk lost to a flaky connection is sent
+again on its own. The chunks of an upload are kept in a directory of their
+own under ``temp_dir``, in files named after their number and digest that
+any worker can list. Since the chunks are the blocks of the content digest
+used in request digests, the digest of an upload is combined from the
+digests of its chunks as they arrived, without reading the file again.
+
+Uploads are removed ``upload_max_age`` seconds after their last chunk.
+"""
+
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+
+from webob.exc import HTTPRequestEntityTooLarge
+from rex.core import Error, cached, get_settings
+from .results import DIGEST_BLOCK_SIZE, combine_digests
+from .scratch import BLOCK_SIZE
+from .tracing import span
+
+
+__all__ = (
+    'CHUNK_SIZE',
+    'ChunkedUpload',
+    'UploadStore',
+    'get_upload_store',
+)
+
+
+# Size of every chunk but the last; chunks are the blocks of the content
+# digest so that the digest of an upload can be combined from them
+CHUNK_SIZE = DIGEST_BLOCK_SIZE
+
+# Minimum number of seconds between two sweeps of expired uploads
+SWEEP_INTERVAL = 600
+
+# Upload IDs are random hex strings
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+# Chunk files are named after the chunk number and its SHA-1 digest
+CHUNK_NAME = re.compile(r'^(\d{6})\.([0-9a-f]{40})$')
+
+
+class ChunkedUpload(object):
+    """ The chunks received so far for an upload """
+
+    def __init__(self, store, upload_id, path):
+        self.store = store
+        self.upload_id = upload_id
+        self.path = path
+
+    def chunks(self):
+        """
+        Returns the received chunks as a dictionary of (digest, path) pairs
+        by chunk number.
+        """
+
+        chunks = {}
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            # Removed by a sweep in the meantime
+            return chunks
+        for name in names:
+            match = CHUNK_NAME.match(name)
+            if match is not None:
+                chunks[int(match.group(1))] = (
+                    match.group(2),
+                    os.path.join(self.path, name),
+                )
+        return chunks
+
+    def put(self, index, digest, stream):
+        """
+        Stores chunk ``index`` read from ``stream``, replacing a previous
+        copy of it.
+
+        :raises Error: If the chunk is empty, too large or its content
+            doesn't match ``digest``
+        :raises HTTPRequestEntityTooLarge: Beyond ``upload_max_size``
+        """
+
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='.')
+        checksum = hashlib.sha1()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for block in iter(lambda: stream.read(BLOCK_SIZE), ''):
+                    size += len(block)
+                    if size > CHUNK_SIZE:
+                        break
+                    checksum.update(block)
+                    fp.write(block)
+            if size == 0 or size > CHUNK_SIZE:
+                error = Error("Expected a chunk of 1 to %d bytes" % (
+                    CHUNK_SIZE,))
+                error.wrap("Got:", "%s bytes" % (
+                    size if size <= CHUNK_SIZE else 'more than %d' % (
+                        CHUNK_SIZE,),))
+                raise error
+            if checksum.hexdigest() != digest:
+                error = Error("The chunk doesn't match its SHA-1 digest")
+                error.wrap("Got:", checksum.hexdigest())
+                raise error
+            max_size = self.store.max_size
+            if max_size and index * CHUNK_SIZE + size > max_size:
+                raise HTTPRequestEntityTooLarge(
+                    'Uploads are limited to %d bytes' % (max_size,)
+                )
+            previous = self.chunks().get(index)
+            os.rename(
+                temp_path,
+                os.path.join(self.path, '%06d.%s' % (index, digest)),
+            )
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        if previous is not None and previous[0] != digest:
+            os.remove(previous[1])
+        # Uploads expire after their last chunk
+        os.utime(self.path, None)
+
+    def assemble(self, scratch, count):
+        """
+        Concatenates chunks 0 to ``count - 1`` into a file of the
+        :class:`ScratchDirectory` ``scratch``. The file is returned rewound,
+        with its `content_digest` in its ``content_digest`` attribute.
+
+        :raises Error: If chunks are missing or have the wrong size
+        """
+
+        chunks = self.chunks()
+        missing = [index for index in range(count) if index not in chunks]
+        if missing:
+            error = Error("The upload is missing chunks")
+            error.wrap("Missing:", ', '.join(
+                str(index) for index in missing[:20]))
+            raise error
+        if any(index >= count for index in chunks):
+            error = Error("The upload has more chunks than expected")
+            error.wrap("Expected:", str(count))
+            raise error
+        for index in range(count - 1):
+            if os.path.getsize(chunks[index][1]) != CHUNK_SIZE:
+                error = Error("Every chunk but the last must have %d bytes" % (
+                    CHUNK_SIZE,))
+                error.wrap("Got a shorter chunk:", str(index))
+                raise error
+
+        with span('assemble', chunks=count) as assembling:
+            upload_file = scratch.open('upload')
+            for index in range(count):
+                with open(chunks[index][1], 'rb') as fp:
+                    shutil.copyfileobj(fp, upload_file, BLOCK_SIZE)
+            assembling.set(bytes=upload_file.size)
+        upload_file.seek(0)
+        upload_file.content_digest = combine_digests(
+            chunks[index][0] for index in range(count)
+        )
+        return upload_file
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class UploadStore(object):
+    """
+    Keeps chunked uploads under ``path``.
+
+    :param max_age: Seconds an upload is kept after its last chunk
+    :param max_size: Maximum number of bytes of an upload; 0 sets no limit
+    """
+
+    def __init__(self, path, max_age=None, max_size=0):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.last_swept = 0
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def create(self):
+        """ Starts a new :class:`ChunkedUpload` """
+
+        self.sweep()
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.path, upload_id)
+        os.mkdir(path)
+        return ChunkedUpload(self, upload_id, path)
+
+    def get(self, upload_id):
+        """ Returns the :class:`ChunkedUpload` with the given ID or None """
+
+        if not UPLOAD_ID.match(upload_id):
+            return None
+        path = os.path.join(self.path, upload_id)
+        if not os.path.isdir(path):
+            return None
+        return ChunkedUpload(self, upload_id, path)
+
+    def sweep(self):
+        """ Removes uploads without new chunks for ``max_age`` seconds """
+
+        now = time.time()
+        if not self.max_age or now - self.last_swept < SWEEP_INTERVAL:
+            return
+        self.last_swept = now
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                # Removed by a concurrent sweep
+                continue
+            if age > self.max_age:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+@cached
+def get_upload_store():
+    """ Returns the application's :class:`UploadStore` """
+
+    settings = get_settings()
+    return UploadStore(
+        os.path.join(
+            settings.temp_dir or tempfile.gettempdir(),
+            'rios.converter',
+            'uploads'
+        ),
+        max_age=settings.upload_max_age,
+        max_size=settings.upload_max_size,
+    )
@@ -0,0 +1,487 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+import hashlib
+
+
+from rex.core import Error, cached, get_settings
+from .interning import intern_document
+from .results import LRUCache, upload_digest
+from .serialization import dump_json, load_json, load_yaml
+from .tracing import span
+
+
+__all__ = (
+    'ValidationMemo',
+    'check_upload',
+    'document_digest',
+    'get_redcap_validator',
+    'get_validation_memo',
+    'get_validation_pool',
+    'load_rios',
+    'load_and_validate_rios',
+    'parse_upload',
+    'pipeline_rios',
+    'validate_definition',
+    'validate_rios',
+    'validate_upload',
+)
+
+
+# RIOS definition types, in validation order
+RIOS_TYPES = ('Instrument', 'Form', 'Calculationset')
+
+# Validators by definition type, named after the ``rios.core`` functions,
+# which are only imported when a definition is validated. All but the
+# instrument validator take the instrument as well.
+RIOS_VALIDATORS = {
+    'Instrument': 'validate_instrument',
+    'Form': 'validate_form',
+    'Calculationset': 'validate_calculationset',
+}
+
+
+def get_redcap_validator(upload_file):
+    """
+    Determines the REDCap data dictionary format from the header row.
+
+    :returns: The CSV validator class for the data dictionary format
+    :raises Error: If the header isn't a known REDCap header
+    """
+
+    from rios.conversion.utils import CsvReader
+    from .csv_validation import (
+        RedcapLegacyCsvValidator,
+        RedcapModernCsvValidator,
+    )
+
+    reader = CsvReader(upload_file)
+    reader.load_attributes()
+    upload_file.seek(0)
+
+    first_field = reader.attributes[0]
+    if first_field == 'Variable / Field Name':
+        # Process new CSV format
+        return RedcapModernCsvValidator
+    elif first_field == 'fieldID':
+        # Process legacy CSV format
+        return RedcapLegacyCsvValidator
+    error = Error(
+        "Unknown input CSV header format. Got values:",
+        ", ".join(reader.attributes)
+    )
+    error.wrap(
+        "Expected first header/field name value to be:",
+        "\"Variable / Field Name\" or \"fieldID\""
+    )
+    raise error
+
+
+def validate_upload(system, upload_file):
+    """
+    Validates an uploaded REDCap data dictionary or Qualtrics QSF file.
+
+    :returns: None if the file is valid, otherwise the error log
+    :rtype: None or str
+    """
+
+    return check_upload(system, upload_file)[0]
+
+
+def check_upload(system, upload_file):
+    """
+    Validates an uploaded file like :func:`validate_upload`.
+
+    :returns:
+        A pair: None or the error log, and the
+        :class:`~rios.converter.reports.ValidationReport` of the lines of a
+        REDCap data dictionary that fail validation, if any
+    :rtype: tuple
+    """
+
+    with span('validate.upload', system=system) as validation:
+        errors, report = _validate_upload(system, upload_file)
+        validation.set(valid=errors is None)
+        if report is not None:
+            validation.set(failures=len(report.failures))
+    return errors, report
+
+
+def _validate_upload(system, upload_file):
+    upload_file.seek(0)
+    try:
+        if system == 'redcap':
+            from .csv_validation import StringLoader, failure_rows
+            from .reports import ValidationReport
+            try:
+                validator = get_redcap_validator(upload_file)
+            except Exception as exc:
+                return str(Error(
+                    "Unable to parse REDCap data dictionary. Got error:",
+                    (str(exc) if isinstance(exc, Error) else repr(exc))
+                )), None
+            checker = validator(StringLoader(upload_file))
+            result = checker()
+            if not result.validation:
+                # Unset if the file failed before its lines were validated
+                rows = failure_rows(
+                    getattr(checker, 'validators', {}),
+                    getattr(checker, 'failures', {}),
+                )
+                return result.log, (ValidationReport(rows) if rows else None)
+        else:  # system == 'qualtrics'
+            try:
+                load_json(upload_file)
+            except Exception as exc:
+                error = Error(
+                    "Qualtrics file validation failed:",
+                    "The file content is not valid JSON text"
+                )
+                error.wrap("Error:", str(exc))
+                error.wrap("Please try again with a valid QSF file")
+                return str(error), None
+    finally:
+        # Rewind file
+        upload_file.seek(0)
+    return None, None
+
+
+def load_rios(format, stream, interned=True):
+    """
+    Parses an uploaded RIOS YAML or JSON document.
+
+    The document is interned, see :func:`intern_document`, unless
+    ``interned`` is False; interned documents can't be modified.
+    """
+
+    if format == 'yaml':
+        document = load_yaml(stream)
+    else:  # JSON files
+        document = load_json(stream)
+    return intern_document(document) if interned else document
+
+
+def canonical_value(value):
+    """
+    Encodes the values JSON lacks, such as the dates of unquoted YAML
+    timestamps, for :func:`document_digest`.
+    """
+
+    encoded = value.isoformat() if hasattr(value, 'isoformat') \
+        else repr(value)
+    return {'!!%s' % (type(value).__name__,): encoded}
+
+
+def document_digest(document):
+    """ Returns the SHA-1 hex digest of a parsed document's canonical JSON """
+
+    return hashlib.sha1(
+        dump_json(document, compact=True, sort_keys=True,
+                  default=canonical_value)
+    ).hexdigest()
+
+
+class ValidationMemo(LRUCache):
+    """
+    LRU memo of RIOS validation outcomes.
+
+    Outcomes are keyed by the definition type, the canonical digest of the
+    definition and the digest of the instrument it was validated against.
+    The memo also remembers the canonical digest of raw uploads, so an
+    upload seen before doesn't need to be parsed to find its outcome.
+    """
+
+    def canonical(self, format, stream):
+        """ Returns the canonical digest of a raw upload seen before """
+
+        found, digest = self.get(('raw', format, upload_digest(stream)))
+        return digest if found else None
+
+    def remember(self, format, stream, document):
+        """ Computes and remembers the canonical digest of a raw upload """
+
+        digest = document_digest(document)
+        self.put(('raw', format, upload_digest(stream)), digest)
+        return digest
+
+    def outcome(self, digests):
+        """
+        Returns a pair: whether the outcome of validating the definitions
+        with the given canonical digests is memoized, and the outcome as
+        returned by :func:`validate_rios`.
+        """
+
+        instrument_digest = digests[0]
+        for val_type, digest in zip(RIOS_TYPES, digests):
+            if digest is None and val_type == 'Calculationset':
+                continue
+            found, message = self.get(
+                (val_type, digest, instrument_digest)
+            )
+            if not found:
+                return False, None
+            if message is not None:
+                return True, (val_type, message)
+        return True, None
+
+
+@cached
+def get_validation_memo():
+    """ Returns the application's :class:`ValidationMemo` """
+
+    return ValidationMemo(get_settings().validation_memo_size)
+
+
+def validate_definition(val_type, document, instrument, memo=None,
+                                                            key=None):
+    """
+    Validates a single RIOS definition of the given type.
+
+    :param key:
+        The memo key of the definition, see :meth:`ValidationMemo.outcome`.
+        Only used with ``memo``.
+    :returns: None if the definition is valid, otherwise the error message
+    :rtype: None or str
+    """
+
+    with span('validate.definition', type=val_type) as validation:
+        message = _validate_definition(val_type, document, instrument, memo,
+                                       key, validation)
+        validation.set(valid=message is None)
+    return message
+
+
+def _validate_definition(val_type, document, instrument, memo, key,
+                                                            validation):
+    if memo is not None:
+        found, message = memo.get(key)
+        if found:
+            validation.set(memo=True)
+            return message
+    import rios.core
+    validator = getattr(rios.core, RIOS_VALIDATORS[val_type])
+    try:
+        if val_type == 'Instrument':
+            validator(document)
+        else:
+            validator(document, instrument=instrument)
+    except rios.core.ValidationError as exc:
+        message = str(exc)
+    else:
+        message = None
+    if memo is not None:
+        memo.put(key, message)
+    return message
+
+
+def validate_rios(instrument, form, calculationset=None, memo=None,
+                                                        digests=None):
+    """
+    Validates RIOS definitions in order: the instrument first, then the form
+    and the calculationset against the instrument.
+
+    :param memo:
+        Memo of validation outcomes to consult and update. Definitions are
+        validated from scratch if None.
+    :type memo: ValidationMemo or None
+    :param digests:
+        Canonical digests of the instrument, form and calculationset, if they
+        are already known. Only used with ``memo``.
+    :type digests: list or None
+    :returns:
+        None if all definitions are valid, otherwise a pair of the failing
+        definition type (``Instrument``, ``Form`` or ``Calculationset``) and
+        the validation error message
+    :rtype: None or tuple
+    """
+
+    documents = (instrument, form, calculationset)
+    if memo is not None and digests is None:
+        digests = [
+            document_digest(document) if document is not None else None
+            for document in documents
+        ]
+    for idx, val_type in enumerate(RIOS_TYPES):
+        document = documents[idx]
+        if val_type == 'Calculationset' and not document:
+            continue
+        key = (val_type, digests[idx], digests[0]) if memo else None
+        message = validate_definition(
+            val_type,
+            document,
+            instrument,
+            memo=memo,
+            key=key,
+        )
+        if message is not None:
+            return (val_type, message)
+    return None
+
+
+def parse_upload(format, val_type, stream, memo=None):
+    """
+    Parses an uploaded RIOS definition and rewinds the upload.
+
+    :returns:
+        A triple: the parsed definition, its canonical digest if ``memo`` is
+        given, and the failure pair if it can't be parsed
+    :rtype: tuple
+    """
+
+    try:
+        with span('parse', type=val_type, format=format) as parsing:
+            document = load_rios(format, stream)
+            parsing.set(bytes=stream.tell())
+    except Exception as exc:
+        return None, None, (val_type, str(Error(
+            'Unable to parse %s file:' % (format.upper(),),
+            str(exc)
+        )))
+    finally:
+        # Rewind file object
+        stream.seek(0)
+    digest = None
+    if memo is not None:
+        digest = memo.remember(format, stream, document)
+    return document, digest, None
+
+
+def pipeline_rios(format, streams, memo, pool):
+    """
+    Parses and validates uploaded RIOS definitions on a thread ``pool``.
+
+    All uploads are parsed concurrently. The instrument is validated as soon
+    as it is parsed, and the form and the calculationset are validated
+    concurrently as soon as the instrument is known to be valid. Failures
+    are reported as if the steps had run one after another: parse failures
+    first, then validation failures, each in definition order.
+    """
+
+    parsing = [
+        pool.apply_async(parse_upload, (format, val_type, stream, memo))
+        if stream is not None else None
+        for val_type, stream in zip(RIOS_TYPES, streams)
+    ]
+
+    def validate_async(idx):
+        val_type = RIOS_TYPES[idx]
+        key = (val_type, digests[idx], digests[0]) if memo else None
+        return pool.apply_async(
+            validate_definition,
+            (val_type, documents[idx], documents[0], memo, key)
+        )
+
+    documents = [None, None, None]
+    digests = [None, None, None]
+    instrument_check = None
+    documents[0], digests[0], failure = parsing[0].get()
+    if failure is None:
+        instrument_check = validate_async(0)
+    parsed = [parsing[0].get()] + [
+        parse.get() if parse is not None else (None, None, None)
+        for parse in parsing[1:]
+    ]
+    for idx, (document, digest, parse_failure) in enumerate(parsed):
+        documents[idx] = document
+        digests[idx] = digest
+        failure = failure or parse_failure
+    if failure is not None:
+        return None, failure
+
+    message = instrument_check.get()
+    if message is not None:
+        return documents, (RIOS_TYPES[0], message)
+    checks = [
+        (RIOS_TYPES[idx], validate_async(idx))
+        for idx in (1, 2)
+        if idx == 1 or documents[idx]
+    ]
+    for val_type, check in checks:
+        message = check.get()
+        if message is not None:
+            return documents, (val_type, message)
+    return documents, None
+
+
+def load_and_validate_rios(format, streams, memo=None, parse=True,
+                                                            pool=None):
+    """
+    Parses and validates uploaded RIOS definitions.
+
+    With a ``memo``, definitions seen before aren't validated again, and if
+    ``parse`` is False, uploads seen before aren't even parsed. With a
+    thread ``pool``, the steps are pipelined, see :func:`pipeline_rios`.
+
+    :param streams:
+        The instrument, form and calculationset file objects. The
+        calculationset may be None.
+    :type streams: list
+    :returns:
+        A pair: the list of parsed definitions, or None if they weren't
+        parsed, and the outcome as returned by :func:`validate_rios`. A
+        definition that can't be parsed fails under its type.
+    :rtype: tuple
+    """
+
+    with span('validate.rios', format=format) as validation:
+        documents, failure = _load_and_validate_rios(format, streams, memo,
+                                                     parse, pool)
+        validation.set(valid=failure is None)
+    return documents, failure
+
+
+def _load_and_validate_rios(format, streams, memo, parse, pool):
+    if memo is not None and not parse:
+        digests = [
+            memo.canonical(format, stream) if stream is not None else None
+            for stream in streams
+        ]
+        if all(digest is not None
+               for digest, stream in zip(digests, streams)
+               if stream is not None):
+            found, failure = memo.outcome(digests)
+            if found:
+                return None, failure
+
+    if pool is not None:
+        return pipeline_rios(format, streams, memo, pool)
+
+    documents = []
+    digests = []
+    for val_type, stream in zip(RIOS_TYPES, streams):
+        if stream is None:
+            documents.append(None)
+            digests.append(None)
+            continue
+        document, digest, failure = parse_upload(
+            format,
+            val_type,
+            stream,
+            memo=memo,
+        )
+        if failure is not None:
+            return None, failure
+        documents.append(document)
+        digests.append(digest)
+
+    return documents, validate_rios(
+        memo=memo,
+        digests=digests if memo is not None else None,
+        *documents
+    )
+
+
+@cached
+def get_validation_pool():
+    """
+    Returns the thread pool for pipelined RIOS validation, or None if
+    ``validation_threads`` is 0.
+    """
+
+    from multiprocessing.pool import ThreadPool
+    threads = get_settings().validation_threads
+    if not threads:
+        return None
+    return ThreadPool(threads)
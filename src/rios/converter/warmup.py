@@ -0,0 +1,177 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+
+import collections
+import cStringIO
+import os
+import time
+
+
+from rex.core import get_packages
+from rex.web import get_jinja
+from .engine import build_archive, run_from_rios, run_to_rios
+from .serialization import dump_json
+
+
+__all__ = (
+    'warm_up',
+)
+
+
+# Smallest REDCap data dictionary the converters accept
+REDCAP_SAMPLE = (
+    'Variable / Field Name,Form Name,Section Header,Field Type,Field Label,'
+    'Choices OR Calculations,Field Note,'
+    'Text Validation Type OR Show Slider Number,Text Validation Min,'
+    'Text Validation Max,Identifier?,'
+    'Branching Logic (Show field only if...),Required Field?,'
+    'Custom Alignment,Question Number (surveys only)\r\n'
+    'record_id,warmup,,text,Record ID,,,,,,,,,,\r\n'
+    'answer,warmup,,radio,Answer,"1, Yes | 2, No",,,,,,,,,\r\n'
+)
+
+# Smallest Qualtrics survey the converters accept, with a text entry and a
+# multiple choice question
+QUALTRICS_SAMPLE = {
+    'SurveyEntry': {
+        'SurveyID': 'SV_warmup',
+        'SurveyName': 'Warm-up',
+        'SurveyDescription': 'Warm-up',
+        'SurveyLanguage': 'EN',
+    },
+    'SurveyElements': [
+        {
+            'Element': 'BL',
+            'Payload': [{
+                'Type': 'Default',
+                'BlockElements': [
+                    {'Type': 'Question', 'QuestionID': 'QID1'},
+                    {'Type': 'Question', 'QuestionID': 'QID2'},
+                ],
+            }],
+        },
+        {
+            'Element': 'SQ',
+            'Payload': {
+                'QuestionID': 'QID1',
+                'QuestionType': 'TE',
+                'QuestionText': 'Record ID',
+                'QuestionDescription': 'Record ID',
+                'DataExportTag': 'record_id',
+            },
+        },
+        {
+            'Element': 'SQ',
+            'Payload': {
+                'QuestionID': 'QID2',
+                'QuestionType': 'MC',
+                'QuestionText': 'Answer',
+                'QuestionDescription': 'Answer',
+                'DataExportTag': 'answer',
+                'Choices': {'1': {'Display': 'Yes'}, '2': {'Display': 'No'}},
+            },
+        },
+    ],
+}
+
+TEMPLATES = 'rios.converter:/templates'
+
+RST_SAMPLE = 'Warm-up\n=======\n\n*RIOS* converter.\n'
+
+
+def load_templates():
+    """ Compiles every template of the package into the Jinja cache """
+
+    jinja = get_jinja()
+    directory = get_packages().abspath(TEMPLATES)
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(('.html', '.rst')):
+            jinja.get_template('%s/%s' % (TEMPLATES, filename))
+
+
+def render_rst():
+    import docutils.core
+    docutils.core.publish_string(RST_SAMPLE, writer_name='html')
+
+
+def convert_samples():
+    """
+    Converts a tiny data dictionary from REDCap to RIOS and back to REDCap
+    and Qualtrics, which validates it with the ``props.csvtoolkit`` and
+    ``rios.core`` validators on the way, and a tiny survey from Qualtrics
+    to RIOS.
+    """
+
+    outcome = run_to_rios(
+        'qualtrics',
+        cStringIO.StringIO(dump_json(QUALTRICS_SAMPLE)),
+        'warmup',
+        format='json',
+    )
+    if outcome.stage is not None:
+        raise RuntimeError('\n'.join(outcome.errors))
+    build_archive(outcome.members)
+
+    outcome = run_to_rios(
+        'redcap',
+        cStringIO.StringIO(REDCAP_SAMPLE),
+        'warmup',
+        format='json',
+        instrument_title='Warm-up',
+        instrument_id='warmup',
+    )
+    if outcome.stage is not None:
+        raise RuntimeError('\n'.join(outcome.errors))
+    build_archive(outcome.members)
+    streams = [
+        cStringIO.StringIO(dump_json(payload))
+        for _, payload, data_type, _ in outcome.members
+        if data_type == 'json'
+    ]
+    for system in ('redcap', 'qualtrics'):
+        for stream in streams:
+            stream.seek(0)
+        outcome = run_from_rios(
+            system,
+            'json',
+            (streams + [None])[:3],
+            'warmup',
+        )
+        if outcome.stage is not None:
+            raise RuntimeError('\n'.join(outcome.errors))
+        build_archive(outcome.members)
+
+
+WARM_UP_STEPS = (
+    ('templates', load_templates),
+    ('docutils', render_rst),
+    ('conversions', convert_samples),
+)
+
+
+def warm_up():
+    """
+    Loads and initializes everything a first request would otherwise pay
+    for: the Jinja templates, docutils, the validators and the converters.
+
+    A failing step doesn't stop the others; it is up to the first request
+    to report the problem.
+
+    :returns:
+        The seconds each step took, by step, and the error of each failed
+        step, by step
+    :rtype: tuple
+    """
+
+    timings = collections.OrderedDict()
+    errors = collections.OrderedDict()
+    for name, step in WARM_UP_STEPS:
+        start = time.time()
+        try:
+            step()
+        except Exception as exc:
+            errors[name] = exc
+        timings[name] = time.time() - start
+    return timings, errors
@@ -1,6 +1,9 @@
+import os
+
 from rex.core import get_settings
 from rex.core import Rex
 from webob import Request
+from rios.converter.validation import ValidationMemo, load_and_validate_rios
 
 def test_pages():
     app = Rex(
@@ -85,3 +88,1257 @@ def test_rios_to_qualtrics():
     f_file.close()
     c_file.close()
     app.off()
+
+def test_result_conditional_requests():
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+
+    def convert():
+        with open('tests/redcap/format_1.csv') as input_file:
+            return Request.blank('/convert/to/rios', POST={
+                    'system': 'redcap',
+                    'format': 'yaml',
+                    'instrument_title': 'Test title',
+                    'instrument_id': 'id0',
+                    'outname': 'red2rio-cached',
+                    'infile': ('format_1.csv', input_file),
+                    }).get_response(app)
+
+    first = convert()
+    second = convert()
+    assert first.etag
+    assert first.etag == second.etag
+    assert first.last_modified == second.last_modified
+    assert first.body == second.body
+
+    req = Request.blank(first.content_location)
+    req.if_none_match = first.etag
+    assert req.get_response(app).status_int == 304
+
+    req = Request.blank(first.content_location)
+    req.range = (0, 10)
+    req.if_range = first.etag
+    response = req.get_response(app)
+    assert response.status_int == 206
+    assert response.body == first.body[:10]
+    app.off()
+
+def test_validate_only():
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+
+    with open('tests/redcap/format_1.csv') as input_file:
+        response = Request.blank('/validate/to/rios', POST={
+                'system': 'redcap',
+                'infile': ('format_1.csv', input_file),
+                }).get_response(app)
+    print response
+    assert response.content_type == 'application/json'
+    assert response.json['valid'] is True
+
+    i_file = open('tests/redcap/format_1_i.yaml')
+    f_file = open('tests/redcap/format_1_f.yaml')
+    response = Request.blank('/validate/from/rios', POST={
+                'format': 'yaml',
+                'instrument_file': ('format_1_i.yaml', i_file),
+                'form_file': ('format_1_f.yaml', f_file),
+                }).get_response(app)
+    i_file.close()
+    f_file.close()
+    print response
+    assert response.json['valid'] is True
+
+    # The instrument, uploaded as the form too, isn't a valid form
+    i_file = open('tests/redcap/format_1_i.yaml')
+    f_file = open('tests/redcap/format_1_i.yaml')
+    response = Request.blank('/validate/from/rios', POST={
+                'format': 'yaml',
+                'instrument_file': ('format_1_i.yaml', i_file),
+                'form_file': ('format_1_f.yaml', f_file),
+                }).get_response(app)
+    i_file.close()
+    f_file.close()
+    print response
+    assert response.json['valid'] is False
+    assert response.json['errors'][0]['source'] == 'Form'
+    app.off()
+
+
+def test_validation_memo():
+    memo = ValidationMemo(16)
+    streams = [
+        open('tests/redcap/format_1_i.yaml'),
+        open('tests/redcap/format_1_f.yaml'),
+        open('tests/redcap/format_1_c.yaml'),
+    ]
+    documents, failure = load_and_validate_rios('yaml', streams, memo=memo)
+    assert failure is None
+    assert memo.hits == 0
+
+    documents, failure = load_and_validate_rios(
+        'yaml', streams, memo=memo, parse=False)
+    assert documents is None
+    assert failure is None
+    assert memo.hits > 0
+
+    documents, failure = load_and_validate_rios(
+        'yaml', [streams[0], streams[0], None], memo=memo)
+    assert failure[0] == 'Form'
+    for stream in streams:
+        stream.close()
+
+    # Unquoted YAML dates fail validation, with or without the memo
+    import cStringIO
+    with open('tests/redcap/format_1_i.yaml') as stream:
+        content = stream.read().replace(
+            'title: format_1', 'title: format_1\ndescription: 2016-01-01')
+    for memo in (None, ValidationMemo(16)):
+        documents, failure = load_and_validate_rios(
+            'yaml', [cStringIO.StringIO(content), None, None], memo=memo)
+        assert failure[0] == 'Instrument'
+
+
+def test_pipelined_validation():
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(3)
+    names = [
+        ('format_1_i.yaml', 'format_1_f.yaml', 'format_1_c.yaml'),
+        ('format_1_i.yaml', 'format_1_i.yaml', None),
+        ('format_1_f.yaml', 'format_1_f.yaml', 'format_1_c.yaml'),
+    ]
+    for triple in names:
+        outcomes = []
+        for mode in (None, pool):
+            streams = [
+                open('tests/redcap/' + name) if name else None
+                for name in triple
+            ]
+            documents, failure = load_and_validate_rios(
+                'yaml', streams, pool=mode)
+            outcomes.append((documents, failure))
+            for stream in streams:
+                if stream:
+                    stream.close()
+        assert outcomes[0] == outcomes[1]
+    pool.close()
+
+
+def test_batch():
+    from rios.converter.batch import main
+    args = [
+        'from-rios', '--system', 'redcap', '-j', '1',
+        '-o', 'tests/sandbox/batch', 'tests/redcap',
+    ]
+    assert main(args) == 0
+    assert os.path.exists('tests/sandbox/batch/format_1.csv')
+    mtime = os.path.getmtime('tests/sandbox/batch/format_1.csv')
+    assert main(args) == 0
+    assert os.path.getmtime('tests/sandbox/batch/format_1.csv') == mtime
+
+    # An instrument without its form fails alone
+    import shutil
+    os.makedirs('tests/sandbox/batch_inputs')
+    for name in ('format_1_i.yaml', 'format_1_f.yaml'):
+        shutil.copy('tests/redcap/' + name, 'tests/sandbox/batch_inputs')
+    shutil.copy('tests/redcap/format_1_i.yaml',
+                'tests/sandbox/batch_inputs/orphan_i.yaml')
+    assert main([
+        'from-rios', '--system', 'qualtrics', '-j', '2',
+        '-o', 'tests/sandbox/batch_orphan', 'tests/sandbox/batch_inputs',
+    ]) == 1
+    assert sorted(os.listdir('tests/sandbox/batch_orphan')) == [
+        'format_1.txt',
+        'format_1_conversion_log.txt',
+    ]
+
+
+def test_admission():
+    from webob.exc import HTTPServiceUnavailable
+    from rios.converter.admission import AdmissionController
+    admission = AdmissionController(
+        'tests/sandbox/admission',
+        limit=1,
+        queue_length=0,
+        queue_size=0,
+        timeout=0,
+        retry_after=5,
+    )
+    with admission.admit(10):
+        assert admission.stats()['running'] == 1
+        try:
+            with admission.admit(10):
+                assert False, 'second conversion was admitted'
+        except HTTPServiceUnavailable as exc:
+            assert exc.headers['Retry-After'] == '5'
+    assert admission.stats()['running'] == 0
+
+    # A conversion doesn't take the last thread of its worker to wait
+    import time
+    admission = AdmissionController(
+        'tests/sandbox/admission',
+        limit=1,
+        queue_length=8,
+        queue_size=1024,
+        timeout=5,
+        retry_after=5,
+        worker_threads=2,
+    )
+    with admission.admit(10):
+        start = time.time()
+        try:
+            with admission.admit(10):
+                assert False, 'second conversion was admitted'
+        except HTTPServiceUnavailable:
+            assert time.time() - start < 1
+        assert admission.stats()['queued'] == 0
+    with admission.admit(10):
+        assert admission.stats()['running'] == 1
+
+
+def test_fair_scheduling():
+    from rios.converter.admission import (
+        AdmissionController,
+        Ticket,
+        client_key,
+        schedule,
+    )
+    tickets = [
+        Ticket('%03d' % (idx,), 10, client)
+        for idx, client in enumerate(['bulk'] * 4 + ['ui'] * 3)
+    ]
+
+    def clients(order):
+        return ''.join(ticket.client[0] for ticket in order)
+
+    assert clients(schedule(tickets, {})) == 'bububub'
+    assert clients(schedule(tickets, {}, vtimes={'bulk': 1.0})) == 'ubububb'
+    assert clients(schedule(tickets, {}, weights={'bulk': 2})) == 'bubbubu'
+    assert clients(schedule(tickets, {'bulk': 1}, client_limit=2)) == 'buu'
+    assert clients(schedule(tickets, {}, budgets={'bulk': 5})) == 'uuubbbb'
+
+    # Only issued tokens tell clients apart
+    from rios.converter import admission as admission_module
+    req = Request.blank('/', headers={'X-API-Token': 'issued'})
+    req.remote_addr = '10.0.0.5'
+    assert client_key(req, tokens=['issued']).startswith('token:')
+    assert client_key(req, tokens=[]) == 'addr:10.0.0.5'
+
+    # Budgets owe at most a burst, idle clients are forgotten
+    admission = AdmissionController(
+        'tests/sandbox/fair_admission',
+        limit=1,
+        queue_length=8,
+        queue_size=1024,
+        timeout=5,
+        retry_after=5,
+        client_rate=100,
+    )
+    admission.charge('bulk', 1 << 30)
+    assert admission.budgets()['bulk'] >= -100 * admission_module.RATE_BURST
+    admission.charge('ui', 10)
+    assert sorted(admission.states()) == ['bulk', 'ui']
+    client_idle = admission_module.CLIENT_IDLE
+    admission_module.CLIENT_IDLE = 0
+    try:
+        admission.charge('ui', 10)
+        assert sorted(admission.states()) == ['ui']
+    finally:
+        admission_module.CLIENT_IDLE = client_idle
+
+
+def test_readiness():
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+    response = Request.blank('/ready').get_response(app)
+    print response
+    assert response.status_int == 200
+    assert response.json['ready'] is True
+    assert 'log_dir' in response.json['free_space']
+
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir',
+        readiness_min_free_space=1 << 62,
+    )
+    app.on()
+    response = Request.blank('/ready').get_response(app)
+    print response
+    assert response.status_int == 503
+    assert response.json['ready'] is False
+    assert response.json['problems']
+
+
+def test_warm_up():
+    from rios.converter.warmup import warm_up
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir',
+        warmup=False,
+    )
+    app.on()
+    timings, errors = warm_up()
+    print timings, errors
+    assert list(timings) == ['templates', 'docutils', 'conversions']
+    assert not errors
+
+def test_incremental_conversion():
+    import cStringIO
+    from rios.conversion import redcap_to_rios
+    from rios.converter.incremental import Previous, convert_incremental
+
+    def params(content):
+        return {
+            'id': 'urn:test_incremental',
+            'title': 'Test title',
+            'description': '',
+            'stream': cStringIO.StringIO(content),
+            'localization': 'en',
+            'instrument_version': '1.0',
+            'suppress': True,
+        }
+
+    with open('tests/redcap/format_1.csv') as input_file:
+        lines = input_file.read().splitlines()
+    previous = '\r\n'.join(lines) + '\r\n'
+    result = redcap_to_rios(**params(previous))
+    assert 'failure' not in result
+
+    revisions = [
+        # A new label
+        [line.replace('Date of birth', 'Birth date') for line in lines],
+        # An added row and a deleted row
+        lines[:3] + ['nickname,demographics,,text,Nickname,,,,,,,,,,'] +
+        lines[3:7] + lines[8:],
+        # A new page
+        lines + ['followup,follow_up,,yesno,Follow up?,,,,,,,,,,'],
+        # A row the converter skips
+        [line.replace('sliderq,demographics,,slider',
+                      'sliderq,demographics,,descriptive') for line in lines],
+    ]
+    for revision in revisions:
+        content = '\r\n'.join(revision) + '\r\n'
+        for trusted in (True, False):
+            incremental, converted = convert_incremental(
+                Previous(cStringIO.StringIO(previous),
+                         result['instrument'], result['form'], trusted),
+                **params(content)
+            )
+            print converted
+            assert converted is not None
+            assert incremental == redcap_to_rios(**params(content))
+
+    # Uploaded fragments that don't match their rows aren't reused
+    import copy
+    instrument = copy.deepcopy(result['instrument'])
+    form = copy.deepcopy(result['form'])
+    instrument['record'][0]['required'] = 'maybe'
+    form['pages'][0]['elements'][0]['options']['text']['en'] = 'Tampered'
+    content = '\r\n'.join(revisions[0]) + '\r\n'
+    incremental, converted = convert_incremental(
+        Previous(cStringIO.StringIO(previous), instrument, form),
+        **params(content)
+    )
+    assert converted is None
+    assert incremental == redcap_to_rios(**params(content))
+
+    # Without a result store hit, every conversion gets a session
+    import shutil
+    import tempfile
+    result_dir = tempfile.mkdtemp()
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir',
+        result_dir=result_dir,
+    )
+    app.on()
+    try:
+        for archive in ('zip', 'tar'):
+            with open('tests/redcap/format_1.csv') as input_file:
+                response = Request.blank('/convert/to/rios', POST={
+                        'system': 'redcap',
+                        'format': 'yaml',
+                        'instrument_title': 'Test title',
+                        'instrument_id': 'incremental',
+                        'outname': 'incremental',
+                        'archive': archive,
+                        'infile': ('format_1.csv', input_file),
+                        }).get_response(app)
+            print response
+            session = response.headers['X-Conversion-Session']
+            assert os.path.exists(os.path.join(
+                'tests/sandbox/log_dir', session, 'output.' + archive))
+            response = Request.blank('/convert/to/rios', POST={
+                    'system': 'redcap',
+                    'format': 'yaml',
+                    'instrument_title': 'Test title',
+                    'instrument_id': 'incremental',
+                    'outname': 'incremental',
+                    'infile': ('format_1.csv', cStringIO.StringIO(
+                        '\r\n'.join(revisions[0]) + '\r\n')),
+                    'previous_session': session,
+                    }).get_response(app)
+            print response
+            assert response.status_int == 200
+            session = response.headers['X-Conversion-Session']
+            with open(os.path.join('tests/sandbox/log_dir', session,
+                                   'incremental.log')) as fp:
+                assert fp.read() != 'Converted from scratch'
+    finally:
+        app.off()
+        shutil.rmtree(result_dir)
+
+def test_parallel_conversion():
+    import cStringIO
+    import multiprocessing
+    import simplejson
+    from rex.core import Error
+    from rios.conversion import qualtrics_to_rios
+    from rios.converter import parallel
+
+    with open('tests/qualtrics/test_1.qsf') as input_file:
+        content = input_file.read()
+    # Without its display-only questions, which fail validation
+    survey = simplejson.loads(content)
+    display = set(
+        element['Payload']['QuestionID']
+        for element in survey['SurveyElements']
+        if element['Element'] == 'SQ'
+        and element['Payload']['QuestionType'] == 'DB'
+    )
+    for element in survey['SurveyElements']:
+        if element['Element'] == 'BL':
+            for block in element['Payload'].values():
+                block['BlockElements'] = [
+                    block_element
+                    for block_element in block['BlockElements']
+                    if block_element.get('QuestionID') not in display
+                    and block_element['Type'] != 'Page Break'
+                ]
+    questions_only = simplejson.dumps(survey)
+
+    pool = multiprocessing.Pool(2)
+    chunk_size = parallel.CHUNK_SIZE
+    min_questions = parallel.MIN_QUESTIONS
+    parallel.CHUNK_SIZE = 4
+    parallel.MIN_QUESTIONS = 4
+    try:
+        parallel.check_pool(pool)
+        sample = parallel.dump_json(parallel.sample_survey(12))
+        for survey_content in (questions_only, sample):
+            for params in (
+                    {'filemetadata': True},
+                    {'id': 'urn:test_q', 'title': 'Test title',
+                     'description': '', 'localization': 'en'}):
+                expected = qualtrics_to_rios(
+                    stream=cStringIO.StringIO(survey_content),
+                    suppress=True,
+                    **params
+                )
+                result = parallel.convert_qualtrics(
+                    pool,
+                    stream=cStringIO.StringIO(survey_content),
+                    suppress=True,
+                    **params
+                )
+                assert 'failure' not in expected
+                assert result == expected
+    finally:
+        parallel.CHUNK_SIZE = chunk_size
+        parallel.MIN_QUESTIONS = min_questions
+        pool.close()
+        pool.join()
+
+    # The pool is checked when the application starts
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir',
+        conversion_processes=2,
+        warmup=False,
+    )
+    app.on()
+    assert parallel.check_conversion_pool() is True
+    pool = parallel.get_conversion_pool()
+    assert pool is not None
+    pool.terminate()
+    app.off()
+
+    def check_pool(pool):
+        raise Error('The output differs from that of qualtrics_to_rios')
+
+    parallel.check_pool, check_pool = check_pool, parallel.check_pool
+    try:
+        app = Rex(
+            'rios.converter',
+            temp_dir='tests/sandbox',
+            log_dir='tests/sandbox/log_dir',
+            conversion_processes=2,
+            warmup=False,
+        )
+        app.on()
+        assert parallel.check_conversion_pool() is False
+        assert parallel.get_conversion_pool() is None
+        app.off()
+    finally:
+        parallel.check_pool = check_pool
+
+def test_streamed_csv_output():
+    import collections
+    import cStringIO
+    import zipfile
+    from rios.converter import engine
+
+    rows = [['id', 'label'], ['a', 'x, "y"']] + [
+        ['f%d' % (idx,), 'Field %d' % (idx,)] for idx in range(2000)
+    ]
+    expected = cStringIO.StringIO()
+    engine.write_to_buffer(expected, [list(rows)], 'csv')
+    members = [('out.csv', [collections.deque(rows)], 'csv', {})]
+    chunk_size = engine.CSV_CHUNK_SIZE
+    spool_size = engine.SPOOL_SIZE
+    engine.CSV_CHUNK_SIZE = 100
+    engine.SPOOL_SIZE = 1000
+    try:
+        archive = zipfile.ZipFile(engine.build_archive(members))
+        assert archive.read('out.csv') == expected.read()
+        assert members[0][1][0] == collections.deque()
+        expected.seek(0)
+        csv_file = engine.build_csv([iter(rows)])
+        assert csv_file.read() == expected.read()
+    finally:
+        engine.CSV_CHUNK_SIZE = chunk_size
+        engine.SPOOL_SIZE = spool_size
+
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+    responses = []
+    for single_file in ('false', 'true'):
+        with open('tests/redcap/format_1_i.yaml') as i_file, \
+                open('tests/redcap/format_1_f.yaml') as f_file:
+            responses.append(Request.blank('/convert/from/rios', POST={
+                    'system': 'redcap',
+                    'format': 'yaml',
+                    'instrument_file': ('format_1_i.yaml', i_file),
+                    'form_file': ('format_1_f.yaml', f_file),
+                    'outname': 'rio2red_single',
+                    'single_file': single_file,
+                    }).get_response(app))
+    archive, single = responses
+    assert archive.content_type == 'application/zip'
+    assert single.content_type == 'text/csv'
+    assert single.body == zipfile.ZipFile(
+        cStringIO.StringIO(archive.body)).read('rio2red_single.csv')
+
+    # The same file under another name is another result
+    with open('tests/redcap/format_1_i.yaml') as i_file, \
+            open('tests/redcap/format_1_f.yaml') as f_file:
+        renamed = Request.blank('/convert/from/rios', POST={
+                'system': 'redcap',
+                'format': 'yaml',
+                'instrument_file': ('format_1_i.yaml', i_file),
+                'form_file': ('format_1_f.yaml', f_file),
+                'outname': 'rio2red_renamed',
+                'single_file': 'true',
+                }).get_response(app)
+    assert renamed.body == single.body
+    assert renamed.etag != single.etag
+    assert 'filename=rio2red_renamed.csv' in \
+        renamed.headers['Content-Disposition']
+    response = Request.blank(single.content_location).get_response(app)
+    assert 'filename=rio2red_single.csv' in \
+        response.headers['Content-Disposition']
+    app.off()
+
+def test_sniff_upload():
+    import cStringIO
+    from rex.core import Error
+    from rios.converter.sniff import route_upload, sniff_upload
+
+    def upload(*paths):
+        return cStringIO.StringIO(''.join(open(path).read() for path in paths))
+
+    assert sniff_upload(upload('tests/redcap/format_1.csv')) == 'redcap'
+    assert sniff_upload(cStringIO.StringIO('fieldID,page\r\na,1\r\n')) \
+        == 'redcap_legacy'
+    assert sniff_upload(upload('tests/qualtrics/test_1.qsf')) == 'qualtrics'
+    assert sniff_upload(upload('tests/redcap/format_1_i.yaml')) == 'rios'
+    assert sniff_upload(upload('tests/redcap/format_1_f.yaml')) == 'rios'
+    assert sniff_upload(cStringIO.StringIO('{"id": "urn:a"}')) == 'rios'
+    assert sniff_upload(cStringIO.StringIO('[1, 2]')) is None
+    assert sniff_upload(cStringIO.StringIO(
+        '\xef\xbb\xbf' + open('tests/redcap/format_1.csv').read())) \
+        == 'redcap'
+
+    infile = upload('tests/redcap/format_1.csv')
+    infile.read(10)
+    assert route_upload(None, infile) == 'redcap'
+    assert infile.tell() == 0
+    assert route_upload('qualtrics', upload('tests/qualtrics/test_1.qsf')) \
+        == 'qualtrics'
+    for system, content in (
+            (None, ''),
+            (None, 'PK\x03\x04\x14\x00\x00\x00'),
+            (None, 'a,b,c\r\n'),
+            ('redcap', open('tests/qualtrics/test_1.qsf').read()),
+            ('qualtrics', open('tests/redcap/format_1.csv').read()),
+            ('redcap', open('tests/redcap/format_1_i.yaml').read()),
+            ('redcap', '{"questions": []}'),
+            ('redcap', 'a,b,c\r\n'),
+            ('redcap', '\xef\xbb\xbf')):
+        try:
+            route_upload(system, cStringIO.StringIO(content))
+        except Error as exc:
+            print exc
+        else:
+            assert False, content[:20]
+
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+    with open('tests/qualtrics/test_1.qsf') as input_file:
+        response = Request.blank('/validate/to/rios', POST={
+                'infile': ('test_1.qsf', input_file),
+                }).get_response(app)
+    assert '"system":"qualtrics"' in response.body
+    app.off()
+
+def test_json_api():
+    import cStringIO
+    import simplejson
+    import zipfile
+    from rios.conversion import rios_to_qualtrics
+    from rios.converter.engine import (
+        build_archive,
+        from_rios_members,
+        from_rios_params,
+    )
+    from rios.converter.validation import load_rios
+
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+
+    with open('tests/redcap/format_1.csv') as input_file:
+        req = Request.blank('/api/v1/convert/to/rios', POST={
+                'instrument_title': 'Test title',
+                'instrument_id': 'id0',
+                'infile': ('format_1.csv', input_file),
+                })
+        req.accept_encoding = 'gzip'
+        response = req.get_response(app)
+    assert response.status_int == 200
+    assert response.content_encoding == 'gzip'
+    response.decode_content()
+    report = simplejson.loads(response.body)
+    assert report['status'] == 'converted'
+    assert report['system'] == 'redcap'
+    assert report['documents']['instrument']['id'] == 'urn:id0'
+
+    with open('tests/redcap/format_1.csv') as input_file:
+        response = Request.blank('/api/v1/convert/to/rios', POST={
+                'infile': ('format_1.csv', input_file),
+                }).get_response(app)
+    assert response.status_int == 400
+    assert response.content_encoding is None
+    report = simplejson.loads(response.body)
+    assert report['status'] == 'invalid'
+    assert report['errors'][0]['source'] == 'parameters'
+
+    with open('tests/redcap/format_1_i.yaml') as i_file, \
+            open('tests/redcap/format_1_f.yaml') as f_file:
+        response = Request.blank('/api/v1/convert/from/rios', POST={
+                'system': 'redcap',
+                'format': 'yaml',
+                'instrument_file': ('format_1_i.yaml', i_file),
+                'form_file': ('format_1_f.yaml', f_file),
+                }).get_response(app)
+    report = simplejson.loads(response.body)
+    assert report['status'] == 'converted'
+    assert report['documents']['instrument'].startswith(
+        'Variable / Field Name,')
+
+    with open('tests/redcap/format_1_f.yaml') as i_file, \
+            open('tests/redcap/format_1_f.yaml') as f_file:
+        response = Request.blank('/api/v1/convert/from/rios', POST={
+                'system': 'redcap',
+                'format': 'yaml',
+                'instrument_file': ('format_1_f.yaml', i_file),
+                'form_file': ('format_1_f.yaml', f_file),
+                }).get_response(app)
+    assert response.status_int == 400
+    assert simplejson.loads(response.body)['errors'][0]['source'] \
+        == 'Instrument'
+
+    with open('tests/redcap/format_1.csv') as input_file:
+        lines = input_file.read().split('\n')
+    fields = lines[2].split(',')
+    lines[2] = ','.join(fields[:1] + [''] + fields[2:])
+    for path in ('/api/v1/convert/to/rios', '/validate/to/rios'):
+        response = Request.blank(path, POST={
+                'system': 'redcap',
+                'instrument_title': 'Test title',
+                'instrument_id': 'id0',
+                'infile': ('format_1.csv',
+                           cStringIO.StringIO('\n'.join(lines))),
+                }).get_response(app)
+        error = simplejson.loads(response.body)['errors'][0]
+        assert error['source'] == 'redcap'
+        assert error['line'] == 3
+        assert error['column'] and error['validator'] and error['message']
+
+    with open('tests/redcap/format_1_i.yaml') as i_file, \
+            open('tests/redcap/format_1_f.yaml') as f_file:
+        response = Request.blank('/api/v1/convert/from/rios', POST={
+                'system': 'qualtrics',
+                'format': 'yaml',
+                'instrument_file': ('format_1_i.yaml', i_file),
+                'form_file': ('format_1_f.yaml', f_file),
+                }).get_response(app)
+    instrument = simplejson.loads(response.body)['documents']['instrument']
+    app.off()
+
+    documents = [
+        load_rios('yaml', open('tests/redcap/format_1_%s.yaml' % (name,)))
+        for name in ('i', 'f')
+    ]
+    result = rios_to_qualtrics(**from_rios_params(*documents))
+    archive = zipfile.ZipFile(build_archive(
+        from_rios_members(result, 'instrument', 'qualtrics')))
+    assert archive.read('instrument.txt') == instrument
+    assert instrument.startswith('[[PageBreak]]\n')
+
+def test_tracing():
+    import simplejson
+
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir',
+        trace_file='tests/sandbox/traces.jsonl',
+    )
+    app.on()
+    with open('tests/redcap/format_1.csv') as input_file:
+        response = Request.blank('/convert/to/rios', POST={
+                'system': 'redcap',
+                'format': 'json',
+                'instrument_title': 'Test title',
+                'instrument_id': 'id0',
+                'outname': 'red2rio_traced',
+                'infile': ('format_1.csv', input_file),
+                }).get_response(app)
+    trace_id = response.headers['X-Trace-Id']
+    assert trace_id == response.headers['X-Conversion-Session']
+    path = os.path.join('tests/sandbox/log_dir', trace_id, 'trace.jsonl')
+    with open(path) as trace_file:
+        spans = [simplejson.loads(line) for line in trace_file]
+    names = [span['name'] for span in spans]
+    for name in ('convert.to_rios', 'validate.upload', 'convert',
+                 'build_archive', 'write_to_zip', 'log', 'store'):
+        assert name in names
+    assert spans[0]['parent_id'] is None
+    assert all(span['trace_id'] == trace_id for span in spans)
+    assert all(span['parent_id'] for span in spans[1:])
+    with open('tests/sandbox/traces.jsonl') as collector:
+        assert any(trace_id in line for line in collector)
+    app.off()
+
+def test_scratch_space():
+    import cStringIO
+    import shutil
+    import zipfile
+    from webob.exc import HTTPInsufficientStorage, HTTPRequestEntityTooLarge
+    from rios.converter.engine import build_archive
+    from rios.converter.results import ResultStore
+    from rios.converter.scratch import ScratchSpace
+
+    space = ScratchSpace('tests/sandbox/scratch', request_quota=1000)
+    with space.request() as scratch:
+        path = scratch.save('../../passwd', cStringIO.StringIO('x' * 500))
+        assert os.path.dirname(path) == scratch.path
+        try:
+            scratch.save('more', cStringIO.StringIO('y' * 600))
+        except HTTPRequestEntityTooLarge:
+            pass
+        else:
+            assert False
+    assert not os.path.exists(scratch.path)
+
+    space = ScratchSpace('tests/sandbox/scratch', quota=1500)
+    with space.request() as first, space.request() as second:
+        first.save('first', cStringIO.StringIO('x' * 1000))
+        try:
+            second.save('second', cStringIO.StringIO('y' * 600))
+        except HTTPInsufficientStorage:
+            pass
+        else:
+            assert False
+
+    shutil.rmtree('tests/sandbox/scratch_results', ignore_errors=True)
+    store = ResultStore('tests/sandbox/scratch_results')
+    with space.request() as scratch:
+        archive = build_archive(
+            [('out.csv', [[['a', 'b'], ['c', 'd']]], 'csv', {})],
+            scratch=scratch,
+        )
+        stored = store.put(archive, 'out.zip')
+        # Handed off by a hard link
+        assert os.stat(stored.path).st_nlink == 2
+    with open(stored.path, 'rb') as stored_file:
+        assert zipfile.ZipFile(stored_file).read('out.csv') == 'a,b\r\nc,d\r\n'
+
+def test_chunked_upload():
+    import cStringIO
+    import hashlib
+    import simplejson
+    from rex.core import Error
+    from rios.converter.results import content_digest, request_digest
+    from rios.converter.scratch import ScratchSpace
+    from rios.converter.uploads import CHUNK_SIZE, UploadStore
+
+    store = UploadStore('tests/sandbox/uploads')
+    upload = store.create()
+    content = ''.join(chr(idx % 251) for idx in range(CHUNK_SIZE * 5 / 2))
+    chunks = [content[start:start + CHUNK_SIZE]
+              for start in range(0, len(content), CHUNK_SIZE)]
+    for index in (2, 0, 1, 0):
+        upload.put(index, hashlib.sha1(chunks[index]).hexdigest(),
+                   cStringIO.StringIO(chunks[index]))
+    assert sorted(upload.chunks()) == [0, 1, 2]
+    try:
+        upload.put(1, hashlib.sha1('x').hexdigest(),
+                   cStringIO.StringIO(chunks[1]))
+    except Error:
+        pass
+    else:
+        assert False
+    with ScratchSpace('tests/sandbox/scratch').request() as scratch:
+        upload_file = upload.assemble(scratch, 3)
+        assert upload_file.read() == content
+        upload_file.seek(0)
+        assert upload_file.content_digest == \
+            content_digest(cStringIO.StringIO(content))
+        assert request_digest(upload_file) == \
+            request_digest(cStringIO.StringIO(content))
+        try:
+            upload.assemble(scratch, 4)
+        except Error:
+            pass
+        else:
+            assert False
+    upload.remove()
+
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+    response = Request.blank('/convert/upload', method='POST') \
+        .get_response(app)
+    assert response.status_int == 201
+    upload_id = simplejson.loads(response.body)['upload_id']
+    with open('tests/redcap/format_1.csv') as input_file:
+        data = input_file.read()
+    response = Request.blank(
+        '/convert/upload/chunk?upload_id=%s&index=0&sha1=%s' % (
+            upload_id, hashlib.sha1(data).hexdigest()),
+        method='PUT',
+        body=data,
+    ).get_response(app)
+    assert simplejson.loads(response.body)['chunks'] == [0]
+    response = Request.blank('/convert/upload/finalize', POST={
+            'upload_id': upload_id,
+            'chunks': '1',
+            'system': 'redcap',
+            'format': 'json',
+            'instrument_title': 'Test title',
+            'instrument_id': 'id0',
+            'outname': 'red2rio_chunked',
+            }).get_response(app)
+    assert response.status_int == 200
+    assert response.content_disposition == \
+        'attachment; filename=red2rio_chunked.zip'
+    response = Request.blank('/convert/upload?upload_id=%s' % (upload_id,),
+                             method='DELETE').get_response(app)
+    assert response.status_int == 204
+    app.off()
+
+def test_streaming_ingest():
+    import cStringIO
+    import importlib
+    from rios.converter.results import content_digest
+    from rios.converter.scratch import ScratchSpace
+    # The package exports the ingest() function under the module's name
+    ingest_module = importlib.import_module('rios.converter.ingest')
+
+    with open('tests/redcap/format_1.csv') as input_file:
+        data = input_file.read()
+    req = Request.blank('/convert/to/rios', POST={
+            'system': 'redcap',
+            'infile': ('format_1.csv', cStringIO.StringIO(data)),
+            })
+    # Delimiters straddle the blocks the body is read in
+    block_size = ingest_module.BLOCK_SIZE
+    ingest_module.BLOCK_SIZE = 7
+    try:
+        with ScratchSpace('tests/sandbox/scratch').request() as scratch:
+            fields = ingest_module.ingest_multipart(req, scratch)
+            assert fields['system'] == u'redcap'
+            infile = fields['infile']
+            assert infile.filename == 'format_1.csv'
+            assert infile.file.read() == data
+            assert infile.file.content_digest == \
+                content_digest(cStringIO.StringIO(data))
+            assert infile.file.prefix == data[:ingest_module.SNIFF_SIZE]
+            assert infile.file.rows == len(data.splitlines())
+    finally:
+        ingest_module.BLOCK_SIZE = block_size
+
+    req = Request.blank('/convert/to/rios', POST={
+            'infile': ('format_1.csv', cStringIO.StringIO(data)),
+            })
+    req.body = req.body[:-10]
+    with ScratchSpace('tests/sandbox/scratch').request() as scratch:
+        try:
+            ingest_module.ingest_multipart(req, scratch)
+        except ingest_module.HTTPBadRequest:
+            pass
+        else:
+            assert False
+
+def test_fingerprinted_assets():
+    import gzip
+    import shutil
+    from rios.converter.assets import asset_response, build_assets
+
+    www = 'tests/sandbox/www'
+    shutil.rmtree(www, ignore_errors=True)
+    shutil.copytree('static/www', www)
+    os.makedirs(os.path.join(www, 'bundle'))
+    with open(os.path.join(www, 'bundle', 'bundle.css'), 'wb') as fp:
+        fp.write('.footer { bottom: 0; }\n' * 100)
+    manifest = build_assets(www)
+    css = manifest['bundle/bundle.css']
+    assert css.startswith('bundle/bundle.') and css.endswith('.css')
+    assert manifest['img/prometheus_footer.png'] != \
+        'img/prometheus_footer.png'
+    assert build_assets(www) == manifest
+    with gzip.open(os.path.join(www, css + '.gz')) as fp:
+        gzipped = fp.read()
+    with open(os.path.join(www, css), 'rb') as fp:
+        assert fp.read() == gzipped
+
+    req = Request.blank('/' + css)
+    req.accept_encoding = 'gzip'
+    with open(os.path.join(www, css + '.gz'), 'rb') as fp:
+        response = asset_response(req, css, gzipped, fp.read())
+    assert response.content_encoding == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert response.content_type == 'text/css'
+    response = asset_response(Request.blank('/bundle/bundle.css'),
+                              'bundle.css', gzipped)
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.etag
+
+def test_compression_policy():
+    import cStringIO
+    import gzip
+    import shutil
+    import tarfile
+    import zipfile
+    import zlib
+    from multiprocessing.pool import ThreadPool
+    from rios.converter import compression
+    from rios.converter.engine import build_archive, build_tar
+    from rios.converter.results import ResultStore
+
+    policy = compression.CompressionPolicy(budget=0.5)
+    assert policy.level(None) == compression.STREAM_LEVEL
+    assert policy.level(1000) == 9
+    assert policy.level(1 << 30) == 1
+    assert policy.level(20 << 20) == 6
+
+    content = ''.join('%d,' % (idx,) for idx in range(1 << 19))
+    piece_size = compression.PIECE_SIZE
+    compression.PIECE_SIZE = 1 << 16
+    try:
+        deflated = compression.deflate(content, 6)
+        pool = ThreadPool(2)
+        assert compression.deflate(content, 6, pool) == deflated
+        pool.close()
+    finally:
+        compression.PIECE_SIZE = piece_size
+    assert zlib.decompress(deflated, -15) == content
+
+    members = [
+        ('small.log', 'done', None, {}),
+        ('large.json', {'values': range(10000)}, 'json', {}),
+        ('random.bin', os.urandom(4096), None, {}),
+    ]
+    archive = zipfile.ZipFile(build_archive(members))
+    assert archive.testzip() is None
+    infos = dict((info.filename, info) for info in archive.infolist())
+    assert infos['small.log'].compress_type == zipfile.ZIP_STORED
+    assert infos['large.json'].compress_type == zipfile.ZIP_DEFLATED
+    assert infos['random.bin'].compress_type == zipfile.ZIP_STORED
+    assert archive.read('small.log') == 'done'
+
+    tar = build_tar(members).read()
+    assert build_tar(members).read() == tar
+    archive = tarfile.open(fileobj=cStringIO.StringIO(tar))
+    assert archive.getnames() == ['small.log', 'large.json', 'random.bin']
+    assert archive.extractfile('small.log').read() == 'done'
+
+    shutil.rmtree('tests/sandbox/compression_results', ignore_errors=True)
+    store = ResultStore('tests/sandbox/compression_results')
+    stored = store.put(build_tar(members), 'out.tar')
+    renamed = store.put(build_tar(members), 'renamed.tar')
+    assert renamed.etag != stored.etag
+    assert store.get(stored.etag).filename == 'out.tar'
+    assert store.get(renamed.etag).filename == 'renamed.tar'
+    gzipped = store.gzipped(stored)
+    assert gzipped.etag == stored.etag + '-gzip'
+    assert store.gzipped(stored) == gzipped
+    with gzip.open(gzipped.path) as fp:
+        assert fp.read() == tar
+
+def test_multi_format_output():
+    import zipfile
+    from multiprocessing.pool import ThreadPool
+    from rios.converter.engine import (
+        build_archive,
+        output_formats,
+        to_rios_members,
+    )
+    from rios.converter.results import LRUCache
+    from rios.converter.serialization import load_json, load_yaml
+
+    assert output_formats('yaml,json,yaml') == ['yaml', 'json']
+    result = {
+        'instrument': {'id': 'urn:test', 'version': '1.0', 'record': []},
+        'form': {'instrument': {'id': 'urn:test', 'version': '1.0'}},
+        'logs': ['Converted\n'],
+    }
+    members = to_rios_members(result, 'test', 'yaml,json')
+    assert [member[0] for member in members] == [
+        'test_i.yaml', 'test_f.yaml', 'test_i.json', 'test_f.json',
+        'conversion_log.txt',
+    ]
+    assert [member[0] for member in to_rios_members(result, 'test', 'json')] \
+        == ['test_i.json', 'test_f.json', 'conversion_log.txt']
+
+    pool = ThreadPool(2)
+    output = build_archive(members, pool=pool).read()
+    pool.close()
+    assert build_archive(members).read() == output
+    archive = zipfile.ZipFile(build_archive(members))
+    assert load_yaml(archive.read('test_i.yaml')) == result['instrument']
+    assert load_json(archive.read('test_f.json')) == result['form']
+
+    cache = LRUCache(2)
+    cache.put('a', result)
+    cache.put('b', None)
+    assert cache.get('a') == (True, result)
+    cache.put('c', {})
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, result)
+    assert cache.stats() == {
+        'size': 2, 'entries': 2, 'hits': 2, 'misses': 1,
+    }
+
+def test_interned_documents():
+    import copy
+    import pickle
+    from rios.converter.engine import (
+        FROM_RIOS_CONVERTERS,
+        from_rios_params,
+        load_converter,
+    )
+    from rios.converter.interning import FrozenDict, intern_document
+    from rios.converter.validation import (
+        document_digest,
+        load_rios,
+        validate_rios,
+    )
+
+    document = {
+        'pages': [
+            {'id': 'page%d' % (idx,), 'enumerations': [
+                {'id': 'yes', 'text': {'en': 'Yes'}},
+                {'id': 'no', 'text': {'en': 'No'}},
+            ], 'values': [1, 1.0, True]}
+            for idx in range(2)
+        ],
+    }
+    interned = intern_document(document)
+    assert interned == document
+    assert document_digest(interned) == document_digest(document)
+    first, second = interned['pages']
+    assert first['enumerations'] is second['enumerations']
+    assert [type(value) for value in first['values']] == [int, float, bool]
+    try:
+        first['enumerations'][0]['id'] = 'maybe'
+    except TypeError:
+        pass
+    else:
+        assert False
+    copied = copy.deepcopy(interned)
+    copied['pages'][0]['enumerations'][0]['text']['en'] = 'Maybe'
+    assert copied != document and interned == document
+    assert type(pickle.loads(pickle.dumps(interned, 2))) is dict
+
+    names = ('format_1_i.yaml', 'format_1_f.yaml', 'format_1_c.yaml')
+    outputs = []
+    for interned in (False, True):
+        documents = []
+        for name in names:
+            with open('tests/redcap/' + name) as stream:
+                documents.append(load_rios('yaml', stream, interned=interned))
+        assert isinstance(documents[1], FrozenDict) == interned
+        assert validate_rios(*documents) is None
+        outputs.append([
+            load_converter(FROM_RIOS_CONVERTERS[system])(
+                **from_rios_params(*documents))
+            for system in ('redcap', 'qualtrics')
+        ])
+    assert outputs[0] == outputs[1]
+
+def test_validation_report():
+    import shutil
+    import tempfile
+    from rios.converter.csv_validation import failure_rows, log_failures
+    from rios.converter.reports import (
+        PAGE_SIZE,
+        REPORT_NAME,
+        SUMMARY_NAME,
+        StoredReport,
+        ValidationReport,
+    )
+    from rios.converter.serialization import dump_json
+
+    class Failure(Exception):
+        pass
+
+    class RequiredStrVal(object):
+        pass
+
+    named = Failure('Out of range')
+    named.validator = 'IntRangeVal'
+    failures = {
+        'field_name': dict(
+            (line, [Failure('Required')]) for line in range(2, 252)),
+        'text_validation_min': {7: [named]},
+    }
+    rows = failure_rows({'field_name': [RequiredStrVal()]}, failures)
+    assert len(rows) == 251
+    assert rows[0] == (2, 'field_name', 'RequiredStrVal', 'Required')
+    assert (7, 'text_validation_min', 'IntRangeVal', 'Out of range') in rows
+
+    class Logger(object):
+        def __init__(self):
+            self.lines = []
+
+        def log(self, line):
+            self.lines.append(line)
+
+    logger = Logger()
+    log_failures(failures, logger)
+    assert logger.lines[-1] == '  (151 more failing lines suppressed)'
+
+    report = ValidationReport(rows)
+    content, summary = report.dump()
+    assert summary['failures'] == 251 and summary['lines'] == 250
+    assert summary['columns'][0] == ('field_name', 250)
+    assert len(summary['offsets']) == 3
+    path = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(path, REPORT_NAME), 'wb') as fp:
+            fp.write(content.read())
+        with open(os.path.join(path, SUMMARY_NAME), 'wb') as fp:
+            fp.write(dump_json(summary))
+        stored = StoredReport.load(path)
+        assert stored.pages == 3
+        assert len(stored.page(1)) == PAGE_SIZE
+        assert stored.page(3)[-1] == [u'251', u'field_name',
+                                      u'RequiredStrVal', u'Required']
+        assert stored.page(4) is None
+        assert stored.open().readline().startswith('line,column')
+        assert StoredReport.load(os.path.join(path, 'missing')) is None
+    finally:
+        shutil.rmtree(path)
+
+    # Reports are served by session only, and aren't cached
+    import cStringIO
+    app = Rex(
+        'rios.converter',
+        temp_dir='tests/sandbox',
+        log_dir='tests/sandbox/log_dir'
+    )
+    app.on()
+    with open('tests/redcap/format_1.csv') as input_file:
+        lines = input_file.read().split('\n')
+    fields = lines[2].split(',')
+    lines[2] = ','.join(fields[:1] + [''] + fields[2:])
+    response = Request.blank('/convert/to/rios', POST={
+            'system': 'redcap',
+            'format': 'yaml',
+            'instrument_title': 'Test title',
+            'instrument_id': 'id0',
+            'outname': 'invalid',
+            'infile': ('format_1.csv', cStringIO.StringIO('\n'.join(lines))),
+            }).get_response(app)
+    session = response.headers['X-Conversion-Session']
+    for path in ('/convert/report', '/convert/report/csv'):
+        response = Request.blank(
+            '%s?session=%s' % (path, session)).get_response(app)
+        assert response.status_int == 200
+        assert 'no-store' in response.headers['Cache-Control']
+        response = Request.blank(
+            '%s?session=%s' % (path, session[:24])).get_response(app)
+        assert response.status_int == 400
+    app.off()
+
+def test_yaml_output():
+    from rios.converter.serialization import dump_yaml, load_yaml
+
+    unicode_text = u'Caf\xe9 \u2014 ' * 8
+    payload = {
+        'tab': 'a\tb',
+        'quoted': 'He said "yes" and \'no\'. ' * 8,
+        'lines': 'First line\nsecond line\n' * 4,
+        'unicode': unicode_text,
+    }
+    assert load_yaml(dump_yaml(payload)) == payload
+    # Folded like yaml.Dumper does, which libyaml does not
+    assert dump_yaml({'unicode': unicode_text}) == (
+        'unicode: "Caf\\xE9 \\u2014 Caf\\xE9 \\u2014 Caf\\xE9 \\u2014'
+        ' Caf\\xE9 \\u2014 Caf\\xE9 \\u2014\\\n'
+        '  \\ Caf\\xE9 \\u2014 Caf\\xE9 \\u2014 Caf\\xE9 \\u2014 "\n'
+    )
+    compact = {'label': 'Plain', 'values': [1, 2]}
+    assert load_yaml(dump_yaml(compact, compact=True)) == compact